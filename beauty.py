@@ -0,0 +1,217 @@
+"""Локальная оценка "красоты" найденных номеров.
+
+Номера из файла результата megafon.py загружаются в матрицу цифр NumPy,
+и библиотека правил (серии, лесенки, зеркала, повторы блоков...) считается
+векторно пачками по всем номерам сразу. Так можно один раз запросить широкие
+маски, а тонкий отбор делать офлайн.
+
+    python beauty.py numbers_20240101_120000.txt --top 50
+    python beauty.py numbers.ndjson.gz --tag mirror6 --min-score 20 --out best.ndjson
+"""
+import argparse
+import gzip
+import json
+import sys
+from typing import Callable, List, NamedTuple
+
+import numpy as np
+
+DIGITS = 11  # 7XXXXXXXXXX
+TAIL = 7  # "Красивая" часть номера - последние 7 цифр
+CHUNK = 1_000_000  # Номеров в пачке
+
+
+def load_numbers(filename: str) -> np.ndarray:
+    """Номера из файла результата (txt или ndjson, можно .gz) как int64"""
+    opener = gzip.open if filename.endswith(".gz") else open
+    numbers = []
+    with opener(filename, 'rt', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                numbers.append(int(json.loads(line)["number"]) if line.startswith("{") else int(line))
+            except (ValueError, KeyError):
+                continue
+    return np.unique(np.array(numbers, dtype=np.int64))
+
+
+def digit_matrix(numbers: np.ndarray) -> np.ndarray:
+    """Матрица цифр (N, 11) uint8, старшая цифра слева"""
+    digits = np.empty((len(numbers), DIGITS), dtype=np.uint8)
+    rest = numbers.copy()
+    for col in range(DIGITS - 1, -1, -1):
+        rest, digit = np.divmod(rest, 10)
+        digits[:, col] = digit
+    return digits
+
+
+def longest_run(mask: np.ndarray) -> np.ndarray:
+    """Длина самой длинной серии True по строкам матрицы (N, M)"""
+    current = np.zeros(mask.shape[0], dtype=np.int8)
+    best = np.zeros(mask.shape[0], dtype=np.int8)
+    for col in range(mask.shape[1]):
+        current = np.where(mask[:, col], current + 1, 0).astype(np.int8)
+        np.maximum(best, current, out=best)
+    return best
+
+
+# Правила: функция от матрицы цифр -> сила совпадения (0 - нет совпадения)
+
+def rule_same_run(d: np.ndarray) -> np.ndarray:
+    """Серия одинаковых цифр в хвосте (от 3-х): 777, 0000"""
+    tail = d[:, -TAIL:]
+    run = longest_run(tail[:, 1:] == tail[:, :-1]) + 1
+    return np.where(run >= 3, run - 2, 0)
+
+
+def rule_ladder(d: np.ndarray) -> np.ndarray:
+    """Лесенка из 4+ цифр по возрастанию или убыванию: 1234, 9876"""
+    tail = d[:, -TAIL:].astype(np.int8)
+    step = tail[:, 1:] - tail[:, :-1]
+    run = np.maximum(longest_run(step == 1), longest_run(step == -1)) + 1
+    return np.where(run >= 4, run - 3, 0)
+
+
+def rule_same_end(d: np.ndarray) -> np.ndarray:
+    """Одинаковые цифры в самом конце (от 3-х): ...777"""
+    last = d[:, -1:]
+    same = d[:, -TAIL:] == last
+    run = longest_run(same[:, ::-1] & np.cumprod(same[:, ::-1], axis=1).astype(bool))
+    return np.where(run >= 3, run - 2, 0)
+
+
+def make_mirror(length: int) -> Callable[[np.ndarray], np.ndarray]:
+    def rule(d: np.ndarray) -> np.ndarray:
+        tail = d[:, -length:]
+        return np.all(tail == tail[:, ::-1], axis=1).astype(np.int8)
+    rule.__doc__ = f"Зеркало последних {length} цифр: 1221, 123321"
+    return rule
+
+
+def make_repeat(block: int, times: int) -> Callable[[np.ndarray], np.ndarray]:
+    def rule(d: np.ndarray) -> np.ndarray:
+        tail = d[:, -block * times:]
+        first = tail[:, :block]
+        same = np.ones(len(d), dtype=bool)
+        for i in range(1, times):
+            same &= np.all(tail[:, i * block:(i + 1) * block] == first, axis=1)
+        # Блок из одной цифры уже учтён сериями
+        return (same & np.any(first != first[:, :1], axis=1)).astype(np.int8)
+    rule.__doc__ = f"Блок из {block} цифр повторяется {times} раза в конце: 1212, 123123"
+    return rule
+
+
+def rule_pairs(d: np.ndarray) -> np.ndarray:
+    """Пары в конце: AABB, AABBCC"""
+    tail = d[:, -6:]
+    pairs = tail[:, 0::2] == tail[:, 1::2]
+    distinct = tail[:, 0::2][:, 1:] != tail[:, 0::2][:, :-1]
+    aabb = pairs[:, 1:].all(axis=1) & distinct[:, 1]
+    aabbcc = pairs.all(axis=1) & distinct.all(axis=1)
+    return aabb.astype(np.int8) + aabbcc.astype(np.int8)
+
+
+def rule_few_digits(d: np.ndarray) -> np.ndarray:
+    """Мало разных цифр в хвосте: 7 цифр из 2-3 разных"""
+    tail = d[:, -TAIL:]
+    present = np.zeros((len(d), 10), dtype=bool)
+    present[np.arange(len(d))[:, None], tail] = True
+    distinct = present.sum(axis=1)
+    return np.clip(4 - distinct, 0, None)
+
+
+def rule_round(d: np.ndarray) -> np.ndarray:
+    """Круглый номер: нули в конце (от 2-х)"""
+    zeros = longest_run((d[:, ::-1] == 0) & np.cumprod(d[:, ::-1] == 0, axis=1).astype(bool))
+    return np.where(zeros >= 2, zeros - 1, 0)
+
+
+class Rule(NamedTuple):
+    name: str
+    weight: float
+    func: Callable[[np.ndarray], np.ndarray]
+
+
+RULES: List[Rule] = [
+    Rule("run", 10, rule_same_run),
+    Rule("end", 8, rule_same_end),
+    Rule("ladder", 8, rule_ladder),
+    Rule("mirror4", 6, make_mirror(4)),
+    Rule("mirror6", 15, make_mirror(6)),
+    Rule("mirror7", 20, make_mirror(7)),
+    Rule("abab", 8, make_repeat(2, 2)),
+    Rule("ababab", 18, make_repeat(2, 3)),
+    Rule("abcabc", 15, make_repeat(3, 2)),
+    Rule("pairs", 8, rule_pairs),
+    Rule("few", 7, rule_few_digits),
+    Rule("round", 6, rule_round),
+]
+
+
+def score(numbers: np.ndarray, rules: List[Rule] = RULES) -> tuple:
+    """Оценивает номера пачками.
+
+    Возвращает (scores float32 (N,), tags uint32 (N,)) - в tags бит i
+    установлен, если сработало правило rules[i].
+    """
+    scores = np.zeros(len(numbers), dtype=np.float32)
+    tags = np.zeros(len(numbers), dtype=np.uint32)
+    for start in range(0, len(numbers), CHUNK):
+        d = digit_matrix(numbers[start:start + CHUNK])
+        chunk_scores = scores[start:start + CHUNK]
+        chunk_tags = tags[start:start + CHUNK]
+        for i, rule in enumerate(rules):
+            strength = rule.func(d)
+            chunk_scores += rule.weight * strength
+            chunk_tags |= (strength > 0).astype(np.uint32) << i
+    return scores, tags
+
+
+def tag_names(tag_bits: int, rules: List[Rule] = RULES) -> List[str]:
+    return [rule.name for i, rule in enumerate(rules) if tag_bits & (1 << i)]
+
+
+def main(argv: List[str] = None):
+    parser = argparse.ArgumentParser(description="Оценка красоты номеров")
+    parser.add_argument("file", help="файл результата megafon.py (txt/ndjson, можно .gz)")
+    parser.add_argument("--top", type=int, default=50, help="сколько лучших номеров показать")
+    parser.add_argument("--min-score", type=float, default=0, help="минимальная оценка")
+    parser.add_argument("--tag", action="append", default=[], help="только номера с этим правилом (можно несколько)")
+    parser.add_argument("--out", help="записать отобранные номера в NDJSON")
+    parser.add_argument("--rules", action="store_true", help="показать список правил")
+    args = parser.parse_args(argv)
+
+    if args.rules:
+        for rule in RULES:
+            print(f"{rule.name:10} {rule.weight:5g}  {rule.func.__doc__}")
+        return
+
+    numbers = load_numbers(args.file)
+    print(f"Номеров: {len(numbers)}", file=sys.stderr)
+    scores, tags = score(numbers)
+
+    selected = scores >= args.min_score
+    for name in args.tag:
+        names = [rule.name for rule in RULES]
+        if name not in names:
+            parser.error(f"неизвестное правило: {name}")
+        selected &= (tags & (1 << names.index(name))) != 0
+    idx = np.flatnonzero(selected)
+    idx = idx[np.argsort(-scores[idx], kind="stable")]
+    print(f"Отобрано: {len(idx)}", file=sys.stderr)
+
+    if args.out:
+        with open(args.out, 'w', encoding='utf-8') as f:
+            for i in idx:
+                f.write(json.dumps({"number": str(numbers[i]), "score": float(scores[i]),
+                                    "tags": tag_names(int(tags[i]))}) + "\n")
+        print(f"Сохранено в: {args.out}", file=sys.stderr)
+
+    for i in idx[:args.top]:
+        print(f"{numbers[i]}  {scores[i]:6.1f}  {','.join(tag_names(int(tags[i])))}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,252 @@
+"""Бенчмарк пропускной способности megafon.py на локальном mock_server.py.
+
+Для каждой настройки планировщика (регионов одновременно × воркеров на регион
+× запросов на хост) прогоняет run_regions против mock-сервера и печатает
+запросы/с, номера/с, p50/p99 задержки запросов и пиковую память.
+
+    python bench.py --regions 8 --masks 777,1234,0000 --settings 1x1x8,4x2x8,8x4x8
+    python bench.py --json bench.json                      # сохранить результат
+    python bench.py --baseline bench.json --tolerance 0.1  # сравнить с прошлым, код 1 при регрессии
+    python bench.py --replay run.replay.gz --masks 777,12 --replay-scale 0  # по записи (megafon.py --record)
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import List
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, REPO_DIR)
+
+from mock_server import MockServer, add_config_args, config_from_args  # noqa: E402
+
+
+def percentile(values: List[float], p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def parse_settings(text: str) -> List[tuple]:
+    """'1x1x8,4x2x8' -> [(регионов, воркеров, на хост), ...]"""
+    settings = []
+    for part in text.split(","):
+        values = [int(v) for v in part.strip().split("x")]
+        while len(values) < 3:
+            values.append(8)
+        settings.append(tuple(values[:3]))
+    return settings
+
+
+def make_timed_session(base, latencies: List[float]):
+    """Сессия, которая замеряет время каждого запроса"""
+
+    class TimedSession(base):
+        async def request(self, *args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await super().request(*args, **kwargs)
+            finally:
+                latencies.append(time.perf_counter() - started)
+
+    return TimedSession
+
+
+def reset_state(megafon, per_host: int, warm: bool):
+    """Сбрасывает глобальное состояние megafon между прогонами"""
+    megafon.all_numbers = megafon.NumberSet()
+    megafon.MAX_PER_HOST = per_host
+    megafon.host_semaphores.clear()
+    megafon.page_probes.clear()
+    megafon.rate_controllers.clear()
+    megafon.retry_policies.clear()
+    megafon.branch_aliases.clear()
+    megafon.split_aliases.clear()
+    megafon.session_pool = megafon.SessionPool()
+    megafon.yield_history = megafon.YieldHistory(megafon.YIELD_HISTORY_FILE)
+    megafon.run_budget = megafon.RunBudget()
+    if not warm:
+        for filename in (megafon.BOOTSTRAP_CACHE_FILE, megafon.CLASSES_CACHE_FILE, megafon.PAGE_LIMIT_CACHE_FILE):
+            if os.path.exists(filename):
+                os.remove(filename)
+        megafon.bootstrap_cache = None
+        megafon.classes_cache = None
+        megafon.page_limit_cache = None
+
+
+def recorded_regions(megafon, replay) -> List[str]:
+    """Регионы, запросы которых есть в архиве воспроизведения"""
+    urls = {key.split(" ")[1] for key in replay.exchanges}
+    regions = []
+    for city in megafon.REGIONS:
+        base = megafon.SHOP_URL.format(city=city)
+        if any(url == base or url.startswith(base + "/") for url in urls):
+            regions.append(city)
+    return regions
+
+
+async def run_setting(megafon, server: MockServer, session_class, regions: List[str], masks: List[str],
+                      setting: tuple, warm: bool, verbose: bool) -> dict:
+    parallel, threads, per_host = setting
+    reset_state(megafon, per_host, warm)
+    if server:
+        server.stats.reset()
+    else:
+        megafon.replay.rewind()  # Кэши - как на момент записи
+    latencies: List[float] = []
+    megafon.AsyncSession = make_timed_session(session_class, latencies)
+
+    region_proxy_map = {city: [None] * threads for city in regions}
+    writer = megafon.ResultWriter(f"bench_{parallel}x{threads}x{per_host}.txt", "txt", False)
+    writer.start()
+
+    output = contextlib.nullcontext() if verbose else contextlib.redirect_stdout(io.StringIO())
+    tracemalloc.start()
+    started = time.perf_counter()
+    with output:
+        await megafon.run_regions(regions, region_proxy_map, masks, writer, [None], max_regions=parallel)
+        await writer.close()
+    elapsed = time.perf_counter() - started
+    pool = megafon.session_pool.snapshot()
+    await megafon.session_pool.close()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    os.remove(writer.filename)
+
+    requests = len(latencies)
+    return {
+        "setting": f"{parallel}x{threads}x{per_host}",
+        "seconds": round(elapsed, 3),
+        "requests": requests,
+        "server_requests": server.stats.total if server else megafon.replay.served,
+        "numbers": writer.count,
+        "requests_per_sec": round(requests / elapsed, 2) if elapsed else 0,
+        "numbers_per_sec": round(writer.count / elapsed, 2) if elapsed else 0,
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 1),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 1),
+        "peak_mb": round(peak / 1024 / 1024, 2),
+        "new_connections": pool["new_connections"],
+        "connection_reuse": pool["connection_reuse"],
+    }
+
+
+def print_table(results: List[dict]):
+    header = f"{'настройка':>10} {'сек':>8} {'запросов':>9} {'запр/с':>8} {'номеров':>8} {'ном/с':>9} " \
+             f"{'p50 мс':>8} {'p99 мс':>8} {'пик МБ':>8}"
+    print(header)
+    print("-" * len(header))
+    for r in results:
+        print(f"{r['setting']:>10} {r['seconds']:>8.2f} {r['requests']:>9} {r['requests_per_sec']:>8.1f} "
+              f"{r['numbers']:>8} {r['numbers_per_sec']:>9.1f} {r['p50_ms']:>8.1f} {r['p99_ms']:>8.1f} "
+              f"{r['peak_mb']:>8.2f}")
+
+
+def compare(results: List[dict], baseline_file: str, tolerance: float) -> bool:
+    """Сравнивает с прошлым результатом, True если регрессий нет"""
+    with open(baseline_file, 'r', encoding='utf-8') as f:
+        baseline = {r["setting"]: r for r in json.load(f)["results"]}
+    ok = True
+    for r in results:
+        base = baseline.get(r["setting"])
+        if not base:
+            continue
+        for key in ("requests_per_sec", "numbers_per_sec"):
+            if base[key] and r[key] < base[key] * (1 - tolerance):
+                print(f"РЕГРЕССИЯ {r['setting']} {key}: {r[key]} < {base[key]} (-{tolerance:.0%})")
+                ok = False
+        if base["peak_mb"] and r["peak_mb"] > base["peak_mb"] * (1 + tolerance):
+            print(f"РЕГРЕССИЯ {r['setting']} peak_mb: {r['peak_mb']} > {base['peak_mb']} (+{tolerance:.0%})")
+            ok = False
+    return ok
+
+
+async def run(args: argparse.Namespace, megafon) -> List[dict]:
+    if args.replay:
+        # Без сети: ответы из архива megafon.py --record
+        server = None
+        megafon.replay = megafon.Replay(args.replay, args.replay_scale)
+        megafon.SHOP_URL = megafon.replay.shop_url
+        megafon.CLASSES_URL = megafon.replay.classes_url
+        session_class = megafon.ReplaySession
+        candidates = recorded_regions(megafon, megafon.replay)
+    else:
+        server = MockServer(0, config_from_args(args)).start()
+        megafon.SHOP_URL = server.shop_url
+        megafon.CLASSES_URL = server.classes_url
+        session_class = megafon.AsyncSession
+        candidates = list(megafon.REGIONS)
+
+    # По региону на филиал, чтобы регионы не дублировали друг друга
+    regions, branches = [], set()
+    for city in candidates:
+        branch_id = megafon.REGIONS[city]
+        if branch_id not in branches:
+            branches.add(branch_id)
+            regions.append(city)
+    regions = regions[:args.regions]
+    masks = [m.strip() for m in args.masks.split(",") if m.strip()]
+    if args.replay:
+        # Как в megafon.py: выводимые маски не запрашиваются, иначе их нет в архиве
+        masks = megafon.MaskPlan(masks).remote
+
+    results = []
+    try:
+        for setting in parse_settings(args.settings):
+            print(f"Прогон {setting[0]}x{setting[1]}x{setting[2]}: {len(regions)} регионов, {len(masks)} масок...",
+                  file=sys.stderr)
+            results.append(await run_setting(megafon, server, session_class, regions, masks, setting,
+                                             args.warm, args.verbose))
+            if args.replay and megafon.replay.misses:
+                print(f"  нет в архиве: {megafon.replay.misses} запросов (маски и регионы должны совпадать с записью)",
+                      file=sys.stderr)
+    finally:
+        if server:
+            server.stop()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк megafon.py на mock-сервере")
+    parser.add_argument("--regions", type=int, default=4, help="сколько регионов")
+    parser.add_argument("--masks", default="777,1234,0000", help="маски через запятую")
+    parser.add_argument("--settings", default="1x1x8,4x1x8,4x2x8",
+                        help="настройки: регионов_одновременно x воркеров_на_регион x запросов_на_хост")
+    parser.add_argument("--warm", action="store_true", help="не сбрасывать кэши между прогонами")
+    parser.add_argument("--verbose", action="store_true", help="показывать вывод парсера")
+    parser.add_argument("--json", help="сохранить результаты в файл")
+    parser.add_argument("--baseline", help="сравнить с сохранённым результатом")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="допустимое ухудшение (доля)")
+    parser.add_argument("--replay", help="отвечать из архива megafon.py --record вместо mock-сервера")
+    parser.add_argument("--replay-scale", type=float, default=1.0,
+                        help="множитель записанного времени ответа (0 - без задержек)")
+    add_config_args(parser)
+    args = parser.parse_args()
+    for attr in ("json", "baseline", "replay"):
+        if getattr(args, attr):
+            setattr(args, attr, os.path.abspath(getattr(args, attr)))
+
+    # megafon пишет лог, кэши и журнал в текущую папку - работаем во временной
+    workdir = tempfile.mkdtemp(prefix="megafon_bench_")
+    os.chdir(workdir)
+    import megafon
+
+    results = asyncio.run(run(args, megafon))
+    print_table(results)
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump({"config": vars(args), "results": results}, f, ensure_ascii=False, indent=2)
+        print(f"Сохранено в: {args.json}")
+    if args.baseline and not compare(results, args.baseline, args.tolerance):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
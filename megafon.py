@@ -1,40 +1,135 @@
+import argparse
 import asyncio
+import atexit
+import os
+from queue import SimpleQueue
+import shutil
+import heapq
+import inspect
+import sys
 import random
 import string
 import re
 import base64
+import bisect
+import contextlib
+import gzip
 import logging
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 import json
+import sqlite3
+import threading
+import time
+import tracemalloc
 import urllib.parse
+import zlib
 from typing import Optional, List, Tuple
+from curl_cffi import CurlInfo
 from curl_cffi.requests import AsyncSession
 from datetime import datetime
 
 # Настройка логирования
-LOG_FILE = "megafon.log"
-file_handler = logging.FileHandler(LOG_FILE, encoding='utf-8', mode='w')  # mode='w' перезаписывает
-file_handler.setLevel(logging.DEBUG)
+# Запись в файл идёт в фоновом потоке через очередь, чтобы не тормозить event loop
+LOG_FILE = os.environ.get("MEGAFON_LOG", "megafon.log")  # Процессы --processes пишут каждый в свой
+LOG_LEVEL = logging.DEBUG
+LOG_MAX_BYTES = 50 * 1024 * 1024  # Размер файла до ротации
+LOG_BACKUPS = 5  # Сколько старых логов (.gz) хранить
+LOG_BODY_SAMPLE = 1.0  # Доля запросов, у которых пишутся заголовки и тела (0..1)
+
+
+def gzip_rotator(source: str, dest: str):
+    """Сжимает лог при ротации"""
+    with open(source, 'rb') as f_in, gzip.open(dest, 'wb') as f_out:
+        shutil.copyfileobj(f_in, f_out)
+    os.remove(source)
+
+
+class DeferredQueueHandler(QueueHandler):
+    """Кладёт запись в очередь без форматирования - оно делается в потоке записи"""
+
+    def prepare(self, record):
+        return record
+
+
+file_handler = RotatingFileHandler(LOG_FILE, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUPS, encoding='utf-8',
+                                   delay=True)
+file_handler.namer = lambda name: name + ".gz"
+file_handler.rotator = gzip_rotator
 file_handler.setFormatter(logging.Formatter('%(asctime)s [%(levelname)s] %(message)s'))
 
+
+def rotate_log():
+    """Каждый запуск парсера - новый файл лога, прошлый уходит в .gz.
+    Вызывается из main, а не при импорте: --runs, --merge и bench.py не вытесняют логи запусков"""
+    if os.path.exists(LOG_FILE) and os.path.getsize(LOG_FILE) > 0:
+        file_handler.acquire()  # Поток записи может как раз писать в файл
+        try:
+            file_handler.doRollover()
+        finally:
+            file_handler.release()
+
+log_queue = SimpleQueue()
+log_listener = QueueListener(log_queue, file_handler)
+log_listener.start()
+atexit.register(log_listener.stop)
+
 logger = logging.getLogger('megafon')
-logger.setLevel(logging.DEBUG)
-logger.addHandler(file_handler)
+logger.setLevel(LOG_LEVEL)
+logger.addHandler(DeferredQueueHandler(log_queue))
+
+
+class LazyJson:
+    """JSON для лога - сериализуется только при записи в файл"""
+
+    __slots__ = ("value",)
 
+    def __init__(self, value):
+        self.value = value
 
-def log_request(method: str, url: str, headers: dict = None, body: dict = None):
-    """Логирует запрос в файл"""
-    logger.debug(f">>> {method} {url}")
+    def __str__(self):
+        return json.dumps(self.value, ensure_ascii=False)
+
+
+class LazyTruncate:
+    """Обрезанный текст ответа для лога - режется только при записи в файл"""
+
+    __slots__ = ("text", "limit")
+
+    def __init__(self, text: str, limit: int):
+        self.text = text
+        self.limit = limit
+
+    def __str__(self):
+        text = self.text or ""
+        return text[:self.limit] + "..." if len(text) > self.limit else text
+
+
+def log_request(method: str, url: str, headers: dict = None, body: dict = None) -> bool:
+    """Логирует запрос в файл.
+
+    Возвращает, попал ли запрос в выборку LOG_BODY_SAMPLE - это передаётся в log_response,
+    чтобы тела запроса и ответа писались (или пропускались) вместе.
+    """
+    if not logger.isEnabledFor(logging.DEBUG):
+        return False
+    logger.debug(">>> %s %s", method, url)
+    if random.random() >= LOG_BODY_SAMPLE:
+        return False
+    # Копии: словари меняются дальше, а форматирование отложено
     if headers:
-        logger.debug(f"    Headers: {json.dumps(headers, ensure_ascii=False)}")
+        logger.debug("    Headers: %s", LazyJson(dict(headers)))
     if body:
-        logger.debug(f"    Body: {json.dumps(body, ensure_ascii=False)}")
+        logger.debug("    Body: %s", LazyJson(dict(body)))
+    return True
 
 
-def log_response(status: int, text: str, truncate: int = 1000):
-    """Логирует ответ в файл"""
-    body = text[:truncate] + "..." if len(text) > truncate else text
-    logger.debug(f"<<< Status: {status}")
-    logger.debug(f"    Response: {body}")
+def log_response(status: int, text: str, sampled: bool, truncate: int = 1000):
+    """Логирует ответ в файл; тело - только если запрос попал в выборку (sampled от log_request)"""
+    if not logger.isEnabledFor(logging.DEBUG):
+        return
+    logger.debug("<<< Status: %s", status)
+    if sampled:
+        logger.debug("    Response: %s", LazyTruncate(text, truncate))
 
 
 def log_info(message: str):
@@ -49,6 +144,10 @@ def log_error(message: str):
 
 RUCAPTCHA_KEY = "YOUR_RUCAPTCHA_KEY"  # Вставьте свой ключ с rucaptcha.com
 
+# Адреса магазина (можно подменить на локальный mock_server.py)
+SHOP_URL = "https://{city}.shop.megafon.ru"
+CLASSES_URL = "https://api.shop.megafon.ru/catalog/v1/showcases/1/branches/{branch_id}/numbers/classes"
+
 REGIONS = {
     'altay': '738', 'amur': '495', 'arhangelsk': '655', 'astrakhan': '255', 'bel': '815', 'brn': '596',
     'vl': '615', 'volgograd': '97', 'vologda': '656', 'vrn': '835', 'eao': '455', 'chita': '519', 'iv': '658',
@@ -66,11 +165,1629 @@ REGIONS = {
     'chechnya': '1036', 'chuvashia': '475', 'chukotka': '435', 'yanao': '416', 'yar': '702'
 }
 
-all_numbers = set()
-lock = asyncio.Lock()
+all_numbers = None  # NumberSet: msisdn всех найденных номеров (создаётся ниже)
 
 LIMIT = 44
 
+# Регионы с общим branch_id обходятся один раз - номера основного региона относятся и к ним
+branch_aliases = {}  # branch_id -> регионы-псевдонимы
+split_aliases = set()  # Псевдонимы, у которых --verify-alias нашёл другие данные - обходятся отдельно
+
+MAX_UNIT_RETRIES = 3  # Сколько раз юнит возвращается в очередь после ошибок
+MAX_WORKER_FAILURES = 3  # Ошибок подряд, после которых воркер останавливается
+
+# Планировщик: лимиты одновременной работы
+MAX_WORKERS_TOTAL = 100  # Воркеров одновременно (на все регионы), --max-workers
+MAX_PER_HOST = 8  # Одновременных запросов на один хост, --max-per-host
+
+# Пул сессий: одна долгоживущая AsyncSession на прокси (выход), её соединения
+# переиспользуют проверка прокси, запрос классов, воркеры и все регионы
+IMPERSONATE = "safari17_0"  # Отпечаток браузера для всех запросов
+SESSION_MAX_CLIENTS = 64  # Одновременных запросов в одной сессии
+SESSION_HTTP_VERSION = "v2tls"  # HTTP/2 по TLS, где сервер его поддерживает, иначе HTTP/1.1
+
+# Темп запросов (AIMD) на каждую пару хост/филиал: растёт на успехах,
+# падает вдвое на 404/409/429/5xx, ошибках соединения и при росте задержки
+RATE_START = 4.0  # Запросов в секунду на старте
+RATE_MIN = 0.2
+RATE_MAX = 10.0  # Потолок (--max-rate)
+RATE_STEP = 0.5  # Прибавка запросов/с за секунду успешных ответов
+RATE_DECREASE = 0.5  # Множитель при перегрузке
+RATE_SLOW_LATENCY = 3.0  # Задержка во столько раз выше базовой - признак перегрузки
+
+# Ретраи запросов (lnumber, msisdn API, классы): пауза с разбросом, бюджет и автомат
+RETRY_BASE = 0.5  # Секунд - верхняя граница первой паузы, дальше удваивается
+RETRY_CAP = 15.0  # Секунд - максимум паузы
+RETRY_BUDGET_RATIO = 0.2  # Ретраев, которые регион зарабатывает каждым первым запросом
+RETRY_BUDGET_MIN = 10  # Ретраев в запасе у региона на старте
+BREAKER_FAILURES = 5  # Ошибок подряд, после которых эндпоинт региона ставится на паузу
+BREAKER_COOLDOWN = 30.0  # Секунд паузы, при повторном срабатывании удваивается
+BREAKER_COOLDOWN_MAX = 300.0
+BREAKER_MAX_OPENS = 3  # Пауз подряд без успеха, после которых эндпоинт региона бросается
+
+# Кэш прогретых сессий: куки по ключу (city, proxy), переживает перезапуск
+BOOTSTRAP_CACHE_FILE = "bootstrap_cache.json"
+BOOTSTRAP_TTL = 30 * 60  # Секунд
+COOKIE_REJECT_STATUSES = (401, 403)  # Ответы msisdn API на устаревшие куки - нужен новый прогрев
+RETRY_CLIENT_STATUSES = (404, 408, 409, 429)  # 4xx, которые повторяются; остальные - отказ по самому запросу
+
+bootstrap_cache = None
+bootstrap_locks = {}
+
+# Кэш классов номеров по филиалам
+CLASSES_CACHE_FILE = "classes_cache.json"
+CLASSES_TTL = 24 * 60 * 60  # Секунд
+
+classes_cache = None
+
+# Метрики: периодический JSON-снимок (и по желанию HTTP для Prometheus)
+METRICS_FILE = "metrics.json"
+METRICS_INTERVAL = 10.0  # Секунд
+
+# Профилирование (--profile): сэмплы стека event loop, задержка цикла, память
+PROFILE_FILE = "profile_report.txt"
+PROFILE_INTERVAL = 0.005  # Секунд между сэмплами стека
+PROFILE_LAG_INTERVAL = 0.1  # Секунд - шаг замера задержки event loop
+PROFILE_MEMORY_INTERVAL = 30.0  # Секунд между окнами tracemalloc
+PROFILE_MEMORY_WINDOW = 1.0  # Секунд работы tracemalloc в каждом окне (он замедляет loop в разы)
+PROFILE_MEMORY_FRAMES = 25  # Глубина стека выделения - нужна, чтобы найти целевую функцию
+PROFILE_TARGETS = ("worker_fetch", "fetch_unit", "self_request_with_captcha", "bootstrap_session",
+                   "fetch_region", "ResultWriter.write", "ResultWriter.sync", "save_results")
+
+# Запись и воспроизведение обменов (--record / --replay): архив фикстур gzip NDJSON
+REPLAY_SCALE = 1.0  # Множитель записанного времени ответа (0 - отвечать сразу)
+REPLAY_VOLATILE_PARAMS = ("_rsc",)  # Случайные параметры адреса, которые не входят в ключ запроса
+
+recorder = None
+replay = None
+
+# Порядок работы: пары (филиал, маска) с большей отдачей в прошлых запусках - первыми
+YIELD_HISTORY_FILE = "yield_history.json"
+YIELD_DECAY = 0.5  # Вес прошлой оценки отдачи при обновлении после запуска
+
+# Непрерывное наблюдение (--watch): каждая пара (филиал, маска) опрашивается заново через
+# свой интервал - он сокращается, когда номера пары меняются, и растёт, когда нет
+WATCH_INTERVAL_START = 300.0  # Секунд
+WATCH_INTERVAL_MIN = 60.0  # --watch-min
+WATCH_INTERVAL_MAX = 3600.0  # --watch-max
+WATCH_SPEEDUP = 0.5  # Множитель интервала, если номера изменились
+WATCH_SLOWDOWN = 1.5  # Множитель интервала, если нет
+WATCH_JITTER = 0.1  # Разброс интервала, чтобы опросы не шли волной
+WATCH_REPORT_INTERVAL = 300.0  # Секунд между сводками
+
+# Очередь регионов для нескольких процессов (--processes)
+QUEUE_FILE = "region_queue.db"
+
+# Журнал выполненных юнитов для продолжения прерванного запуска (--resume)
+CHECKPOINT_FILE = "checkpoint.jsonl"
+
+# Запись результатов: номера пишутся в файл по мере нахождения
+OUTPUT_FORMAT = "txt"  # txt - по номеру в строке, ndjson - запись с регионом, маской и классом
+OUTPUT_GZIP = False
+RESULT_QUEUE_SIZE = 1000  # Пачек в очереди записи (дальше воркеры ждут)
+FSYNC_EVERY = 500  # Записей между fsync
+FSYNC_INTERVAL = 5.0  # Секунд между fsync
+RESULTS_DB = None  # SQLite-база с историей запусков, например "numbers.db" (None - не вести)
+
+# Пагинация: размер страницы подбирается один раз на филиал и кэшируется
+PAGE_LIMIT_CACHE_FILE = "page_limit_cache.json"
+PAGE_LIMIT_TTL = 7 * 24 * 60 * 60  # Секунд
+PAGE_LIMIT_PROBE = 200  # Какой limit пробовать
+PARALLEL_PAGES = 3  # Страниц вперёд одновременно для больших классов
+LARGE_CLASS_PAGES = 2  # После скольких полных страниц класс считается большим
+
+page_limit_cache = None
+page_probes = set()  # Филиалы, для которых проверка идёт прямо сейчас
+
+worker_slots: Optional[asyncio.Semaphore] = None
+host_semaphores = {}
+
+
+def host_slot(url: str) -> asyncio.Semaphore:
+    """Семафор хоста - ограничивает одновременные запросы к одному хосту"""
+    host = urllib.parse.urlsplit(url).netloc
+    sem = host_semaphores.get(host)
+    if sem is None:
+        sem = host_semaphores[host] = asyncio.Semaphore(MAX_PER_HOST)
+    return sem
+
+
+class RateController:
+    """Темп запросов к одному хосту/филиалу: интервал между запросами по AIMD.
+
+    Сигналы перегрузки - 404/409/429/5xx, ошибки соединения и задержка выше
+    базовой для того же эндпоинта в RATE_SLOW_LATENCY раз. Уменьшение - не чаще
+    раза за интервал задержки, чтобы пачка одновременных ошибок считалась одной.
+    """
+
+    def __init__(self, key: tuple):
+        self.key = key
+        self.rate = min(RATE_START, RATE_MAX)
+        self.next_time = 0.0
+        self.last_decrease = 0.0
+        self.latency = {}  # endpoint -> EWMA задержки, секунд
+        self.base_latency = {}  # endpoint -> минимальная наблюдавшаяся
+
+    async def wait(self):
+        """Ждёт своей очереди (интервал 1/rate с небольшим разбросом)"""
+        now = time.monotonic()
+        start = max(now, self.next_time)
+        self.next_time = start + random.uniform(0.8, 1.2) / self.rate
+        if start > now:
+            await asyncio.sleep(start - now)
+
+    def record(self, endpoint: str, status: Optional[int], seconds: float):
+        if status is None or status in (404, 409, 429) or status >= 500:
+            self.decrease()
+            return
+        latency = self.latency.get(endpoint)
+        latency = self.latency[endpoint] = seconds if latency is None else latency * 0.8 + seconds * 0.2
+        base = self.base_latency[endpoint] = min(seconds, self.base_latency.get(endpoint, seconds))
+        if latency > base * RATE_SLOW_LATENCY and latency > 0.5:
+            self.decrease()
+        else:
+            self.rate = min(RATE_MAX, self.rate + RATE_STEP / self.rate)
+
+    def decrease(self):
+        now = time.monotonic()
+        if now - self.last_decrease < max(max(self.latency.values(), default=0), 1 / self.rate):
+            return
+        self.last_decrease = now
+        self.rate = max(RATE_MIN, self.rate * RATE_DECREASE)
+        log_info(f"Rate {self.key}: {self.rate:.2f} req/s")
+
+
+rate_controllers = {}
+
+
+def rate_controller(url: str, city: str) -> RateController:
+    """Регулятор темпа для хоста url и филиала региона"""
+    key = (urllib.parse.urlsplit(url).netloc, REGIONS.get(city, city))
+    controller = rate_controllers.get(key)
+    if controller is None:
+        controller = rate_controllers[key] = RateController(key)
+    return controller
+
+
+class CircuitBreaker:
+    """Автомат эндпоинта региона: после BREAKER_FAILURES ошибок подряд запросы
+    не идут BREAKER_COOLDOWN секунд, потом проходит один пробный запрос.
+    После BREAKER_MAX_OPENS пауз без успеха запросы больше не пропускаются."""
+
+    def __init__(self):
+        self.failures = 0
+        self.opens = 0
+        self.given_up = False
+        self.open_until = 0.0
+        self.cooldown = BREAKER_COOLDOWN
+        self.probe_started = None  # Пробный запрос в работе
+
+    @property
+    def is_open(self) -> bool:
+        if self.failures < BREAKER_FAILURES or self.given_up:
+            return False
+        now = time.monotonic()
+        if now < self.open_until:
+            return True
+        return self.probe_started is not None and now - self.probe_started < self.cooldown
+
+    def allow(self) -> bool:
+        if self.given_up:
+            return False
+        if self.failures < BREAKER_FAILURES:
+            return True
+        if self.is_open:
+            return False
+        self.probe_started = time.monotonic()
+        return True
+
+    def success(self):
+        self.failures = 0
+        self.opens = 0
+        self.probe_started = None
+        self.cooldown = BREAKER_COOLDOWN
+
+    def failure(self) -> bool:
+        """Учитывает ошибку; True если автомат только что разомкнулся"""
+        self.failures += 1
+        if self.probe_started is not None:
+            # Пробный запрос не прошёл - пауза дольше
+            self.probe_started = None
+            self.cooldown = min(self.cooldown * 2, BREAKER_COOLDOWN_MAX)
+        elif self.failures != BREAKER_FAILURES:
+            return False
+        self.opens += 1
+        self.given_up = self.opens > BREAKER_MAX_OPENS
+        self.open_until = time.monotonic() + self.cooldown
+        return True
+
+
+class RetryPolicy:
+    """Общая политика ретраев региона.
+
+    Пауза перед ретраем - случайная от 0 до RETRY_BASE * 2^n (не больше RETRY_CAP).
+    Бюджет: каждый первый запрос добавляет RETRY_BUDGET_RATIO ретрая, каждый
+    ретрай тратит один - деградировавший регион не может бесконечно ретраить.
+    Автоматы (CircuitBreaker) - отдельно на каждый эндпоинт.
+    """
+
+    def __init__(self, city: str):
+        self.city = city
+        self.budget = float(RETRY_BUDGET_MIN)
+        self.breakers = {}  # endpoint -> CircuitBreaker
+
+    def breaker(self, endpoint: str) -> CircuitBreaker:
+        breaker = self.breakers.get(endpoint)
+        if breaker is None:
+            breaker = self.breakers[endpoint] = CircuitBreaker()
+        return breaker
+
+    def is_open(self, endpoint: str) -> bool:
+        return self.breaker(endpoint).is_open
+
+    async def before(self, endpoint: str, retry: int) -> bool:
+        """Перед запросом: retry - номер ретрая (0 - первый запрос).
+        False - запрос делать нельзя (автомат разомкнут или бюджет исчерпан)."""
+        if not self.breaker(endpoint).allow():
+            return False
+        if retry == 0:
+            self.budget = min(self.budget + RETRY_BUDGET_RATIO, RETRY_BUDGET_MIN * 10)
+            return True
+        if self.budget < 1:
+            log_error(f"[{self.city}] Retry budget exhausted ({endpoint})")
+            return False
+        self.budget -= 1
+        await asyncio.sleep(random.uniform(0, min(RETRY_CAP, RETRY_BASE * 2 ** retry)))
+        return True
+
+    def success(self, endpoint: str):
+        self.breaker(endpoint).success()
+
+    def failure(self, endpoint: str):
+        breaker = self.breaker(endpoint)
+        if not breaker.failure():
+            return
+        if breaker.given_up:
+            print(f"[{self.city}] {endpoint}: не восстановился после {BREAKER_MAX_OPENS} пауз, запросы прекращены")
+            log_error(f"[{self.city}] Circuit for {endpoint} given up after {BREAKER_MAX_OPENS} cooldowns")
+        else:
+            print(f"[{self.city}] {endpoint}: {breaker.failures} ошибок подряд, пауза {breaker.cooldown:.0f} с")
+            log_error(f"[{self.city}] Circuit open for {endpoint}: {breaker.failures} failures, "
+                      f"cooldown {breaker.cooldown:.0f}s")
+
+    async def wait_ready(self, endpoint: str):
+        """Ждёт, пока автомат эндпоинта не пропустит запросы"""
+        breaker = self.breaker(endpoint)
+        while breaker.is_open:
+            await asyncio.sleep(max(0.5, breaker.open_until - time.monotonic()))
+
+
+retry_policies = {}
+
+
+def retry_policy(city: str) -> RetryPolicy:
+    policy = retry_policies.get(city)
+    if policy is None:
+        policy = retry_policies[city] = RetryPolicy(city)
+    return policy
+
+
+class SessionPool:
+    """Долгоживущие AsyncSession по прокси.
+
+    Сессия держит пул соединений curl, поэтому TCP/TLS рукопожатие с хостом
+    делается один раз на выход, а не в каждой фазе каждого региона. Общей
+    банки кук у сессии нет (discard_cookies): куки из ответов не копятся в ней,
+    каждый запрос несёт только явно переданные куки своего региона - иначе
+    куки проверки прокси и других регионов уходили бы в API чужого филиала.
+    Счётчики: сколько раз сессия взята из пула, сколько запросов открыли
+    новое соединение и сколько ответов пришло по HTTP/2.
+    """
+
+    def __init__(self):
+        self.sessions = {}  # proxy -> AsyncSession
+        self.hits = 0
+        self.misses = 0
+        self.requests = 0
+        self.connects = 0
+        self.http2 = 0
+
+    @contextlib.asynccontextmanager
+    async def session(self, proxy: Optional[str]):
+        """Сессия для прокси из пула; по выходе из блока не закрывается"""
+        session = self.sessions.get(proxy)
+        if session is None:
+            self.misses += 1
+            session = self.sessions[proxy] = AsyncSession(
+                impersonate=IMPERSONATE, proxy=proxy, timeout=20, max_clients=SESSION_MAX_CLIENTS,
+                http_version=SESSION_HTTP_VERSION, curl_infos=[CurlInfo.NUM_CONNECTS], discard_cookies=True)
+        else:
+            self.hits += 1
+        yield session
+
+    def observe(self, response):
+        infos = getattr(response, "infos", None)
+        if infos is None:
+            return  # Ответ не из curl (воспроизведение)
+        self.requests += 1
+        self.connects += infos.get(CurlInfo.NUM_CONNECTS, 0)
+        if response.http_version >= 3:  # CURL_HTTP_VERSION_2_0 и выше
+            self.http2 += 1
+
+    def snapshot(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "sessions": len(self.sessions),
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0,
+            "requests": self.requests,
+            "new_connections": self.connects,
+            "connection_reuse": round(1 - self.connects / self.requests, 3) if self.requests else 0,
+            "http2": round(self.http2 / self.requests, 3) if self.requests else 0,
+        }
+
+    def report(self):
+        stats = self.snapshot()
+        line = f"Сессии: {stats['sessions']}, из пула: {stats['hit_rate']:.0%}"
+        if self.requests:
+            line += (f", новых соединений: {self.connects} на {self.requests} запросов "
+                     f"(переиспользовано {stats['connection_reuse']:.0%}), HTTP/2: {stats['http2']:.0%}")
+        print(line)
+        log_info(f"Session pool: {stats}")
+
+    async def close(self):
+        for session in self.sessions.values():
+            await session.close()
+        self.sessions.clear()
+
+
+session_pool = SessionPool()
+
+
+class RunBudget:
+    """Ограничение запуска: срок (секунд от старта) и/или число запросов.
+
+    Когда бюджет исчерпан, воркеры не берут новые юниты и новые регионы не
+    начинаются; невыполненное остаётся в журнале для --resume.
+    """
+
+    def __init__(self, seconds: float = None, max_requests: int = None):
+        self.deadline = time.monotonic() + seconds if seconds else None
+        self.max_requests = max_requests
+        self.requests = 0
+
+    def exhausted(self) -> bool:
+        if self.max_requests and self.requests >= self.max_requests:
+            return True
+        return self.deadline is not None and time.monotonic() >= self.deadline
+
+    def reason(self) -> str:
+        if self.max_requests and self.requests >= self.max_requests:
+            return f"{self.requests} запросов"
+        return "срок вышел"
+
+
+run_budget = RunBudget()
+
+
+class YieldHistory:
+    """Отдача пар (филиал, маска) по прошлым запускам: новых номеров на запрос.
+
+    После запуска оценка сглаживается с прошлой (YIELD_DECAY), так что пара,
+    переставшая давать номера, постепенно уходит в конец. Пара без истории
+    получает лучшую известную оценку, чтобы её отдача тоже стала известна.
+    """
+
+    def __init__(self, filename: str):
+        self.filename = filename
+        self.data = None  # "branch|mask" -> {"rate", "runs", "ts"}
+        self.unknown = 1.0
+        self.requests = {}  # (branch_id, mask) -> запросов в этом запуске
+        self.new = {}  # (branch_id, mask) -> новых номеров в этом запуске
+
+    def load(self):
+        if self.data is None:
+            self.data = load_json_cache(self.filename)
+            if self.data:
+                self.unknown = max(entry["rate"] for entry in self.data.values())
+
+    def score(self, branch_id: str, mask: str) -> float:
+        self.load()
+        entry = self.data.get(f"{branch_id}|{mask}")
+        return entry["rate"] if entry else self.unknown
+
+    def order_regions(self, regions: List[str], masks: List[str]) -> List[str]:
+        """Регионы по убыванию ожидаемой отдачи по всем маскам"""
+        return sorted(regions, key=lambda city: -sum(self.score(REGIONS[city], mask) for mask in masks))
+
+    def request(self, branch_id: str, mask: str):
+        key = (branch_id, mask)
+        self.requests[key] = self.requests.get(key, 0) + 1
+
+    def found(self, branch_id: str, mask: str):
+        key = (branch_id, mask)
+        self.new[key] = self.new.get(key, 0) + 1
+
+    def save(self):
+        if not self.requests:
+            return
+        # Перечитываем файл: процессы --processes дописывают свои пары
+        data = load_json_cache(self.filename)
+        for (branch_id, mask), requests in self.requests.items():
+            key = f"{branch_id}|{mask}"
+            rate = self.new.get((branch_id, mask), 0) / requests
+            old = data.get(key)
+            if old:
+                rate = YIELD_DECAY * old["rate"] + (1 - YIELD_DECAY) * rate
+            data[key] = {"rate": round(rate, 4), "runs": old["runs"] + 1 if old else 1, "ts": int(time.time())}
+        save_json_cache(self.filename, data)
+        log_info(f"Yield history saved: {len(self.requests)} pairs")
+
+
+yield_history = YieldHistory(YIELD_HISTORY_FILE)
+
+
+class WorkQueue:
+    """Общая очередь единиц работы региона: (mask, class_type, offset).
+
+    Свободные воркеры забирают юниты по одному, поэтому тяжёлая маска
+    с длинной пагинацией не держит остальных воркеров без дела.
+    Юниты выдаются по убыванию priority(unit), при равенстве - по порядку.
+    """
+
+    def __init__(self, max_retries: int = MAX_UNIT_RETRIES, priority=None):
+        self.units = []  # Куча (-приоритет, порядок, юнит)
+        self.priority = priority
+        self.order = 0
+        self.front = 0  # Порядок для юнитов, возвращённых в начало
+        self.pending = 0  # Юнитов в очереди и в работе
+        self.retries = {}
+        self.max_retries = max_retries
+        self.lost = []
+        self.changed = asyncio.Event()
+
+    def push(self, unit: tuple, order: int):
+        rank = -self.priority(unit) if self.priority else 0
+        heapq.heappush(self.units, (rank, order, unit))
+        self.changed.set()
+
+    def put(self, unit: tuple):
+        self.pending += 1
+        self.order += 1
+        self.push(unit, self.order)
+
+    def done(self, unit: tuple):
+        self.pending -= 1
+        self.changed.set()
+
+    def requeue(self, unit: tuple) -> bool:
+        """Возвращает юнит в очередь; False если попытки исчерпаны"""
+        self.retries[unit] = self.retries.get(unit, 0) + 1
+        if self.retries[unit] > self.max_retries:
+            self.lost.append(unit)
+            self.done(unit)
+            return False
+        self.order += 1
+        self.push(unit, self.order)
+        return True
+
+    def putback(self, unit: tuple):
+        """Возвращает юнит в начало очереди без учёта попытки (регион на паузе)"""
+        self.front -= 1
+        self.push(unit, self.front)
+
+    def remaining(self) -> list:
+        return [entry[-1] for entry in sorted(self.units)]
+
+    def idle(self) -> bool:
+        """Работы сейчас нет, но она ещё будет (PollQueue); пустая очередь региона - это конец работы"""
+        return False
+
+    async def get(self) -> Optional[tuple]:
+        """Следующий юнит или None, когда вся работа сделана (или бюджет запуска исчерпан)"""
+        while True:
+            if run_budget.exhausted():
+                return None
+            if self.units:
+                return heapq.heappop(self.units)[-1]
+            if self.pending == 0:
+                return None
+            # Очередь пуста, но юниты ещё в работе - они могут породить новые
+            self.changed.clear()
+            await self.changed.wait()
+
+
+class PollQueue(WorkQueue):
+    """Очередь пары --watch: живёт между опросами, её воркеры не завершаются на пустой очереди.
+
+    Опрос - start(unit), конец опроса - событие finished; close() отпускает воркеров.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.closed = False
+        self.finished = asyncio.Event()
+        self.finished.set()
+
+    def start(self, unit: tuple):
+        """Новый опрос: прошлые юниты, попытки и потери сбрасываются"""
+        self.units, self.pending, self.retries, self.lost = [], 0, {}, []
+        self.finished.clear()
+        self.put(unit)
+
+    def done(self, unit: tuple):
+        super().done(unit)
+        if self.pending == 0:
+            self.finished.set()
+
+    def idle(self) -> bool:
+        return not self.units and self.pending == 0 and not self.closed
+
+    async def wait_work(self):
+        """Ждёт юнитов следующего опроса или закрытия очереди"""
+        while self.idle():
+            self.changed.clear()
+            await self.changed.wait()
+
+    async def get(self) -> Optional[tuple]:
+        """Следующий юнит; None - только когда очередь закрыта или исчерпан бюджет запуска"""
+        while True:
+            if self.closed or run_budget.exhausted():
+                return None
+            if self.units:
+                return heapq.heappop(self.units)[-1]
+            self.changed.clear()
+            await self.changed.wait()
+
+    def close(self):
+        self.closed = True
+        self.finished.set()
+        self.changed.set()
+
+
+class NumberSet:
+    """Множество номеров для отсева дублей - битмапы по префиксам.
+
+    Номер 7XXXXXXXXXX делится на префикс (первые 3 цифры после 7) и хвост
+    из 7 цифр. Пока номеров с префиксом мало, они лежат в обычном set;
+    после SPARSE_LIMIT префикс переводится в bytearray на 10^7 бит (1.25 МБ).
+    На плотных префиксах это ~1 бит на возможный номер вместо ~100 байт на
+    строку в set, а обход сразу идёт по возрастанию. Номера вне диапазона
+    хранятся в отдельном set.
+    """
+
+    BASE = 7_000_000_0000
+    TAIL = 10 ** 7
+    SPARSE_LIMIT = 20_000  # При таком размере set уже занимает больше битмапа
+
+    def __init__(self):
+        self.bitmaps = {}  # prefix -> bytearray
+        self.sparse = {}  # prefix -> set хвостов
+        self.other = set()
+        self.size = 0
+
+    def _locate(self, msisdn: int):
+        offset = msisdn - self.BASE
+        if 0 <= offset < 1000 * self.TAIL:
+            return divmod(offset, self.TAIL)
+        return None, None
+
+    def __contains__(self, msisdn: int) -> bool:
+        prefix, tail = self._locate(msisdn)
+        if prefix is None:
+            return msisdn in self.other
+        bitmap = self.bitmaps.get(prefix)
+        if bitmap is None:
+            return tail in self.sparse.get(prefix, ())
+        return bool(bitmap[tail >> 3] & (1 << (tail & 7)))
+
+    def add(self, msisdn: int) -> bool:
+        """Добавляет номер, True если его ещё не было"""
+        prefix, tail = self._locate(msisdn)
+        if prefix is None:
+            if msisdn in self.other:
+                return False
+            self.other.add(msisdn)
+            self.size += 1
+            return True
+        bitmap = self.bitmaps.get(prefix)
+        if bitmap is None:
+            tails = self.sparse.setdefault(prefix, set())
+            if tail in tails:
+                return False
+            tails.add(tail)
+            self.size += 1
+            if len(tails) >= self.SPARSE_LIMIT:
+                self._densify(prefix)
+            return True
+        bit = 1 << (tail & 7)
+        if bitmap[tail >> 3] & bit:
+            return False
+        bitmap[tail >> 3] |= bit
+        self.size += 1
+        return True
+
+    def _densify(self, prefix: int):
+        """Переводит префикс из set в битмап"""
+        bitmap = self.bitmaps[prefix] = bytearray(self.TAIL // 8)
+        for tail in self.sparse.pop(prefix):
+            bitmap[tail >> 3] |= 1 << (tail & 7)
+
+    def add_many(self, numbers) -> int:
+        """Добавляет пачку номеров, возвращает сколько из них новых"""
+        add = self.add
+        return sum(1 for msisdn in numbers if add(msisdn))
+
+    def count_new(self, numbers) -> int:
+        """Сколько номеров из пачки ещё нет в множестве (без добавления)"""
+        return len({msisdn for msisdn in numbers if msisdn not in self})
+
+    def __len__(self) -> int:
+        return self.size
+
+    def __bool__(self) -> bool:
+        return self.size > 0
+
+    def __iter__(self):
+        """Номера по возрастанию"""
+        yield from sorted(n for n in self.other if n < self.BASE)
+        for prefix in sorted(self.bitmaps.keys() | self.sparse.keys()):
+            base = self.BASE + prefix * self.TAIL
+            bitmap = self.bitmaps.get(prefix)
+            if bitmap is None:
+                for tail in sorted(self.sparse[prefix]):
+                    yield base + tail
+                continue
+            # Пропускаем нулевые байты на стороне C
+            for match in re.finditer(rb'[^\x00]', bitmap):
+                byte_index = match.start()
+                value = match.group()[0]
+                for bit in range(8):
+                    if value & (1 << bit):
+                        yield base + byte_index * 8 + bit
+        yield from sorted(n for n in self.other if n >= self.BASE)
+
+
+all_numbers = NumberSet()
+
+
+class Interner:
+    """Таблица малых ID для повторяющихся значений (регион, филиал, маска, класс, секция)"""
+
+    def __init__(self):
+        self.ids = {}
+        self.values = []
+
+    def id(self, value) -> int:
+        value_id = self.ids.get(value)
+        if value_id is None:
+            value_id = self.ids[value] = len(self.values)
+            self.values.append(value)
+        return value_id
+
+    def value(self, value_id: int):
+        return self.values[value_id]
+
+
+region_ids = Interner()
+branch_ids = Interner()
+mask_ids = Interner()
+class_ids = Interner()
+section_ids = Interner()
+
+
+class NumberRecord:
+    """Найденный номер: msisdn как int и откуда он получен (ID из таблиц Interner)"""
+
+    __slots__ = ("msisdn", "region_id", "branch_id", "mask_id", "class_id", "section_id")
+
+    def __init__(self, msisdn: int, region_id: int, branch_id: int, mask_id: int, class_id: int, section_id: int):
+        self.msisdn = msisdn
+        self.region_id = region_id
+        self.branch_id = branch_id
+        self.mask_id = mask_id
+        self.class_id = class_id
+        self.section_id = section_id
+
+    @property
+    def number(self) -> str:
+        return str(self.msisdn)
+
+    @property
+    def region(self) -> str:
+        return region_ids.value(self.region_id)
+
+    @property
+    def branch(self) -> str:
+        return branch_ids.value(self.branch_id)
+
+    @property
+    def mask(self) -> str:
+        return mask_ids.value(self.mask_id)
+
+    @property
+    def class_type(self):
+        return class_ids.value(self.class_id)
+
+    @property
+    def section(self) -> str:
+        return section_ids.value(self.section_id)
+
+    def to_dict(self) -> dict:
+        data = {"number": self.number, "region": self.region, "branch": self.branch,
+                "mask": self.mask, "class": self.class_type, "section": self.section}
+        aliases = branch_aliases.get(self.branch)
+        if aliases:
+            data["aliases"] = aliases
+        return data
+
+    def __repr__(self):
+        return f"NumberRecord({self.to_dict()})"
+
+
+class Checkpoint:
+    """Журнал выполненных юнитов (branch_id, mask, class_type, offset) для --resume.
+
+    Append-only JSONL: первая строка - параметры запуска, дальше по строке на
+    выполненный юнит вместе с юнитами дозагрузки, которые он породил.
+    Записи попадают на диск только после fsync файла с номерами.
+    """
+
+    def __init__(self, filename: str, header: dict, completed: set = None, produced: dict = None):
+        self.filename = filename
+        self.header = header
+        self.completed = completed or set()  # {(branch_id, mask, class_type, offset)}
+        self.produced = produced or {}  # branch_id -> {(mask, class_type, offset)}
+        self.buffer = []
+        self.file = None
+
+    @classmethod
+    def start(cls, filename: str, header: dict) -> "Checkpoint":
+        """Новый журнал (старый перезаписывается)"""
+        checkpoint = cls(filename, header)
+        checkpoint.file = open(filename, 'w', encoding='utf-8')
+        checkpoint.file.write(json.dumps({"run": header}, ensure_ascii=False) + "\n")
+        checkpoint.sync()
+        return checkpoint
+
+    @classmethod
+    def load(cls, filename: str) -> Optional["Checkpoint"]:
+        """Загружает журнал для продолжения; None если его нет"""
+        header = None
+        completed = set()
+        produced = {}
+        line = ""
+        try:
+            with open(filename, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue  # Недописанная строка при падении
+                    if "run" in entry:
+                        header = entry["run"]
+                        continue
+                    branch_id = entry["b"]
+                    completed.add((branch_id, entry["m"], entry["c"], entry["o"]))
+                    for class_type, offset in entry.get("next", []):
+                        produced.setdefault(branch_id, set()).add((entry["m"], class_type, offset))
+        except OSError:
+            return None
+        if header is None:
+            return None
+        checkpoint = cls(filename, header, completed, produced)
+        checkpoint.file = open(filename, 'a', encoding='utf-8')
+        if not line.endswith("\n"):
+            # Недописанная строка не должна склеиться с первой записью продолжения
+            checkpoint.file.write("\n")
+        return checkpoint
+
+    def pending_units(self, branch_id: str, masks: List[str]) -> list:
+        """Невыполненные юниты филиала: первые запросы масок и начатые дозагрузки"""
+        units = [(mask, None, 0) for mask in masks]
+        units += sorted(self.produced.get(branch_id, ()), key=lambda u: (u[0], u[1], u[2]))
+        return [u for u in units if (branch_id, *u) not in self.completed]
+
+    def add(self, branch_id: str, unit: tuple, next_units: list):
+        mask, class_type, offset = unit
+        self.buffer.append(json.dumps({
+            "b": branch_id, "m": mask, "c": class_type, "o": offset,
+            "next": [[u[1], u[2]] for u in next_units],
+        }, ensure_ascii=False) + "\n")
+
+    def sync(self):
+        if self.buffer:
+            self.file.write("".join(self.buffer))
+            self.buffer = []
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self):
+        self.sync()
+        self.file.close()
+
+
+class ResultStore:
+    """SQLite-база результатов: история запусков и где/когда виден каждый номер.
+
+    numbers - по строке на (номер, регион) с филиалом, маской, классом и первым/последним
+    запуском; sightings - какие номера видел каждый запуск в каждом регионе (для diff).
+    Вставки идут из стадии записи, коммит - вместе с fsync файла результата.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS runs (
+            id INTEGER PRIMARY KEY,
+            started TEXT NOT NULL,
+            finished TEXT,
+            output TEXT
+        );
+        CREATE TABLE IF NOT EXISTS run_regions (
+            run_id INTEGER NOT NULL,
+            region TEXT NOT NULL,
+            PRIMARY KEY (run_id, region)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS numbers (
+            number INTEGER NOT NULL,
+            region TEXT NOT NULL,
+            branch TEXT,
+            mask TEXT,
+            class TEXT,
+            section TEXT,
+            first_run INTEGER NOT NULL,
+            last_run INTEGER NOT NULL,
+            first_seen TEXT NOT NULL,
+            last_seen TEXT NOT NULL,
+            PRIMARY KEY (number, region)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS numbers_region_seen ON numbers (region, last_seen);
+        CREATE INDEX IF NOT EXISTS numbers_first_seen ON numbers (first_seen);
+        CREATE INDEX IF NOT EXISTS numbers_last_seen ON numbers (last_seen);
+        CREATE TABLE IF NOT EXISTS sightings (
+            run_id INTEGER NOT NULL,
+            region TEXT NOT NULL,
+            number INTEGER NOT NULL,
+            PRIMARY KEY (run_id, region, number)
+        ) WITHOUT ROWID;
+    """
+
+    def __init__(self, filename: str):
+        self.filename = filename
+        # Коммит идёт из asyncio.to_thread, но всегда после записи - параллельного доступа нет
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(self.SCHEMA)
+        self.run_id = None
+        self.now = None
+
+    def start_run(self, output: str, regions: List[str]) -> int:
+        now = datetime.now().isoformat(timespec="seconds")
+        cursor = self.db.execute("INSERT INTO runs (started, output) VALUES (?, ?)", (now, output))
+        self.run_id = cursor.lastrowid
+        self.db.executemany("INSERT OR IGNORE INTO run_regions VALUES (?, ?)",
+                            [(self.run_id, city) for city in regions])
+        self.db.commit()
+        return self.run_id
+
+    def resume_run(self, run_id: int):
+        """Продолжение прерванного запуска (--resume) - номера дописываются в тот же run"""
+        if self.db.execute("SELECT 1 FROM runs WHERE id = ?", (run_id,)).fetchone() is None:
+            raise ValueError(f"запуск {run_id} не найден в {self.filename}")
+        self.run_id = run_id
+        self.db.execute("UPDATE runs SET finished = NULL WHERE id = ?", (run_id,))
+        self.db.commit()
+
+    def add(self, records: list):
+        """Все записи пачки (дубли между регионами тоже - у каждого региона своя история).
+        Номер основного региона филиала записывается и всем его псевдонимам."""
+        if not records:
+            return
+        now = datetime.now().isoformat(timespec="seconds")
+        run_id = self.run_id
+        rows = [(r, city) for r in records for city in (r.region, *branch_aliases.get(r.branch, ()))]
+        self.db.executemany("INSERT OR IGNORE INTO sightings VALUES (?, ?, ?)",
+                            [(run_id, city, r.msisdn) for r, city in rows])
+        self.db.executemany(
+            "INSERT INTO numbers VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT (number, region) DO UPDATE SET branch = excluded.branch, mask = excluded.mask, "
+            "class = excluded.class, section = excluded.section, "
+            "last_run = excluded.last_run, last_seen = excluded.last_seen",
+            [(r.msisdn, city, r.branch, r.mask, None if r.class_type is None else str(r.class_type),
+              r.section, run_id, run_id, now, now) for r, city in rows])
+
+    def commit(self):
+        self.db.commit()
+
+    def close(self):
+        self.db.execute("UPDATE runs SET finished = ? WHERE id = ?",
+                        (datetime.now().isoformat(timespec="seconds"), self.run_id))
+        self.db.commit()
+        self.db.close()
+
+    def runs(self) -> list:
+        """[(id, started, finished, output, регионов, номеров)]"""
+        return self.db.execute(
+            "SELECT r.id, r.started, r.finished, r.output, "
+            "(SELECT COUNT(*) FROM run_regions WHERE run_id = r.id), "
+            "(SELECT COUNT(*) FROM sightings WHERE run_id = r.id) "
+            "FROM runs r ORDER BY r.id").fetchall()
+
+    def resolve_run(self, run: str) -> int:
+        """ID запуска: число, 'last' или 'prev'"""
+        if run in ("last", "prev"):
+            rows = self.db.execute("SELECT id FROM runs ORDER BY id DESC LIMIT 2").fetchall()
+            index = 0 if run == "last" else 1
+            if len(rows) <= index:
+                raise ValueError(f"в {self.filename} нет запуска '{run}'")
+            return rows[index][0]
+        return int(run)
+
+    def diff(self, old_run: int, new_run: int, region: str = None):
+        """Номера, появившиеся (+) и пропавшие (-) между запусками: (знак, регион, номер).
+
+        Сравниваются только регионы, которые обходили оба запуска. Строки идут
+        курсором по первичному ключу sightings, в память целиком не грузятся.
+        """
+        regions = ("SELECT region FROM run_regions WHERE run_id = ? "
+                   "INTERSECT SELECT region FROM run_regions WHERE run_id = ?")
+        params = [old_run, new_run]
+        if region:
+            regions = f"SELECT region FROM ({regions}) WHERE region = ?"
+            params.append(region)
+        query = (f"SELECT s.region, s.number FROM sightings s WHERE s.run_id = ? AND s.region IN ({regions}) "
+                 "AND NOT EXISTS (SELECT 1 FROM sightings o WHERE o.run_id = ? "
+                 "AND o.region = s.region AND o.number = s.number) ORDER BY s.region, s.number")
+        for sign, run, other in (("+", new_run, old_run), ("-", old_run, new_run)):
+            for city, number in self.db.execute(query, (run, *params, other)):
+                yield sign, city, number
+
+
+class ResultWriter:
+    """Стадия записи: принимает пачки записей от воркеров через ограниченную очередь,
+    убирает дубли и дописывает новые номера в файл, делая fsync пачками.
+
+    Записи - NumberRecord. Вместе с пачкой
+    воркер передаёт выполненный юнит - он попадает в журнал checkpoint после fsync номеров.
+    Если задан store (SQLite), записи дублируются в базу с коммитом на том же fsync.
+    """
+
+    def __init__(self, filename: str, fmt: str = OUTPUT_FORMAT, compress: bool = OUTPUT_GZIP,
+                 queue_size: int = RESULT_QUEUE_SIZE, checkpoint: Checkpoint = None, mask_plan: "MaskPlan" = None,
+                 store: ResultStore = None):
+        self.filename = filename
+        self.store = store
+        self.checkpoint = checkpoint
+        self.mask_plan = mask_plan
+        self.fmt = fmt
+        self.compress = compress
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.count = 0  # Уникальных номеров записано
+        self.region_new = {}  # city -> уникальных номеров
+        self.unsynced = 0
+        self.last_sync = time.monotonic()
+        self.task = None
+        if compress:
+            self.file = gzip.open(filename, 'at', encoding='utf-8')
+        else:
+            self.file = open(filename, 'a', encoding='utf-8')
+
+    def start(self):
+        self.task = asyncio.create_task(self.run())
+
+    async def put(self, records: list, done: tuple = None):
+        """Пачка записей и (необязательно) выполненный юнит: (branch_id, unit, next_units)"""
+        await self.queue.put((records, done))
+
+    async def flush(self):
+        """Ждёт, пока всё из очереди будет записано"""
+        await self.queue.join()
+
+    async def run(self):
+        while True:
+            item = await self.queue.get()
+            try:
+                if item is None:
+                    return
+                self.write(*item)
+                if self.unsynced >= FSYNC_EVERY or time.monotonic() - self.last_sync >= FSYNC_INTERVAL:
+                    await asyncio.to_thread(self.sync)
+            finally:
+                self.queue.task_done()
+
+    def write(self, records: list, done: tuple = None):
+        if done and self.checkpoint:
+            self.checkpoint.add(*done)
+        # Маска уточняется до записи в базу, чтобы база и файл совпадали;
+        # отдача же засчитывается запрошенной маске, а не выведенной из неё
+        queried = [record.mask_id for record in records]
+        if self.mask_plan:
+            for record in records:
+                self.mask_plan.refine(record)
+        if self.store:
+            self.store.add(records)
+        lines = []
+        for record, mask_id in zip(records, queried):
+            if not all_numbers.add(record.msisdn):
+                continue
+            yield_history.found(record.branch, mask_ids.value(mask_id))
+            if record.mask_id != mask_id:
+                self.mask_plan.hits[record.mask] += 1
+            city = record.region
+            self.region_new[city] = self.region_new.get(city, 0) + 1
+            if self.fmt == "ndjson":
+                lines.append(json.dumps(record.to_dict(), ensure_ascii=False) + "\n")
+            else:
+                lines.append(f"{record.msisdn}\n")
+        if lines:
+            self.file.write("".join(lines))
+            self.count += len(lines)
+            self.unsynced += len(lines)
+
+    def sync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        if self.store:
+            self.store.commit()
+        # Журнал - только после того как номера на диске
+        if self.checkpoint:
+            self.checkpoint.sync()
+        self.unsynced = 0
+        self.last_sync = time.monotonic()
+
+    async def close(self):
+        """Дописывает остаток очереди и закрывает файл"""
+        if self.task and not self.task.done():
+            await self.queue.put(None)
+            await self.task
+        # Стадия записи уже остановлена (например, отменена по Ctrl+C) - дописываем сами
+        while not self.queue.empty():
+            item = self.queue.get_nowait()
+            if item:
+                self.write(*item)
+        self.sync()
+        self.file.close()
+        if self.store:
+            self.store.close()
+        if self.checkpoint:
+            self.checkpoint.close()
+
+
+class Metrics:
+    """Счётчики и гистограммы задержек запросов по эндпоинтам.
+
+    Разбивка: эндпоинт, регион, статус (или 'error') и номер попытки.
+    Периодически пишется JSON-снимок, по желанию - HTTP в формате Prometheus.
+    """
+
+    BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)  # Секунд
+
+    def __init__(self):
+        self.started = time.time()
+        self.requests = {}  # (endpoint, region, status, retry) -> count
+        self.latency = {}  # (endpoint, region) -> [корзины..., +Inf, sum, count]
+        self.queues = {}  # region -> WorkQueue
+        self.writer = None
+        self.last_numbers = 0
+        self.last_time = time.time()
+        self.numbers_per_sec = 0.0
+
+    def observe(self, endpoint: str, region: str, status, seconds: float, retry: int = 0):
+        key = (endpoint, region, str(status), retry)
+        self.requests[key] = self.requests.get(key, 0) + 1
+        hist = self.latency.get((endpoint, region))
+        if hist is None:
+            hist = self.latency[(endpoint, region)] = [0] * (len(self.BUCKETS) + 3)
+        hist[bisect.bisect_left(self.BUCKETS, seconds)] += 1
+        hist[-2] += seconds
+        hist[-1] += 1
+
+    def update_rate(self):
+        now = time.time()
+        numbers = len(all_numbers)
+        if now > self.last_time:
+            self.numbers_per_sec = (numbers - self.last_numbers) / (now - self.last_time)
+        self.last_numbers, self.last_time = numbers, now
+
+    def quantile(self, hist: list, q: float) -> Optional[float]:
+        """Оценка квантиля по гистограмме (верхняя граница корзины), мс"""
+        count = hist[-1]
+        if not count:
+            return None
+        target = count * q
+        seen = 0
+        for i, bound in enumerate(self.BUCKETS):
+            seen += hist[i]
+            if seen >= target:
+                return bound * 1000
+        return None  # Больше последней корзины
+
+    def snapshot(self) -> dict:
+        elapsed = time.time() - self.started
+        latency = {}
+        for (endpoint, region), hist in sorted(self.latency.items()):
+            count = hist[-1]
+            latency.setdefault(endpoint, {})[region] = {
+                "count": count,
+                "avg_ms": round(hist[-2] / count * 1000, 1) if count else 0,
+                "p50_ms": self.quantile(hist, 0.5),
+                "p99_ms": self.quantile(hist, 0.99),
+            }
+        return {
+            "time": datetime.now().isoformat(timespec="seconds"),
+            "elapsed_sec": round(elapsed, 1),
+            "numbers": len(all_numbers),
+            "numbers_per_sec": round(self.numbers_per_sec, 2),
+            "numbers_per_sec_avg": round(len(all_numbers) / elapsed, 2) if elapsed else 0,
+            "queue_depth": {region: len(q.units) for region, q in self.queues.items()},
+            "in_flight": {region: q.pending - len(q.units) for region, q in self.queues.items()},
+            "writer_queue": self.writer.queue.qsize() if self.writer else 0,
+            "rates": {f"{host}/{branch}": round(c.rate, 2) for (host, branch), c in rate_controllers.items()},
+            "retry_budget": {city: round(p.budget, 1) for city, p in retry_policies.items()},
+            "session_pool": session_pool.snapshot(),
+            "breakers_open": sorted(f"{city}/{endpoint}" for city, p in retry_policies.items()
+                                    for endpoint, b in p.breakers.items() if b.is_open),
+            "requests": [
+                {"endpoint": e, "region": r, "status": s, "retry": a, "count": c}
+                for (e, r, s, a), c in sorted(self.requests.items())
+            ],
+            "latency": latency,
+        }
+
+    def prometheus(self) -> str:
+        lines = ["# TYPE megafon_requests_total counter"]
+        for (endpoint, region, status, retry), count in sorted(self.requests.items()):
+            lines.append(f'megafon_requests_total{{endpoint="{endpoint}",region="{region}",'
+                         f'status="{status}",retry="{retry}"}} {count}')
+        lines.append("# TYPE megafon_request_seconds histogram")
+        for (endpoint, region), hist in sorted(self.latency.items()):
+            labels = f'endpoint="{endpoint}",region="{region}"'
+            cumulative = 0
+            for i, bound in enumerate(self.BUCKETS):
+                cumulative += hist[i]
+                lines.append(f'megafon_request_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f'megafon_request_seconds_bucket{{{labels},le="+Inf"}} {hist[-1]}')
+            lines.append(f'megafon_request_seconds_sum{{{labels}}} {hist[-2]:.6f}')
+            lines.append(f'megafon_request_seconds_count{{{labels}}} {hist[-1]}')
+        lines.append("# TYPE megafon_queue_depth gauge")
+        for region, q in sorted(self.queues.items()):
+            lines.append(f'megafon_queue_depth{{region="{region}"}} {len(q.units)}')
+        lines.append("# TYPE megafon_rate gauge")
+        for (host, branch), controller in sorted(rate_controllers.items()):
+            lines.append(f'megafon_rate{{host="{host}",branch="{branch}"}} {controller.rate:.3f}')
+        pool = session_pool.snapshot()
+        lines.append("# TYPE megafon_session_pool_hit_rate gauge")
+        lines.append(f"megafon_session_pool_hit_rate {pool['hit_rate']}")
+        lines.append("# TYPE megafon_new_connections_total counter")
+        lines.append(f"megafon_new_connections_total {pool['new_connections']}")
+        lines.append("# TYPE megafon_connection_reuse gauge")
+        lines.append(f"megafon_connection_reuse {pool['connection_reuse']}")
+        lines.append("# TYPE megafon_writer_queue gauge")
+        lines.append(f"megafon_writer_queue {self.writer.queue.qsize() if self.writer else 0}")
+        lines.append("# TYPE megafon_numbers_total gauge")
+        lines.append(f"megafon_numbers_total {len(all_numbers)}")
+        lines.append("# TYPE megafon_numbers_per_second gauge")
+        lines.append(f"megafon_numbers_per_second {self.numbers_per_sec:.3f}")
+        return "\n".join(lines) + "\n"
+
+    def save(self, filename: str):
+        self.update_rate()
+        save_json_cache(filename, self.snapshot())
+
+    async def run_snapshots(self, filename: str, interval: float):
+        """Периодически пишет JSON-снимок"""
+        while True:
+            await asyncio.sleep(interval)
+            self.save(filename)
+
+    async def serve(self, port: int):
+        """Локальный HTTP-эндпоинт /metrics в формате Prometheus"""
+        async def handle(reader, writer):
+            try:
+                while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                    pass
+                body = self.prometheus().encode()
+                writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\n"
+                             b"Content-Length: " + str(len(body)).encode() + b"\r\nConnection: close\r\n\r\n" + body)
+                await writer.drain()
+            finally:
+                writer.close()
+
+        return await asyncio.start_server(handle, "127.0.0.1", port)
+
+
+metrics = Metrics()
+
+
+class Profiler:
+    """Профилировщик для --profile.
+
+    Фоновый поток раз в PROFILE_INTERVAL снимает стек потока event loop: в нём видны
+    кадры корутины, которая сейчас выполняется, поэтому время раскладывается по
+    PROFILE_TARGETS (включительно) и по функциям-листьям; ожидание в select - простой
+    (сеть). Отдельная корутина меряет задержку цикла.
+
+    tracemalloc включается только на PROFILE_MEMORY_WINDOW секунд раз в
+    PROFILE_MEMORY_INTERVAL: снимок в конце окна показывает, что из выделенного
+    за окно ещё живо. Сэмплы, попавшие в окна, не входят в разбивку CPU - там
+    измерялся бы сам tracemalloc; их загрузка показывается отдельно.
+    """
+
+    def __init__(self):
+        self.loop_thread = threading.get_ident()
+        self.stopped = threading.Event()
+        self.thread = None
+        self.lag_task = None
+        self.started = None
+        self.samples = 0
+        self.idle = 0
+        self.traced_samples = 0  # Сэмплы в окнах tracemalloc
+        self.traced_idle = 0
+        self.traced_time = 0.0  # Секунд с включённым tracemalloc
+        self.window_started = None
+        self.sampler_cpu = 0.0  # CPU самого потока профилировщика
+        self.peak = 0  # Пик tracemalloc по окнам, байт
+        self.targets = {}  # функция -> сэмплов (включительно)
+        self.leaves = {}  # функция (файл) -> сэмплов
+        self.lags = []
+        self.memory = []  # [(секунд с начала, МБ выделено за окно и живо)]
+        self.snapshot = None
+        self.ranges = self.target_ranges()
+
+    @staticmethod
+    def target_ranges() -> list:
+        """[(первая строка, последняя строка, имя)] целевых функций в этом файле"""
+        ranges = []
+        for name in PROFILE_TARGETS:
+            obj = globals().get(name.split(".")[0])
+            for attr in name.split(".")[1:]:
+                obj = getattr(obj, attr, None)
+            try:
+                lines, first = inspect.getsourcelines(obj)
+            except (TypeError, OSError):
+                continue
+            ranges.append((first, first + len(lines) - 1, name))
+        return ranges
+
+    def start(self):
+        self.started = time.perf_counter()
+        self.thread = threading.Thread(target=self.sample, name="profiler", daemon=True)
+        self.thread.start()
+        self.lag_task = asyncio.create_task(self.watch_lag())
+
+    def sample(self):
+        self.start_window()
+        window_end = time.monotonic() + PROFILE_MEMORY_WINDOW
+        while not self.stopped.wait(PROFILE_INTERVAL):
+            if window_end and time.monotonic() >= window_end:
+                self.end_window()
+                window_end = None
+                next_window = time.monotonic() + PROFILE_MEMORY_INTERVAL
+            elif not window_end and time.monotonic() >= next_window:
+                self.start_window()
+                window_end = time.monotonic() + PROFILE_MEMORY_WINDOW
+            frame = sys._current_frames().get(self.loop_thread)
+            if frame is None:
+                continue
+            idle = os.path.basename(frame.f_code.co_filename) == "selectors.py"
+            if window_end:
+                self.traced_samples += 1
+                self.traced_idle += idle
+                continue
+            self.samples += 1
+            leaf = frame.f_code
+            if idle:
+                self.idle += 1
+            else:
+                key = f"{getattr(leaf, 'co_qualname', leaf.co_name)} ({os.path.basename(leaf.co_filename)})"
+                self.leaves[key] = self.leaves.get(key, 0) + 1
+                seen = set()
+                while frame is not None:
+                    name = getattr(frame.f_code, "co_qualname", frame.f_code.co_name)
+                    if name in PROFILE_TARGETS and name not in seen:
+                        seen.add(name)
+                        self.targets[name] = self.targets.get(name, 0) + 1
+                    frame = frame.f_back
+        if window_end:
+            self.end_window()
+        self.sampler_cpu = time.thread_time()
+
+    def start_window(self):
+        self.window_started = time.perf_counter()
+        tracemalloc.start(PROFILE_MEMORY_FRAMES)
+
+    def end_window(self):
+        self.snapshot = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        now = time.perf_counter()
+        self.traced_time += now - self.window_started
+        self.peak = max(self.peak, peak)
+        self.memory.append((round(now - self.started, 1), round(current / 1024 / 1024, 2)))
+
+    async def watch_lag(self):
+        """Задержка event loop: насколько позже обещанного просыпается sleep"""
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(PROFILE_LAG_INTERVAL)
+            self.lags.append(time.perf_counter() - started - PROFILE_LAG_INTERVAL)
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        if self.lag_task:
+            self.lag_task.cancel()
+
+    def memory_by_target(self) -> dict:
+        """Живая память последнего снимка по самой внутренней целевой функции в стеке выделения"""
+        here = os.path.abspath(__file__)
+        result = {}
+        if self.snapshot is None:
+            return result
+        for stat in self.snapshot.statistics("traceback"):
+            owner = "(прочее)"
+            for frame in reversed(stat.traceback):
+                if os.path.abspath(frame.filename) != here:
+                    continue
+                owner = next((name for first, last, name in self.ranges if first <= frame.lineno <= last), None)
+                if owner:
+                    break
+                owner = "(прочее)"
+            result[owner] = result.get(owner, 0) + stat.size
+        return result
+
+    def report(self, filename: str):
+        elapsed = time.perf_counter() - self.started
+        busy = self.samples - self.idle
+        lags = sorted(self.lags)
+
+        def pct(count, total):
+            return f"{count / total:6.1%}" if total else "   -  "
+
+        lines = [
+            f"Профиль: {datetime.now().isoformat(timespec='seconds')}",
+            f"Время: {elapsed:.1f} с, сэмплов: {self.samples} (каждые {PROFILE_INTERVAL * 1000:g} мс)",
+            f"Event loop занят: {pct(busy, self.samples)}, ждёт сеть/таймеры: {pct(self.idle, self.samples)}",
+            f"Накладные расходы профилировщика: поток сэмплов {self.sampler_cpu:.2f} с CPU "
+            f"({pct(self.sampler_cpu, elapsed).strip()} времени), tracemalloc включён {self.traced_time:.1f} с "
+            f"({pct(self.traced_time, elapsed).strip()}), loop в эти окна занят "
+            f"{pct(self.traced_samples - self.traced_idle, self.traced_samples).strip()} - в разбивку ниже не входит",
+            "",
+            "Время CPU по функциям (включительно, доля занятого времени):",
+        ]
+        for name in PROFILE_TARGETS:
+            count = self.targets.get(name, 0)
+            lines.append(f"  {name:30} {count:8} {pct(count, busy)}")
+        lines += ["", "Самые горячие функции (лист стека):"]
+        for key, count in sorted(self.leaves.items(), key=lambda kv: -kv[1])[:25]:
+            lines.append(f"  {count:8} {pct(count, busy)}  {key}")
+        lines += ["", "Задержка event loop:"]
+        if lags:
+            lines.append(f"  замеров: {len(lags)}, p50: {lags[len(lags) // 2] * 1000:.1f} мс, "
+                         f"p99: {lags[min(len(lags) - 1, int(len(lags) * 0.99))] * 1000:.1f} мс, "
+                         f"макс: {lags[-1] * 1000:.1f} мс")
+        lines += ["", f"Память (tracemalloc, окна по {PROFILE_MEMORY_WINDOW:g} с): пик за окно "
+                      f"{self.peak / 1024 / 1024:.2f} МБ",
+                  "  выделено за окно и живо (с, МБ): " + ", ".join(f"{t:g}: {mb:g}" for t, mb in self.memory)]
+        lines.append("  живая память по функциям (последнее окно):")
+        for name, size in sorted(self.memory_by_target().items(), key=lambda kv: -kv[1]):
+            lines.append(f"    {name:30} {size / 1024:10.1f} КБ")
+        lines.append("  крупнейшие места выделения:")
+        for stat in (self.snapshot.statistics("lineno")[:15] if self.snapshot else ()):
+            frame = stat.traceback[0]
+            lines.append(f"    {stat.size / 1024:10.1f} КБ  {stat.count:8}  {frame.filename}:{frame.lineno}")
+
+        with open(filename, 'w', encoding='utf-8') as f:
+            f.write("\n".join(lines) + "\n")
+        print(f"Профиль сохранён в: {filename}")
+        log_info(f"Profile report saved to: {filename}")
+
+CACHE_FILES = ("bootstrap", "classes", "page_limit")
+
+
+def exchange_key(method: str, url: str, kwargs: dict) -> str:
+    """Ключ обмена для сопоставления при воспроизведении: метод, полный адрес и тело"""
+    if kwargs.get("params"):
+        url += ("&" if "?" in url else "?") + urllib.parse.urlencode(kwargs["params"])
+    if "?" in url:
+        path, query = url.split("?", 1)
+        params = [(k, v) for k, v in urllib.parse.parse_qsl(query, keep_blank_values=True)
+                  if k not in REPLAY_VOLATILE_PARAMS]
+        url = f"{path}?{urllib.parse.urlencode(params)}" if params else path
+    body = kwargs.get("json")
+    if body is None:
+        body = kwargs.get("data")
+    if isinstance(body, (dict, list)):
+        body = json.dumps(body, sort_keys=True, ensure_ascii=False)
+    return f"{method} {url} {body or ''}"
+
+
+class Recorder:
+    """Пишет полные обмены сессий в архив фикстур (gzip NDJSON).
+
+    Первая строка - заголовок: адреса магазина и API классов и кэши на момент
+    старта (чтобы при воспроизведении были те же попадания в кэш). Дальше по
+    строке на запрос: ключ, статус, куки ответа, текст и время ответа.
+    """
+
+    def __init__(self, filename: str):
+        self.filename = filename
+        self.count = 0
+        self.file = gzip.open(filename, 'wt', encoding='utf-8')
+        caches = {name: load_json_cache(globals()[f"{name.upper()}_CACHE_FILE"]) for name in CACHE_FILES}
+        header = {"shop_url": SHOP_URL, "classes_url": CLASSES_URL, "time": time.time(), "caches": caches}
+        self.file.write(json.dumps(header, ensure_ascii=False) + "\n")
+
+    def add(self, key: str, response, elapsed: float, error: Exception = None):
+        entry = {"key": key, "elapsed": round(elapsed, 4)}
+        if error is not None:
+            entry["error"] = str(error)
+        else:
+            entry["status"] = response.status_code
+            entry["cookies"] = [[c.name, c.value] for c in response.cookies.jar]
+            entry["text"] = response.text
+        self.file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        self.count += 1
+
+    def close(self):
+        self.file.close()
+        print(f"Записано обменов: {self.count} в {self.filename}")
+        log_info(f"Recorded {self.count} exchanges to {self.filename}")
+
+
+class RecordingSession(AsyncSession):
+    """AsyncSession, которая пишет каждый обмен в recorder"""
+
+    async def request(self, method, url, **kwargs):
+        key = exchange_key(method, url, kwargs)
+        started = time.monotonic()
+        try:
+            response = await super().request(method, url, **kwargs)
+        except Exception as e:
+            recorder.add(key, None, time.monotonic() - started, e)
+            raise
+        recorder.add(key, response, time.monotonic() - started)
+        return response
+
+
+class ReplayError(Exception):
+    """Записанная сетевая ошибка или запрос, которого нет в архиве"""
+
+
+class ReplayCookie:
+    def __init__(self, name: str, value: str):
+        self.name = name
+        self.value = value
+
+
+class ReplayJar:
+    def __init__(self, cookies: list):
+        self.jar = [ReplayCookie(name, value) for name, value in cookies]
+
+
+class ReplayResponse:
+    """Ответ из архива с тем же интерфейсом, что использует парсер"""
+
+    def __init__(self, entry: dict):
+        self.status_code = entry["status"]
+        self.text = entry["text"]
+        self.cookies = ReplayJar(entry["cookies"])
+
+    @property
+    def content(self) -> bytes:
+        return self.text.encode()
+
+    def json(self):
+        return json.loads(self.text)
+
+
+class Replay:
+    """Архив фикстур для воспроизведения без сети.
+
+    Ответы ищутся по ключу запроса и отдаются по порядку записи: ретраи
+    получают те же ошибки, что и при записи. Когда ответы ключа кончились,
+    повторяется последний. Время ответа - записанное, умноженное на scale.
+    """
+
+    def __init__(self, filename: str, scale: float = REPLAY_SCALE):
+        self.filename = filename
+        self.scale = scale
+        self.exchanges = {}
+        with gzip.open(filename, 'rt', encoding='utf-8') as f:
+            self.header = json.loads(f.readline())
+            for line in f:
+                entry = json.loads(line)
+                self.exchanges.setdefault(entry["key"], []).append(entry)
+        self.shop_url = self.header["shop_url"]
+        self.classes_url = self.header["classes_url"]
+        self.rewind()
+
+    def rewind(self):
+        """С начала архива; кэши - как на момент записи, с тем же возрастом записей"""
+        global bootstrap_cache, classes_cache, page_limit_cache
+        self.positions = {}
+        self.served = 0
+        self.misses = 0
+        shift = time.time() - self.header["time"]
+        caches = {}
+        for name in CACHE_FILES:
+            caches[name] = {key: dict(entry, ts=entry["ts"] + shift)
+                            for key, entry in self.header["caches"].get(name, {}).items()}
+        bootstrap_cache, classes_cache, page_limit_cache = caches["bootstrap"], caches["classes"], caches["page_limit"]
+
+    async def respond(self, method: str, url: str, kwargs: dict) -> ReplayResponse:
+        key = exchange_key(method, url, kwargs)
+        entries = self.exchanges.get(key)
+        if not entries:
+            self.misses += 1
+            log_error(f"Replay miss: {key[:200]}")
+            raise ReplayError(f"нет в архиве: {method} {url}")
+        position = self.positions.get(key, 0)
+        self.positions[key] = position + 1
+        entry = entries[min(position, len(entries) - 1)]
+        if self.scale:
+            await asyncio.sleep(entry["elapsed"] * self.scale)
+        self.served += 1
+        if "error" in entry:
+            raise ReplayError(entry["error"])
+        return ReplayResponse(entry)
+
+    def report(self):
+        print(f"Воспроизведено ответов: {self.served}, нет в архиве: {self.misses}")
+        log_info(f"Replayed {self.served} responses, {self.misses} misses")
+
+
+class ReplaySession:
+    """Замена AsyncSession: отвечает из replay, прокси и отпечаток браузера не нужны"""
+
+    def __init__(self, **kwargs):
+        pass
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+    async def close(self):
+        pass
+
+    async def get(self, url: str, **kwargs):
+        return await self.request("GET", url, **kwargs)
+
+    async def post(self, url: str, **kwargs):
+        return await self.request("POST", url, **kwargs)
+
+    async def request(self, method: str, url: str, **kwargs):
+        return await replay.respond(method, url, kwargs)
+
+
+async def send(endpoint: str, city: str, url: str, request, retry: int = 0):
+    """Выполняет запрос в темпе регулятора хоста/филиала и под семафором хоста.
+
+    Статус и время ответа уходят в регулятор и в metrics.
+    """
+    controller = rate_controller(url, city)
+    run_budget.requests += 1
+    try:
+        await controller.wait()
+    except BaseException:
+        request.close()  # Корутина запроса так и не запущена
+        raise
+    async with host_slot(url):
+        started = time.monotonic()
+        try:
+            response = await request
+        except Exception:
+            elapsed = time.monotonic() - started
+            controller.record(endpoint, None, elapsed)
+            metrics.observe(endpoint, city, "error", elapsed, retry)
+            raise
+    elapsed = time.monotonic() - started
+    controller.record(endpoint, response.status_code, elapsed)
+    metrics.observe(endpoint, city, response.status_code, elapsed, retry)
+    session_pool.observe(response)
+    return response
+
 
 async def solve_captcha(session: AsyncSession, captcha_html: str, city: str = "") -> Optional[str]:
     """Решает капчу через rucaptcha (без прокси)"""
@@ -104,10 +1821,10 @@ async def solve_captcha(session: AsyncSession, captcha_html: str, city: str = ""
         "numeric": "0",
     }
 
-    # Используем отдельную сессию без прокси для rucaptcha
+    # rucaptcha - через сессию без прокси
     try:
-        async with AsyncSession(timeout=30) as captcha_session:
-            response = await captcha_session.post(in_url, data=data)
+        async with session_pool.session(None) as captcha_session:
+            response = await captcha_session.post(in_url, data=data, timeout=30)
             result = response.json()
 
             if result.get("status") != 1:
@@ -122,7 +1839,7 @@ async def solve_captcha(session: AsyncSession, captcha_html: str, city: str = ""
 
             for i in range(20):
                 await asyncio.sleep(5)
-                response = await captcha_session.get(res_url, params=params)
+                response = await captcha_session.get(res_url, params=params, timeout=30)
                 result = response.json()
 
                 if result.get("status") == 1:
@@ -140,303 +1857,607 @@ async def solve_captcha(session: AsyncSession, captcha_html: str, city: str = ""
         return None
 
 
-def parse_numbers(result: dict) -> list:
-    numbers = []
+def decode_numbers(result: dict, city: str = "", mask: str = "") -> List[NumberRecord]:
+    """Единый разбор ответа msisdn API в компактные записи"""
+    records = []
+    region_id = region_ids.id(city)
+    branch_id = branch_ids.id(REGIONS.get(city))
+    mask_id = mask_ids.id(mask)
 
     for section in ['regular', 'vip']:
         if section in result:
+            section_id = section_ids.id(section)
             for class_data in result[section].get('numbers', []):
-                phones = class_data.get('phones', [])
-                numbers.extend([str(p) for p in phones])
+                class_id = class_ids.id(class_data.get('classType'))
+                for p in class_data.get('phones', []):
+                    try:
+                        msisdn = int(p)
+                    except (TypeError, ValueError):
+                        continue
+                    records.append(NumberRecord(msisdn, region_id, branch_id, mask_id, class_id, section_id))
 
     if 'payload' in result:
+        section_id = section_ids.id('payload')
         for item in result['payload'].get('msisdns', []):
             if 'msisdn' in item:
-                numbers.append(str(item['msisdn']))
-
-    return numbers
+                try:
+                    msisdn = int(item['msisdn'])
+                except (TypeError, ValueError):
+                    continue
+                class_id = class_ids.id(item.get('classType'))
+                records.append(NumberRecord(msisdn, region_id, branch_id, mask_id, class_id, section_id))
 
+    return records
 
-async def worker_fetch(
-    worker_id: int,
-    proxy: str,
-    city: str,
-    branch_id: str,
-    base_url: str,
-    number_classes: list,
-    masks: list,
-    result_list: list
-):
-    """Воркер обрабатывает свой список масок"""
 
-    if not masks:
-        return
+def parse_numbers(result: dict) -> list:
+    return [record.number for record in decode_numbers(result)]
 
-    tag = f"[W{worker_id}][{city}]"
-    print(f"{tag} Старт воркера, масок: {len(masks)}")
-    log_info(f"{tag} Worker start, masks: {masks}, proxy: {proxy}")
 
+def load_json_cache(filename: str) -> dict:
+    """Читает JSON-кэш с диска (пустой dict если файла нет или он битый)"""
     try:
-        async with AsyncSession(impersonate="safari17_0", proxy=proxy, timeout=20) as session:
-            # Генерация ID для кук (эмуляция JS-трекеров)
-            device_uuid = f"{random.randint(10000000,99999999)}-{random.randint(1000,9999)}-{random.randint(1000,9999)}-{random.randint(1000,9999)}-{random.randint(100000000000,999999999999)}"
-            ym_uid = str(random.randint(1000000000000000, 9999999999999999))
-            ym_d = str(int(datetime.now().timestamp()))
-            st_uid = ''.join(random.choices('0123456789abcdef', k=32))
-            domain_sid = ''.join(random.choices(string.ascii_letters + string.digits, k=20))
-
-            # Инициализация сессии - собираем куки
-            cookies = {
-                "branchId": branch_id,  # Важная кука региона
-                "screenType": "Desktop",
-                "isEmployee": "0",
-                "homeRegion": city,
-                # Яндекс.Метрика
-                "_ym_uid": ym_uid,
-                "_ym_d": ym_d,
-                "_ym_isad": "1",
-                # Трекеры
-                "mindboxDeviceUUID": device_uuid,
-                "directCrm-session": urllib.parse.quote(json.dumps({"deviceGuid": device_uuid})),
-                "st_uid": st_uid,
-                "domain_sid": f"{domain_sid}:{int(datetime.now().timestamp() * 1000)}",
-                "tmr_lvid": st_uid[:32],
-                "tmr_lvidTS": str(int(datetime.now().timestamp() * 1000)),
-                "tmr_detect": "0%7C" + str(int(datetime.now().timestamp() * 1000)),
-                "cookie_toast": "cookie_toast",
-            }
-            page_headers = {
-                "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8",
-                "Accept-Language": "ru",
-                "Sec-Fetch-Dest": "document",
-                "Sec-Fetch-Mode": "navigate",
-                "Sec-Fetch-Site": "none",
-            }
+        with open(filename, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_json_cache(filename: str, data: dict):
+    """Атомарно сохраняет JSON-кэш на диск (свой tmp у каждого процесса)"""
+    if replay is not None and filename in (BOOTSTRAP_CACHE_FILE, CLASSES_CACHE_FILE, PAGE_LIMIT_CACHE_FILE,
+                                           YIELD_HISTORY_FILE):
+        return  # При воспроизведении кэши живут только в памяти, как в начале записи
+    tmp = f"{filename}.{os.getpid()}.tmp"
+    try:
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(tmp, filename)
+    except OSError as e:
+        log_error(f"Cache save error {filename}: {e}")
 
-            # 1. Главная страница
-            log_request("GET", base_url, page_headers)
-            response = await session.get(base_url, headers=page_headers, cookies=cookies, allow_redirects=True, timeout=20)
-            for c in response.cookies.jar:
-                cookies[c.name] = c.value
-            log_response(response.status_code, response.text)
-            await asyncio.sleep(random.uniform(0.5, 1))
-
-            # 2. Сначала fullnumber
-            fullnumber_url = f"{base_url}/connect/chnumber/fullnumber"
-            page_headers["Referer"] = base_url + "/"
-            page_headers["Sec-Fetch-Site"] = "same-origin"
-            log_request("GET", fullnumber_url, page_headers)
-            response = await session.get(fullnumber_url, headers=page_headers, cookies=cookies, allow_redirects=True, timeout=20)
+
+def get_page_limit(branch_id: str) -> Optional[Tuple[int, bool]]:
+    """Размер страницы для филиала и подтверждён ли он полной страницей; None - ещё не проверяли"""
+    global page_limit_cache
+    if page_limit_cache is None:
+        page_limit_cache = load_json_cache(PAGE_LIMIT_CACHE_FILE)
+    entry = page_limit_cache.get(branch_id)
+    if entry and time.time() - entry["ts"] < PAGE_LIMIT_TTL:
+        return entry["limit"], entry.get("confirmed", False)
+    return None
+
+
+def set_page_limit(branch_id: str, limit: int, confirmed: bool = True):
+    get_page_limit(branch_id)  # Загружает кэш с диска
+    page_limit_cache[branch_id] = {"ts": time.time(), "limit": limit, "confirmed": confirmed}
+    save_json_cache(PAGE_LIMIT_CACHE_FILE, page_limit_cache)
+
+
+async def get_bootstrap_cookies(session: AsyncSession, city: str, branch_id: str, base_url: str,
+                                proxy: Optional[str], tag: str, stale_since: float = None) -> Tuple[dict, Optional[float]]:
+    """Куки прогретой сессии из кэша (city, proxy) или после полного прогрева.
+
+    Возвращает (cookies, cached_at): cached_at - время записи в кэше,
+    None если прогрев сделан только что. stale_since - время записи,
+    которую API отверг: она удаляется, если её ещё не обновил другой воркер.
+    """
+    global bootstrap_cache
+    if bootstrap_cache is None:
+        bootstrap_cache = load_json_cache(BOOTSTRAP_CACHE_FILE)
+
+    key = f"{city}|{proxy or ''}"
+    key_lock = bootstrap_locks.setdefault(key, asyncio.Lock())
+
+    async with key_lock:
+        entry = bootstrap_cache.get(key)
+        if entry and stale_since is not None and entry["ts"] <= stale_since:
+            bootstrap_cache.pop(key, None)
+            entry = None
+
+        if entry and time.time() - entry["ts"] < BOOTSTRAP_TTL:
+            log_info(f"{tag} Bootstrap cookies from cache ({int(time.time() - entry['ts'])}s old)")
+            # Запись обновлена другим воркером после отказа - она свежая
+            cached_at = entry["ts"] if stale_since is None else None
+            return dict(entry["cookies"]), cached_at
+
+        cookies = await bootstrap_session(session, city, branch_id, base_url, tag)
+        bootstrap_cache[key] = {"ts": time.time(), "cookies": cookies}
+        # Просроченные записи не храним
+        now = time.time()
+        for k in [k for k, v in bootstrap_cache.items() if now - v["ts"] >= BOOTSTRAP_TTL]:
+            del bootstrap_cache[k]
+        save_json_cache(BOOTSTRAP_CACHE_FILE, bootstrap_cache)
+        return dict(cookies), None
+
+
+async def bootstrap_session(session: AsyncSession, city: str, branch_id: str, base_url: str, tag: str) -> dict:
+    """Прогрев сессии: главная, fullnumber, RSC lnumber. Возвращает собранные куки"""
+    # Генерация ID для кук (эмуляция JS-трекеров)
+    device_uuid = f"{random.randint(10000000,99999999)}-{random.randint(1000,9999)}-{random.randint(1000,9999)}-{random.randint(1000,9999)}-{random.randint(100000000000,999999999999)}"
+    ym_uid = str(random.randint(1000000000000000, 9999999999999999))
+    ym_d = str(int(datetime.now().timestamp()))
+    st_uid = ''.join(random.choices('0123456789abcdef', k=32))
+    domain_sid = ''.join(random.choices(string.ascii_letters + string.digits, k=20))
+
+    # Инициализация сессии - собираем куки
+    cookies = {
+        "branchId": branch_id,  # Важная кука региона
+        "screenType": "Desktop",
+        "isEmployee": "0",
+        "homeRegion": city,
+        # Яндекс.Метрика
+        "_ym_uid": ym_uid,
+        "_ym_d": ym_d,
+        "_ym_isad": "1",
+        # Трекеры
+        "mindboxDeviceUUID": device_uuid,
+        "directCrm-session": urllib.parse.quote(json.dumps({"deviceGuid": device_uuid})),
+        "st_uid": st_uid,
+        "domain_sid": f"{domain_sid}:{int(datetime.now().timestamp() * 1000)}",
+        "tmr_lvid": st_uid[:32],
+        "tmr_lvidTS": str(int(datetime.now().timestamp() * 1000)),
+        "tmr_detect": "0%7C" + str(int(datetime.now().timestamp() * 1000)),
+        "cookie_toast": "cookie_toast",
+    }
+    page_headers = {
+        "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8",
+        "Accept-Language": "ru",
+        "Sec-Fetch-Dest": "document",
+        "Sec-Fetch-Mode": "navigate",
+        "Sec-Fetch-Site": "none",
+    }
+
+    # 1. Главная страница
+    sampled = log_request("GET", base_url, page_headers)
+    response = await send("home", city, base_url, session.get(base_url, headers=page_headers, cookies=cookies, allow_redirects=True, timeout=20))
+    for c in response.cookies.jar:
+        cookies[c.name] = c.value
+    log_response(response.status_code, response.text, sampled)
+
+    # 2. Сначала fullnumber
+    fullnumber_url = f"{base_url}/connect/chnumber/fullnumber"
+    page_headers["Referer"] = base_url + "/"
+    page_headers["Sec-Fetch-Site"] = "same-origin"
+    sampled = log_request("GET", fullnumber_url, page_headers)
+    response = await send("fullnumber", city, fullnumber_url, session.get(fullnumber_url, headers=page_headers, cookies=cookies, allow_redirects=True, timeout=20))
+    for c in response.cookies.jar:
+        cookies[c.name] = c.value
+    log_response(response.status_code, response.text, sampled)
+
+    # 3. Затем lnumber - RSC-запрос (Next.js client navigation)
+    # С ретраями при ошибке 404
+    lnumber_success = False
+    policy = retry_policy(city)
+
+    for lnumber_attempt in range(5):  # До 5 попыток
+        if not await policy.before("lnumber", lnumber_attempt):
+            break
+        rsc_id = ''.join(random.choices(string.ascii_lowercase + string.digits, k=5))
+        lnumber_url = f"{base_url}/connect/chnumber/lnumber?_rsc={rsc_id}"
+
+        # next-router-state-tree для перехода fullnumber -> lnumber
+        router_state = json.dumps(
+            ["", {"children": [[f"branchName", city, "d"], {"children": ["connect", {"children": ["chnumber", {"children": [["slug", "fullnumber", "oc"], {"children": ["__PAGE__", {}, None, None]}, None, None]}, None, None, True]}, None, None]}, None, None]}, None, None, True],
+            separators=(',', ':')
+        )
+
+        rsc_headers = {
+            "Accept": "*/*",
+            "Accept-Language": "ru",
+            "Referer": fullnumber_url,
+            "Sec-Fetch-Dest": "empty",
+            "Sec-Fetch-Mode": "cors",
+            "Sec-Fetch-Site": "same-origin",
+            "rsc": "1",
+            "next-router-state-tree": urllib.parse.quote(router_state),
+            "next-url": f"/{city}/connect/chnumber/fullnumber",
+        }
+
+        sampled = log_request("GET", lnumber_url, rsc_headers)
+        log_info(f"{tag} Cookies sent: {list(cookies.keys())}")
+        response = await send("lnumber", city, lnumber_url, session.get(lnumber_url, headers=rsc_headers, cookies=cookies, allow_redirects=True, timeout=20), lnumber_attempt)
+        for c in response.cookies.jar:
+            cookies[c.name] = c.value
+        log_response(response.status_code, response.text, sampled)
+
+        if response.status_code == 200:
+            lnumber_success = True
+            policy.success("lnumber")
+            break
+        elif response.status_code == 404:
+            # Пауза перед повтором - в policy.before и регуляторе темпа
+            policy.failure("lnumber")
+            print(f"{tag} lnumber 404, ретрай {lnumber_attempt + 1}/5...")
+            log_info(f"{tag} lnumber 404, retry {lnumber_attempt + 1}/5")
+
+            # Перезагружаем fullnumber перед повторной попыткой
+            sampled = log_request("GET", fullnumber_url, page_headers)
+            response = await send("fullnumber", city, fullnumber_url, session.get(fullnumber_url, headers=page_headers, cookies=cookies, allow_redirects=True, timeout=20), lnumber_attempt + 1)
             for c in response.cookies.jar:
                 cookies[c.name] = c.value
-            log_response(response.status_code, response.text)
-            await asyncio.sleep(random.uniform(0.3, 0.6))
-
-            # 3. Затем lnumber - RSC-запрос (Next.js client navigation)
-            # С ретраями при ошибке 404
-            api_referer = f"{base_url}/connect/chnumber/lnumber"
-            lnumber_success = False
-
-            for lnumber_attempt in range(5):  # До 5 попыток
-                rsc_id = ''.join(random.choices(string.ascii_lowercase + string.digits, k=5))
-                lnumber_url = f"{base_url}/connect/chnumber/lnumber?_rsc={rsc_id}"
-
-                # next-router-state-tree для перехода fullnumber -> lnumber
-                router_state = json.dumps(
-                    ["", {"children": [[f"branchName", city, "d"], {"children": ["connect", {"children": ["chnumber", {"children": [["slug", "fullnumber", "oc"], {"children": ["__PAGE__", {}, None, None]}, None, None]}, None, None, True]}, None, None]}, None, None]}, None, None, True],
-                    separators=(',', ':')
-                )
-
-                rsc_headers = {
-                    "Accept": "*/*",
-                    "Accept-Language": "ru",
-                    "Referer": fullnumber_url,
-                    "Sec-Fetch-Dest": "empty",
-                    "Sec-Fetch-Mode": "cors",
-                    "Sec-Fetch-Site": "same-origin",
-                    "rsc": "1",
-                    "next-router-state-tree": urllib.parse.quote(router_state),
-                    "next-url": f"/{city}/connect/chnumber/fullnumber",
-                }
-
-                log_request("GET", lnumber_url, rsc_headers)
-                log_info(f"{tag} Cookies sent: {list(cookies.keys())}")
-                response = await session.get(lnumber_url, headers=rsc_headers, cookies=cookies, allow_redirects=True, timeout=20)
-                for c in response.cookies.jar:
-                    cookies[c.name] = c.value
-                log_response(response.status_code, response.text)
+            log_response(response.status_code, response.text, sampled)
+        else:
+            # Другие ошибки - пробуем продолжить
+            print(f"{tag} lnumber {response.status_code}, пробую продолжить")
+            log_info(f"{tag} lnumber {response.status_code}, trying to continue")
+            break
 
-                if response.status_code == 200:
-                    lnumber_success = True
-                    break
-                elif response.status_code == 404:
-                    wait_time = 3 + lnumber_attempt * 2  # 3, 5, 7, 9, 11 секунд
-                    print(f"{tag} lnumber 404, ретрай {lnumber_attempt + 1}/5 через {wait_time}с...")
-                    log_info(f"{tag} lnumber 404, retry {lnumber_attempt + 1}/5 in {wait_time}s")
-                    await asyncio.sleep(wait_time)
-
-                    # Перезагружаем fullnumber перед повторной попыткой
-                    log_request("GET", fullnumber_url, page_headers)
-                    response = await session.get(fullnumber_url, headers=page_headers, cookies=cookies, allow_redirects=True, timeout=20)
-                    for c in response.cookies.jar:
-                        cookies[c.name] = c.value
-                    log_response(response.status_code, response.text)
-                    await asyncio.sleep(random.uniform(0.5, 1))
-                else:
-                    # Другие ошибки - пробуем продолжить
-                    print(f"{tag} lnumber {response.status_code}, пробую продолжить")
-                    log_info(f"{tag} lnumber {response.status_code}, trying to continue")
-                    break
+    if not lnumber_success:
+        print(f"{tag} lnumber не загрузился, пробую API напрямую")
+        log_info(f"{tag} lnumber failed, trying API directly")
 
-            if not lnumber_success:
-                print(f"{tag} lnumber не загрузился после 5 попыток, пробую API напрямую")
-                log_info(f"{tag} lnumber failed after 5 attempts, trying API directly")
-
-            await asyncio.sleep(random.uniform(0.5, 1))
-
-            # API headers
-            api_headers = {
-                "Accept": "*/*",
-                "Content-Type": "application/json",
-                "Origin": base_url,
-                "Referer": api_referer,
-                "X-Branch-Id": branch_id,
-                "Sec-Fetch-Dest": "empty",
-                "Sec-Fetch-Mode": "cors",
-                "Sec-Fetch-Site": "same-origin",
-            }
+    return cookies
 
-            # Body для первого запроса (С classes)
-            body_first = {
-                "captchaCode": "",
-                "branchId": int(branch_id),
-                "currentTab": "favoriteNumber",
-                "classes": {"numberClasses": number_classes}
-            }
 
-            # Body для последующих запросов (БЕЗ classes)
-            body_next = {
-                "captchaCode": "",
-                "branchId": int(branch_id),
-                "currentTab": "favoriteNumber"
-            }
+class RequestRejected(Exception):
+    """msisdn API отклонил запрос - повтор с теми же куками и параметрами не поможет"""
+
+    def __init__(self, status: int):
+        super().__init__(f"HTTP {status}")
+        self.status = status
 
-            # Обрабатываем каждую маску
-            for mask in masks:
-                mask_numbers = []
+    @property
+    def cookies(self) -> bool:
+        """Отклонены куки сессии, а не параметры запроса"""
+        return self.status in COOKIE_REJECT_STATUSES
 
-                # 1. Первый запрос - получаем классы которые есть для этой маски
-                api_url = f"{base_url}/api/msisdn/msisdn?offset=0&limit={LIMIT}&mask={mask}"
-                api_headers["X-Ecom-Request-Trace-Id"] = ''.join(random.choices(string.ascii_lowercase + string.digits, k=20))
 
-                result, cookies = await self_request_with_captcha(session, api_url, api_headers, body_first, cookies, city, worker_id, mask)
+def api_request_parts(base_url: str, branch_id: str, number_classes: list) -> tuple:
+    """Заголовки и тела запросов к msisdn API: (api_headers, body_first, body_next)"""
+    api_referer = f"{base_url}/connect/chnumber/lnumber"
 
-                if not result:
+    # API headers
+    api_headers = {
+        "Accept": "*/*",
+        "Content-Type": "application/json",
+        "Origin": base_url,
+        "Referer": api_referer,
+        "X-Branch-Id": branch_id,
+        "Sec-Fetch-Dest": "empty",
+        "Sec-Fetch-Mode": "cors",
+        "Sec-Fetch-Site": "same-origin",
+    }
+
+    # Body для первого запроса (С classes)
+    body_first = {
+        "captchaCode": "",
+        "branchId": int(branch_id),
+        "currentTab": "favoriteNumber",
+        "classes": {"numberClasses": number_classes}
+    }
+
+    # Body для последующих запросов (БЕЗ classes)
+    body_next = {
+        "captchaCode": "",
+        "branchId": int(branch_id),
+        "currentTab": "favoriteNumber"
+    }
+    return api_headers, body_first, body_next
+
+
+async def worker_fetch(
+    worker_id: int,
+    proxy: str,
+    city: str,
+    branch_id: str,
+    base_url: str,
+    number_classes: list,
+    queue: WorkQueue,
+    writer: ResultWriter,
+    pagination: dict,
+    job: str = None,
+    verbose: bool = True
+):
+    """Воркер берёт единицы работы из общей очереди региона.
+
+    Работает, занимая слот worker_slots (глобальный лимит воркеров); пока API
+    региона на паузе или опрос --watch закончен (PollQueue), слот отдаётся другим.
+    job - ключ юнитов в журнале checkpoint (по умолчанию branch_id).
+    verbose=False - ход работы только в лог, на экран - только ошибки (--watch).
+    """
+
+    tag = f"[W{worker_id}][{city}]"
+    await worker_slots.acquire()
+    holding = True  # Слот занят - освобождаем его в finally только в этом случае
+    if verbose:
+        print(f"{tag} Старт воркера")
+    log_info(f"{tag} Worker start, proxy: {proxy}")
+
+    unit = None
+    collected = 0
+    try:
+        async with session_pool.session(proxy) as session:
+            cookies, cached_at = await get_bootstrap_cookies(session, city, branch_id, base_url, proxy, tag)
+            warmed_up = cached_at is None  # Полный прогрев уже сделан в этом воркере
+            api_headers, body_first, body_next = api_request_parts(base_url, branch_id, number_classes)
+
+            # Берём единицы работы из общей очереди региона, пока она не опустеет
+            failures = 0
+            policy = retry_policy(city)
+            while True:
+                if policy.is_open("msisdn"):
+                    # API региона на паузе - слот воркера пока отдаём другим регионам
+                    log_info(f"{tag} Region paused, releasing worker slot")
+                    worker_slots.release()
+                    holding = False
+                    await policy.wait_ready("msisdn")
+                    await worker_slots.acquire()
+                    holding = True
+
+                if queue.idle():
+                    # Опрос --watch закончен - до следующего слот воркера отдаём другим парам
+                    log_info(f"{tag} Poll done, releasing worker slot")
+                    worker_slots.release()
+                    holding = False
+                    await queue.wait_work()
+                    await worker_slots.acquire()
+                    holding = True
+
+                unit = await queue.get()
+                if unit is None:
+                    break
+
+                result = rejected = None
+                try:
+                    result, cookies = await fetch_unit(
+                        session, unit, base_url, api_headers, body_first, body_next, cookies, city, worker_id, tag,
+                        pagination, verbose
+                    )
+                except RequestRejected as e:
+                    rejected = e
+
+                if rejected and rejected.cookies and not warmed_up and not policy.is_open("msisdn"):
+                    # API отверг куки из кэша - делаем полный прогрев и повторяем юнит.
+                    # Другие ошибки (5xx, бюджет, пауза региона) прогревом не лечатся
+                    if verbose:
+                        print(f"{tag} Куки из кэша не подошли, прогрев сессии...")
+                    log_info(f"{tag} Cached bootstrap rejected ({rejected}), warming up")
+                    cookies, _ = await get_bootstrap_cookies(
+                        session, city, branch_id, base_url, proxy, tag, stale_since=cached_at
+                    )
+                    warmed_up = True
+                    try:
+                        result, cookies = await fetch_unit(
+                            session, unit, base_url, api_headers, body_first, body_next, cookies, city, worker_id,
+                            tag, pagination, verbose
+                        )
+                    except RequestRejected as e:
+                        log_error(f"{tag} Request rejected after warm-up: {e}")
+                elif rejected:
+                    log_error(f"{tag} Request rejected: {rejected}")
+
+                if result is None and policy.is_open("msisdn"):
+                    # Запрос не пошёл из-за паузы региона - это не ошибка юнита и воркера
+                    queue.putback(unit)
+                    unit = None
                     continue
 
-                # Собираем номера и определяем какие классы есть
-                found_classes = {}  # classType -> count
-                for section in ['regular', 'vip']:
-                    if section in result:
-                        for item in result[section].get('numbers', []):
-                            class_type = item.get('classType')
-                            phones = item.get('phones', [])
-                            if phones:
-                                mask_numbers.extend([str(p) for p in phones])
-                                found_classes[class_type] = len(phones)
-
-                # Показываем какие классы будут дозагружаться
-                need_more = [f"{ct}:{cnt}" for ct, cnt in found_classes.items() if cnt >= LIMIT]
-                if need_more:
-                    print(f"{tag}[{mask}] +{len(mask_numbers)}, дозагрузка: {need_more}")
-                else:
-                    print(f"{tag}[{mask}] +{len(mask_numbers)} (все)")
-                log_info(f"{tag}[{mask}] First request: {len(mask_numbers)} numbers, classes: {found_classes}")
-
-                # 2. Для каждого класса с >= LIMIT номерами - загружаем остальные
-                for class_type, count in found_classes.items():
-                    if count < LIMIT:
-                        continue  # Уже все номера этого класса получены
-
-                    offset = LIMIT
-                    while True:
-                        api_url = f"{base_url}/api/msisdn/msisdn?classIds={class_type}&limit={LIMIT+1}&offset={offset}&mask={mask}"
-                        api_headers["X-Ecom-Request-Trace-Id"] = ''.join(random.choices(string.ascii_lowercase + string.digits, k=20))
-
-                        result, cookies = await self_request_with_captcha(session, api_url, api_headers, body_next, cookies, city, worker_id, mask)
-
-                        if not result:
-                            break
-
-                        # Проверяем есть ли номера
-                        has_numbers = False
-                        for section in ['regular', 'vip']:
-                            if section in result:
-                                for item in result[section].get('numbers', []):
-                                    phones = item.get('phones', [])
-                                    if phones:
-                                        has_numbers = True
-                                        mask_numbers.extend([str(p) for p in phones])
-
-                        if not has_numbers:
-                            break  # Номера закончились
-
-                        offset += LIMIT + 1
-                        await asyncio.sleep(random.uniform(0.3, 0.7))
-
-                if mask_numbers:
-                    result_list.extend(mask_numbers)
-                    print(f"{tag}[{mask}] Итого: +{len(mask_numbers)}")
-                    log_info(f"{tag}[{mask}] Total: {len(mask_numbers)} numbers")
-                else:
-                    log_info(f"{tag}[{mask}] No numbers found")
+                if result is None:
+                    # Не получилось с этим прокси - отдаём юнит другим воркерам
+                    queue.requeue(unit)
+                    unit = None
+                    failures += 1
+                    if failures >= MAX_WORKER_FAILURES:
+                        print(f"{tag} {failures} ошибок подряд, воркер остановлен")
+                        log_error(f"{tag} {failures} failures in a row, worker stopped")
+                        break
+                    continue
 
-                await asyncio.sleep(random.uniform(0.5, 1))
+                records, next_units = result
+                # Ждёт, если стадия записи не успевает (очередь ограничена)
+                await writer.put(records, done=(job or branch_id, unit, next_units))
+                collected += len(records)
+                for next_unit in next_units:
+                    queue.put(next_unit)
+                queue.done(unit)
+                unit = None
+                failures = 0
 
-        log_info(f"{tag} Worker finished, total numbers: {len(result_list)}")
+        log_info(f"{tag} Worker finished, total numbers: {collected}")
 
     except Exception as e:
         print(f"{tag} Ошибка: {e}")
         log_error(f"{tag} Worker error: {e}")
+        # Возвращаем незавершённый юнит в очередь
+        if unit is not None and queue.requeue(unit):
+            log_info(f"{tag} Unit {unit} returned to queue")
+    finally:
+        if holding:
+            worker_slots.release()
+
+    return collected
+
+
+async def fetch_unit(session, unit, base_url, api_headers, body_first, body_next, cookies, city, worker_id, tag,
+                     pagination: dict, verbose: bool = True):
+    """Обрабатывает одну единицу работы (mask, class_type, offset).
+
+    Возвращает ((records, next_units), cookies) или (None, cookies) при ошибке,
+    records - список NumberRecord.
+    class_type=None - первый запрос по маске: он возвращает все классы,
+    и для каждого класса с >= LIMIT номерами ставится юнит дозагрузки.
+    Страницы класса заканчиваются на первой неполной, если размер страницы
+    подтверждён (сервер уже отдавал полную страницу такого размера); иначе
+    неполная страница может быть урезана сервером, и конец - пустая или
+    повторно неполная страница. pagination - общее для воркеров региона
+    состояние классов (размер страницы, найденный конец).
+    verbose=False - ход работы только в лог.
+    """
+    mask, class_type, offset = unit
+    next_units = []
+    api_headers["X-Ecom-Request-Trace-Id"] = ''.join(random.choices(string.ascii_lowercase + string.digits, k=20))
+
+    if class_type is None:
+        # 1. Первый запрос - получаем классы которые есть для этой маски
+        api_url = f"{base_url}/api/msisdn/msisdn?offset=0&limit={LIMIT}&mask={mask}"
+        result, cookies = await self_request_with_captcha(session, api_url, api_headers, body_first, cookies, city, worker_id, mask)
+        if not result:
+            return None, cookies
+
+        # Собираем номера и определяем какие классы есть
+        numbers = decode_numbers(result, city, mask)
+        found_classes = {}  # classType -> count
+        for record in numbers:
+            found_classes[record.class_type] = found_classes.get(record.class_type, 0) + 1
+
+        # 2. Для каждого класса с >= LIMIT номерами - юнит дозагрузки
+        need_more = [f"{ct}:{cnt}" for ct, cnt in found_classes.items() if cnt >= LIMIT]
+        next_units = [(mask, ct, LIMIT) for ct, cnt in found_classes.items() if cnt >= LIMIT]
+        if verbose and need_more:
+            print(f"{tag}[{mask}] +{len(numbers)}, дозагрузка: {need_more}")
+        elif verbose:
+            print(f"{tag}[{mask}] +{len(numbers)} (все)")
+        log_info(f"{tag}[{mask}] First request: {len(numbers)} numbers, classes: {found_classes}")
+        return (numbers, next_units), cookies
+
+    # Дозагрузка страницы класса
+    branch_id = REGIONS[city]
+    state = pagination.get((mask, class_type))
+    if state and state["end"] is not None and offset >= state["end"]:
+        # Конец класса уже найден на другой странице - запрос не нужен
+        return ([], []), cookies
+
+    probing = False
+    cached = None
+    if state:
+        limit, confirmed = state["page"], state["confirmed"]
+    else:
+        cached = get_page_limit(branch_id)
+        if cached:
+            limit, confirmed = cached
+        else:
+            confirmed = False
+            if branch_id in page_probes:
+                limit = LIMIT + 1  # Другой воркер уже проверяет размер страницы
+            else:
+                # Пробуем страницу побольше, пока размер не подтвердится
+                probing = True
+                page_probes.add(branch_id)
+                limit = PAGE_LIMIT_PROBE
+
+    api_url = f"{base_url}/api/msisdn/msisdn?classIds={class_type}&limit={limit}&offset={offset}&mask={mask}"
+    try:
+        result, cookies = await self_request_with_captcha(session, api_url, api_headers, body_next, cookies, city, worker_id, mask)
+    except RequestRejected as e:
+        if not probing or e.cookies:
+            raise
+        # API не принял большой limit - остаёмся на стандартном, пока он не подтвердится
+        log_info(f"[{city}] Page limit probe rejected: {e}")
+        set_page_limit(branch_id, LIMIT + 1, confirmed=False)
+        cached = (LIMIT + 1, False)
+        result = None
+    finally:
+        if probing:
+            page_probes.discard(branch_id)
+    if not result and probing:
+        # Эту страницу берём со стандартным limit. После временной ошибки (сеть, 5xx)
+        # кэш не трогаем - проба повторится на следующей странице
+        probing = False
+        limit = LIMIT + 1
+        api_url = f"{base_url}/api/msisdn/msisdn?classIds={class_type}&limit={limit}&offset={offset}&mask={mask}"
+        result, cookies = await self_request_with_captcha(session, api_url, api_headers, body_next, cookies, city, worker_id, mask)
+    if not result:
+        return None, cookies
+
+    numbers = decode_numbers(result, city, mask)
+    count = len(numbers)
+    if probing:
+        log_info(f"[{city}] Page limit probe: requested {limit}, got {count}")
+
+    if state is None:
+        state = pagination[(mask, class_type)] = {"page": limit, "next": offset + limit, "end": None, "full": 0,
+                                                  "confirmed": confirmed, "trimmed": False}
+
+    if count >= limit and not state["confirmed"]:
+        # Полная страница - сервер принимает такой размер
+        state["confirmed"] = True
+        if probing or cached or state["trimmed"]:
+            set_page_limit(branch_id, limit)
+            log_info(f"[{city}] Page limit confirmed: {limit}")
+
+    if count < limit and not state["confirmed"] and not state["trimmed"] and count:
+        # Размер не подтверждён: сервер мог урезать страницу до count. Следующая страница
+        # покажет: полная - это его максимум, пустая или снова неполная - класс кончился
+        state["page"] = count
+        state["trimmed"] = True
+        state["next"] = offset + count * 2
+        next_units.append((mask, class_type, offset + count))
+    elif count < limit:
+        # Неполная страница - номера класса закончились
+        if state["end"] is None or offset + count < state["end"]:
+            state["end"] = offset + count
+    else:
+        # Полная страница: следующая, а для больших классов - несколько вперёд
+        state["full"] += 1
+        lookahead = PARALLEL_PAGES if state["full"] >= LARGE_CLASS_PAGES else 1
+        target = offset + state["page"] * lookahead
+        while state["next"] <= target and (state["end"] is None or state["next"] < state["end"]):
+            next_units.append((mask, class_type, state["next"]))
+            state["next"] += state["page"]
+
+    log_info(f"{tag}[{mask}] Class {class_type} offset {offset} limit {limit}: {count} numbers")
+    return (numbers, next_units), cookies
 
 
 async def self_request_with_captcha(session, url, headers, body, cookies, city, worker_id, mask):
-    """Делает запрос с обработкой капчи, возвращает (result, updated_cookies)"""
+    """Делает запрос с обработкой капчи, возвращает (result, updated_cookies).
+
+    Отказ API по самому запросу (устаревшие куки, ошибка проверки параметров -
+    4xx кроме RETRY_CLIENT_STATUSES) - исключение RequestRejected: повтор тут
+    не поможет, решает вызывающий.
+    """
     body = body.copy()
     cookies = cookies.copy()
     tag = f"[W{worker_id}][{city}][{mask}]"
+    policy = retry_policy(city)
+    retry = 0  # Ошибок подряд - от него пауза перед следующей попыткой
 
     for attempt in range(5):
+        if not await policy.before("msisdn", retry):
+            log_info(f"{tag} Request skipped: region paused or retry budget exhausted")
+            return None, cookies
         try:
             # Логируем запрос в файл
-            log_request("POST", url, headers, body)
+            sampled = log_request("POST", url, headers, body)
             log_info(f"{tag} Cookies: {list(cookies.keys())}")
+            yield_history.request(REGIONS[city], mask)
 
-            response = await session.post(url, headers=headers, cookies=cookies, json=body, timeout=30)
+            response = await send("msisdn", city, url, session.post(url, headers=headers, cookies=cookies, json=body, timeout=30), attempt)
 
             # Обновляем куки
             for c in response.cookies.jar:
                 cookies[c.name] = c.value
 
             # Логируем ответ в файл
-            log_response(response.status_code, response.text)
+            log_response(response.status_code, response.text, sampled)
+
+            if (400 <= response.status_code < 500 and response.status_code not in RETRY_CLIENT_STATUSES
+                    and "captcha" not in response.text):
+                # Отказ по самому запросу: устаревшие куки или параметры не прошли проверку
+                log_info(f"{tag} Request rejected: {response.status_code}")
+                raise RequestRejected(response.status_code)
 
             if response.status_code == 404:
                 log_info(f"{tag} 404, attempt {attempt+1}")
+                policy.failure("msisdn")
                 if attempt < 2:  # Пробуем 3 раза для 404
-                    await asyncio.sleep(2 + attempt * 2)
+                    retry += 1
                     continue
                 log_info(f"{tag} 404 - не найдено после {attempt+1} попыток")
                 return None, cookies
 
             if response.status_code >= 500:
                 log_error(f"{tag} Server error {response.status_code}, attempt {attempt+1}")
-                await asyncio.sleep(5 + attempt * 3)
+                policy.failure("msisdn")
+                retry += 1
                 continue
 
             if not response.text or len(response.text) < 10:
                 log_error(f"{tag} Empty response")
-                await asyncio.sleep(2)
+                rate_controller(url, city).decrease()
+                policy.failure("msisdn")
+                retry += 1
                 continue
 
             result = response.json()
@@ -450,42 +2471,58 @@ async def self_request_with_captcha(session, url, headers, body, cookies, city,
                     body["captchaCode"] = captcha_code
                     print(f"{tag} Повтор с кодом капчи...")
                     log_info(f"{tag} Retrying with captcha code: {captcha_code}")
-                    await asyncio.sleep(2)
+                    retry = 0  # Повтор с кодом - не ретрай после ошибки
                     continue
                 print(f"{tag} Капча не решена")
                 log_error(f"{tag} Captcha not solved")
+                policy.failure("msisdn")
                 return None, cookies
 
             if "errors" in result and result["errors"]:
                 log_error(f"{tag} API errors: {result['errors']}")
-                await asyncio.sleep(2)
+                rate_controller(url, city).decrease()
+                policy.failure("msisdn")
+                retry += 1
                 continue
 
             log_info(f"{tag} Success")
+            policy.success("msisdn")
             return result, cookies
 
+        except RequestRejected:
+            raise
         except Exception as e:
             print(f"{tag} Exception: {e}")
             log_error(f"{tag} Exception: {e}")
-            await asyncio.sleep(3)
+            policy.failure("msisdn")
+            retry += 1
 
     log_error(f"{tag} Max attempts reached")
     return None, cookies
 
 
-async def fetch_region(city: str, proxies: List[str], masks: List[str], all_proxies: List[str] = None) -> list:
-    """Получает номера региона для всех масок, распределяя по воркерам"""
-    global all_numbers
+def get_cached_classes(branch_id: str) -> Optional[list]:
+    """Классы номеров филиала из дискового кэша, если запись не устарела"""
+    global classes_cache
+    if classes_cache is None:
+        classes_cache = load_json_cache(CLASSES_CACHE_FILE)
+    entry = classes_cache.get(branch_id)
+    if entry and time.time() - entry["ts"] < CLASSES_TTL:
+        return entry["classes"]
+    return None
 
-    branch_id = REGIONS[city]
-    base_url = f"https://{city}.shop.megafon.ru"
-    num_workers = len(proxies)
 
-    print(f"\n[{city}] Старт: {num_workers} воркеров, {len(masks)} масок...")
+async def fetch_classes(city: str, proxies: List[str], all_proxies: List[str] = None) -> Optional[list]:
+    """Получает классы номеров филиала региона (кэш на диске, ротация прокси при ошибке)"""
+    branch_id = REGIONS[city]
+    cached = get_cached_classes(branch_id)
+    if cached:
+        print(f"[{city}] Классы из кэша: {len(cached)} классов")
+        log_info(f"[{city}] Classes from cache: {len(cached)}")
+        return cached
 
-    # Сначала получаем классы номеров (с ротацией прокси при ошибке)
     number_classes = None
-    classes_url = f"https://api.shop.megafon.ru/catalog/v1/showcases/1/branches/{branch_id}/numbers/classes"
+    classes_url = CLASSES_URL.format(branch_id=branch_id)
 
     # Собираем все доступные прокси для попыток: сначала региональные, потом из общего пула
     proxies_to_try = list(proxies)
@@ -494,85 +2531,490 @@ async def fetch_region(city: str, proxies: List[str], masks: List[str], all_prox
             if p not in proxies_to_try:
                 proxies_to_try.append(p)
 
-    working_proxy_idx = 0  # Индекс рабочего прокси для этого региона
-
+    policy = retry_policy(city)
     for attempt, proxy in enumerate(proxies_to_try):
-        if proxy is None:
-            continue
+        if not await policy.before("classes", attempt):
+            log_error(f"[{city}] Classes: circuit open or retry budget exhausted")
+            break
         try:
-            proxy_short = proxy.split('@')[-1] if '@' in proxy else proxy.replace('http://', '').replace('socks5://', '')
+            if proxy is None:
+                proxy_short = "без прокси"
+            else:
+                proxy_short = proxy.split('@')[-1] if '@' in proxy else proxy.replace('http://', '').replace('socks5://', '')
             print(f"[{city}] Получение классов (попытка {attempt + 1}, прокси: {proxy_short})...")
             log_info(f"[{city}] Getting classes, attempt {attempt + 1}, proxy: {proxy_short}")
 
-            async with AsyncSession(impersonate="chrome120", proxy=proxy, timeout=20) as session:
+            async with session_pool.session(proxy) as session:
                 headers = {"Accept": "application/json"}
-                response = await session.get(classes_url, headers=headers, timeout=20)
+                response = await send("classes", city, classes_url, session.get(classes_url, headers=headers, timeout=20), attempt)
 
                 if response.status_code == 200:
                     classes_result = response.json()
                     number_classes = classes_result.get("payload", {}).get("numberClasses", [])
                     if number_classes:
+                        policy.success("classes")
                         print(f"[{city}] Классы: найдено {len(number_classes)} классов")
                         # Заменяем первый прокси на рабочий
                         if attempt > 0 and attempt < len(proxies):
                             print(f"[{city}] Заменяем нерабочий прокси #{1} на #{attempt + 1}")
                             proxies[0] = proxy
-                        working_proxy_idx = attempt
                         break
                     else:
                         print(f"[{city}] Классы пусты, пробую другой прокси...")
+                        policy.failure("classes")
                 else:
                     print(f"[{city}] Классы: status={response.status_code}, пробую другой прокси...")
+                    policy.failure("classes")
 
         except Exception as e:
+            policy.failure("classes")
             err_short = str(e)[:80].replace('\n', ' ')
             print(f"[{city}] Ошибка получения классов: {err_short}")
             log_error(f"[{city}] Classes error with proxy {proxy}: {e}")
 
-        # Небольшая пауза перед следующей попыткой (ротация прокси)
-        await asyncio.sleep(1)
+    if number_classes:
+        classes_cache[branch_id] = {"ts": time.time(), "classes": number_classes}
+        save_json_cache(CLASSES_CACHE_FILE, classes_cache)
+    else:
+        print(f"[{city}] Не удалось получить классы после {len(proxies_to_try)} попыток")
+    return number_classes
 
-    if not number_classes:
-        print(f"[{city}] Не удалось получить классы после {len(proxies_to_try)} попыток, пропускаю регион")
-        return []
 
-    result_list = []
+async def prefetch_classes(regions: List[str], region_proxy_map: dict, all_proxies: List[str]) -> dict:
+    """Заранее и параллельно получает классы для всех филиалов выбранных регионов.
+
+    Возвращает {branch_id: number_classes}; каждый филиал запрашивается один раз.
+    """
+    branch_city = {}
+    for city in regions:
+        branch_city.setdefault(REGIONS[city], city)
+
+    print(f"\nПолучение классов номеров для {len(branch_city)} филиалов...")
+
+    async def fetch_one(branch_id, city):
+        try:
+            return branch_id, await fetch_classes(city, region_proxy_map[city], all_proxies)
+        except Exception as e:
+            log_error(f"[{city}] Classes prefetch error: {e}")
+            return branch_id, None
+
+    results = await asyncio.gather(*(fetch_one(b, c) for b, c in branch_city.items()))
+    classes = {b: nc for b, nc in results if nc}
+    print(f"Классы получены: {len(classes)}/{len(branch_city)} филиалов")
+    log_info(f"Classes prefetched: {len(classes)}/{len(branch_city)} branches")
+    return classes
 
-    # Распределяем маски по воркерам
-    masks_per_worker = [[] for _ in range(num_workers)]
-    for i, mask in enumerate(masks):
-        masks_per_worker[i % num_workers].append(mask)
 
-    print(f"[{city}] Маски по воркерам: {masks_per_worker}")
+async def fetch_region(city: str, proxies: List[str], masks: List[str], writer: ResultWriter,
+                       all_proxies: List[str] = None, number_classes: list = None) -> int:
+    """Получает номера региона для всех масок, распределяя по воркерам.
 
-    # Запуск воркеров параллельно
+    Номера уходят в стадию записи writer, возвращает сколько собрано.
+    """
+    global worker_slots
+
+    if worker_slots is None:
+        worker_slots = asyncio.Semaphore(MAX_WORKERS_TOTAL)
+
+    branch_id = REGIONS[city]
+    base_url = SHOP_URL.format(city=city)
+    num_workers = len(proxies)
+    # Псевдоним с отличающимися данными ведёт свой журнал, чтобы не совпасть с основным регионом
+    job = f"{branch_id}:{city}" if city in split_aliases else branch_id
+
+    print(f"\n[{city}] Старт: {num_workers} воркеров, {len(masks)} масок...")
+
+    # Общая очередь: первый запрос по каждой маске, дозагрузки добавляют сами воркеры
+    # При продолжении - только то, что не выполнено в прошлом запуске
+    if writer.checkpoint:
+        units = writer.checkpoint.pending_units(job, masks)
+    else:
+        units = [(mask, None, 0) for mask in masks]
+    if not units:
+        print(f"[{city}] Уже обработан в прошлом запуске")
+        return 0
+    if run_budget.exhausted():
+        print(f"[{city}] Бюджет запуска исчерпан - регион отложен")
+        return 0
+
+    # Классы номеров: из префетча, кэша или запросом (с ротацией прокси при ошибке)
+    if number_classes is None:
+        number_classes = await fetch_classes(city, proxies, all_proxies)
+
+    if not number_classes:
+        print(f"[{city}] Не удалось получить классы, пропускаю регион")
+        return 0
+
+    # Сначала маски и страницы пар, которые больше давали в прошлых запусках
+    queue = WorkQueue(priority=lambda unit: yield_history.score(branch_id, unit[0]))
+    for unit in units:
+        queue.put(unit)
+    metrics.queues[city] = queue
+    pagination = {}  # (mask, class_type) -> состояние страниц класса
+
+    # Запуск воркеров параллельно (в пределах глобального лимита воркеров)
     tasks = []
     for i in range(num_workers):
-        if masks_per_worker[i]:
-            task = worker_fetch(
-                worker_id=i + 1,
-                proxy=proxies[i],
-                city=city,
-                branch_id=branch_id,
-                base_url=base_url,
-                number_classes=number_classes,
-                masks=masks_per_worker[i],
-                result_list=result_list
-            )
-            tasks.append(task)
-
-    await asyncio.gather(*tasks)
-
-    # Добавляем уникальные номера
-    new_count = 0
-    async with lock:
-        for num in result_list:
-            if num not in all_numbers:
-                all_numbers.add(num)
-                new_count += 1
-
-    print(f"[{city}] Готово: +{new_count} уникальных (всего собрано: {len(result_list)})")
-    return result_list
+        task = worker_fetch(
+            worker_id=i + 1,
+            proxy=proxies[i],
+            city=city,
+            branch_id=branch_id,
+            base_url=base_url,
+            number_classes=number_classes,
+            queue=queue,
+            writer=writer,
+            pagination=pagination,
+            job=job
+        )
+        tasks.append(task)
+
+    try:
+        collected = sum(await asyncio.gather(*tasks))
+    finally:
+        metrics.queues.pop(city, None)
+
+    if queue.units and run_budget.exhausted():
+        print(f"[{city}] Бюджет запуска исчерпан, отложено юнитов: {len(queue.units)}")
+        log_info(f"[{city}] Budget exhausted, deferred units: {queue.remaining()}")
+    elif queue.units or queue.lost:
+        lost = queue.remaining() + queue.lost
+        print(f"[{city}] Не обработано юнитов: {len(lost)}")
+        log_error(f"[{city}] Unprocessed units: {lost}")
+
+    # Дожидаемся записи номеров региона, чтобы посчитать уникальные
+    await writer.flush()
+    new_count = writer.region_new.get(city, 0)
+
+    print(f"[{city}] Готово: +{new_count} уникальных (всего собрано: {collected})")
+    return collected
+
+
+def group_branches(regions: List[str]) -> dict:
+    """{branch_id: [регионы]} в порядке выбора; первый регион филиала - основной"""
+    groups = {}
+    for city in regions:
+        groups.setdefault(REGIONS[city], []).append(city)
+    return groups
+
+
+def plan_branches(regions: List[str], region_proxy_map: dict) -> List[str]:
+    """Оставляет по одному региону на филиал, остальные запоминает как псевдонимы.
+
+    Прокси псевдонимов отдаются основному региону, чтобы не терять воркеров.
+    Возвращает основные регионы.
+    """
+    primaries = []
+    for branch_id, cities in group_branches(regions).items():
+        primary, aliases = cities[0], cities[1:]
+        primaries.append(primary)
+        if not aliases:
+            continue
+        branch_aliases[branch_id] = aliases
+        for alias in aliases:
+            region_proxy_map[primary] = region_proxy_map[primary] + region_proxy_map.get(alias, [])
+        log_info(f"Branch {branch_id}: {primary} also covers {aliases}")
+    skipped = len(regions) - len(primaries)
+    if skipped:
+        print(f"Регионов с общим филиалом: {skipped} - обходятся один раз вместе с основным "
+              f"({', '.join(f'{REGIONS[c]}: {c}+{len(branch_aliases[REGIONS[c]])}' for c in primaries if REGIONS[c] in branch_aliases)})")
+    return primaries
+
+
+async def sample_numbers(city: str, proxy: str, mask: str, number_classes: list) -> Optional[set]:
+    """Номера первой страницы маски в регионе - для сравнения псевдонимов"""
+    branch_id = REGIONS[city]
+    base_url = SHOP_URL.format(city=city)
+    tag = f"[verify][{city}]"
+    async with session_pool.session(proxy) as session:
+        cookies, _ = await get_bootstrap_cookies(session, city, branch_id, base_url, proxy, tag)
+        api_headers, body_first, _ = api_request_parts(base_url, branch_id, number_classes)
+        api_url = f"{base_url}/api/msisdn/msisdn?offset=0&limit={LIMIT}&mask={mask}"
+        try:
+            result, _ = await self_request_with_captcha(session, api_url, api_headers, body_first, cookies, city, 0, mask)
+        except RequestRejected as e:
+            log_error(f"{tag} Request rejected: {e}")
+            result = None
+    if not result:
+        return None
+    return {record.msisdn for record in decode_numbers(result, city, mask)}
+
+
+async def verify_aliases(city: str, aliases: List[str], masks: List[str], proxies: List[str],
+                         number_classes: list) -> List[str]:
+    """Сверяет первую страницу первой маски у основного региона и псевдонимов.
+
+    Возвращает псевдонимы с другими данными. Если проверить не удалось,
+    псевдоним считается совпадающим.
+    """
+    mask = masks[0]
+    reference = await sample_numbers(city, proxies[0], mask, number_classes)
+    if reference is None:
+        print(f"[{city}] Проверка псевдонимов: основной регион не ответил, считаю совпадающими")
+        return []
+    different = []
+    for alias in aliases:
+        numbers = await sample_numbers(alias, proxies[0], mask, number_classes)
+        if numbers is None:
+            print(f"[{alias}] Проверка псевдонима не удалась, считаю совпадающим с {city}")
+        elif numbers != reference:
+            common = len(numbers & reference)
+            print(f"[{alias}] Данные отличаются от {city} (общих номеров {common} из {len(reference)}), "
+                  f"регион будет обойдён отдельно")
+            different.append(alias)
+        else:
+            print(f"[{alias}] Совпадает с {city}")
+        log_info(f"Alias check {alias} vs {city}: {'different' if alias in different else 'same'}")
+    return different
+
+
+async def fetch_branch(city: str, region_proxy_map: dict, masks: List[str], writer: ResultWriter,
+                       all_proxies: List[str] = None, number_classes: list = None, verify: bool = False):
+    """Обходит филиал основного региона city один раз; с verify сначала сверяет псевдонимы
+    и обходит отдельно те, у которых данные другие"""
+    branch_id = REGIONS[city]
+    aliases = branch_aliases.get(branch_id, [])
+    different = []
+    if verify and aliases:
+        if number_classes is None:
+            number_classes = await fetch_classes(city, region_proxy_map[city], all_proxies)
+        if number_classes:
+            different = await verify_aliases(city, aliases, masks, region_proxy_map[city], number_classes)
+        for alias in different:
+            aliases.remove(alias)
+            split_aliases.add(alias)
+    await fetch_region(city, region_proxy_map[city], masks, writer, all_proxies=all_proxies,
+                       number_classes=number_classes)
+    for alias in different:
+        await fetch_region(alias, region_proxy_map[city], masks, writer, all_proxies=all_proxies,
+                           number_classes=number_classes)
+
+
+async def run_regions(regions: List[str], region_proxy_map: dict, masks: List[str], writer: ResultWriter,
+                      all_proxies: List[str], max_regions: int, max_workers: int = MAX_WORKERS_TOTAL,
+                      verify_alias: bool = False):
+    """Запускает регионы параллельно: не больше max_regions регионов и max_workers воркеров одновременно.
+    Регионы с общим филиалом обходятся один раз."""
+    global worker_slots
+    worker_slots = asyncio.Semaphore(max_workers)
+    region_slots = asyncio.Semaphore(max_regions)
+
+    # Классы всех филиалов - до старта воркеров
+    branch_classes = await prefetch_classes(regions, region_proxy_map, all_proxies)
+
+    async def run_one(city):
+        async with region_slots:
+            log_info(f"Processing region: {city}")
+            try:
+                await fetch_branch(city, region_proxy_map, masks, writer, all_proxies=all_proxies,
+                                   number_classes=branch_classes.get(REGIONS[city]), verify=verify_alias)
+            except Exception as e:
+                print(f"[{city}] Ошибка региона: {e}")
+                log_error(f"[{city}] Region error: {e}")
+
+    # Регионы с большей ожидаемой отдачей - первыми (семафор пускает по порядку)
+    primaries = yield_history.order_regions(plan_branches(regions, region_proxy_map), masks)
+    log_info(f"Region order: {primaries}")
+    await asyncio.gather(*(run_one(city) for city in primaries))
+
+
+class PollCollector:
+    """Заменяет ResultWriter в опросе --watch: собирает записи в память.
+
+    Записи, как и в ResultWriter, помечаются выводимой маской плана (MaskPlan.refine).
+    """
+
+    checkpoint = None
+
+    def __init__(self, mask_plan: "MaskPlan" = None):
+        self.mask_plan = mask_plan
+        self.records = {}  # msisdn -> NumberRecord
+
+    async def put(self, records: list, done: tuple = None):
+        for record in records:
+            if self.mask_plan:
+                self.mask_plan.refine(record)
+            self.records[record.msisdn] = record
+
+
+class WatchPair:
+    """Состояние пары (регион, маска) в --watch: последний снимок и интервал опроса"""
+
+    def __init__(self, city: str, mask: str, interval: float, mask_plan: "MaskPlan" = None):
+        self.city = city
+        self.mask = mask
+        self.interval = interval
+        self.records = None  # msisdn -> NumberRecord после последнего полного опроса
+        self.polls = 0
+        self.changes = 0
+        # Воркеры пары живут между опросами: сессии и куки остаются тёплыми
+        self.queue = PollQueue()
+        self.pagination = {}
+        self.collector = PollCollector(mask_plan)
+        self.workers = []
+
+    def update(self, changed: bool):
+        factor = WATCH_SPEEDUP if changed else WATCH_SLOWDOWN
+        self.interval = min(WATCH_INTERVAL_MAX, max(WATCH_INTERVAL_MIN, self.interval * factor))
+
+    def delay(self) -> float:
+        return self.interval * random.uniform(1 - WATCH_JITTER, 1 + WATCH_JITTER)
+
+
+class WatchStream:
+    """Поток изменений --watch: событие NDJSON в файл и строка в консоль на каждый номер"""
+
+    def __init__(self, filename: str):
+        self.filename = filename
+        self.file = open(filename, 'a', encoding='utf-8')
+        self.added = 0
+        self.removed = 0
+
+    def emit(self, event: str, records: list):
+        now = datetime.now().isoformat(timespec="seconds")
+        lines = []
+        for record in records:
+            lines.append(json.dumps({"time": now, "event": event, **record.to_dict()}, ensure_ascii=False) + "\n")
+            print(f"{event} {record.number}  {record.region} {record.mask}")
+        self.file.write("".join(lines))
+        self.file.flush()
+        if event == "+":
+            self.added += len(records)
+        else:
+            self.removed += len(records)
+
+    def close(self):
+        self.file.close()
+
+
+async def poll_pair(pair: WatchPair, proxies: List[str], number_classes: list) -> Optional[dict]:
+    """Полный опрос пары: все классы и страницы маски. None - опрос неполный.
+
+    Воркеры пары запускаются при первом опросе, упавшие - перезапускаются.
+    """
+    city, branch_id, queue = pair.city, REGIONS[pair.city], pair.queue
+    pair.pagination.clear()
+    pair.collector.records = {}
+    queue.start((pair.mask, None, 0))
+
+    for i, proxy in enumerate(proxies):
+        if i < len(pair.workers) and not pair.workers[i].done():
+            continue
+        worker = asyncio.create_task(worker_fetch(
+            worker_id=i + 1, proxy=proxy, city=city, branch_id=branch_id, base_url=SHOP_URL.format(city=city),
+            number_classes=number_classes, queue=queue, writer=pair.collector, pagination=pair.pagination,
+            verbose=False))
+        if i < len(pair.workers):
+            pair.workers[i] = worker
+        else:
+            pair.workers.append(worker)
+
+    # Конец опроса - очередь пуста, или все воркеры остановились (ошибки, бюджет запуска)
+    finished = asyncio.create_task(queue.finished.wait())
+    try:
+        while not finished.done() and not all(worker.done() for worker in pair.workers):
+            await asyncio.wait([finished, *(w for w in pair.workers if not w.done())],
+                               return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        finished.cancel()
+    if not queue.finished.is_set() or queue.lost:
+        return None
+    return pair.collector.records
+
+
+async def stop_pair(pair: WatchPair):
+    """Отпускает воркеров пары и ждёт их завершения"""
+    pair.queue.close()
+    await asyncio.gather(*pair.workers, return_exceptions=True)
+
+
+async def watch_pair(pair: WatchPair, proxies: List[str], number_classes: list, stream: WatchStream,
+                     poll_slots: asyncio.Semaphore):
+    """Опрашивает пару, пока не исчерпан бюджет запуска; изменения уходят в stream"""
+    tag = f"[watch][{pair.city}][{pair.mask}]"
+    try:
+        while not run_budget.exhausted():
+            async with poll_slots:
+                try:
+                    records = await poll_pair(pair, proxies, number_classes)
+                except Exception as e:
+                    log_error(f"{tag} Poll error: {e}")
+                    records = None
+            pair.polls += 1
+            if records is None:
+                # Неполный опрос не сравниваем - пропавшие номера были бы ложными
+                log_info(f"{tag} Incomplete poll, retry in {WATCH_INTERVAL_MIN:g}s")
+                await asyncio.sleep(WATCH_INTERVAL_MIN)
+                continue
+            if pair.records is None:
+                print(f"{tag} Исходно номеров: {len(records)}, опрос каждые {pair.interval:g} с")
+                pair.records = records
+            else:
+                added = [records[n] for n in sorted(records.keys() - pair.records.keys())]
+                removed = [pair.records[n] for n in sorted(pair.records.keys() - records.keys())]
+                if added:
+                    stream.emit("+", added)
+                if removed:
+                    stream.emit("-", removed)
+                pair.records = records
+                changed = bool(added or removed)
+                pair.changes += changed
+                pair.update(changed)
+                log_info(f"{tag} +{len(added)} -{len(removed)}, next poll in {pair.interval:.0f}s")
+            await asyncio.sleep(pair.delay())
+    finally:
+        await stop_pair(pair)
+
+
+async def report_watch(pairs: List[WatchPair], stream: WatchStream):
+    """Периодическая сводка --watch"""
+    while True:
+        await asyncio.sleep(WATCH_REPORT_INTERVAL)
+        intervals = sorted(pair.interval for pair in pairs)
+        print(f"Наблюдение: опросов {sum(p.polls for p in pairs)}, запросов {run_budget.requests}, "
+              f"изменений +{stream.added}/-{stream.removed}, интервал: "
+              f"{intervals[0]:.0f}..{intervals[-1]:.0f} с (медиана {intervals[len(intervals) // 2]:.0f})")
+
+
+async def run_watch(regions: List[str], region_proxy_map: dict, masks: List[str], filename: str,
+                    all_proxies: List[str], max_polls: int, max_workers: int = MAX_WORKERS_TOTAL,
+                    mask_plan: "MaskPlan" = None):
+    """Непрерывное наблюдение: пары (филиал, маска) опрашиваются каждая в своём темпе,
+    в filename пишутся только появившиеся (+) и пропавшие (-) номера.
+    mask_plan - номера помечаются выводимыми масками, как в обычном обходе"""
+    global worker_slots
+    worker_slots = asyncio.Semaphore(max_workers)
+    poll_slots = asyncio.Semaphore(max_polls)
+
+    branch_classes = await prefetch_classes(regions, region_proxy_map, all_proxies)
+    primaries = yield_history.order_regions(plan_branches(regions, region_proxy_map), masks)
+    interval = min(WATCH_INTERVAL_MAX, max(WATCH_INTERVAL_MIN, WATCH_INTERVAL_START))
+    pairs, tasks = [], []
+    stream = WatchStream(filename)
+    for city in primaries:
+        number_classes = branch_classes.get(REGIONS[city])
+        if not number_classes:
+            print(f"[{city}] Нет классов номеров, регион не наблюдается")
+            continue
+        for mask in masks:
+            pair = WatchPair(city, mask, interval, mask_plan)
+            pairs.append(pair)
+            tasks.append(watch_pair(pair, region_proxy_map[city], number_classes, stream, poll_slots))
+    if not pairs:
+        stream.close()
+        return
+
+    print(f"Наблюдение: {len(pairs)} пар (филиал, маска), изменения пишутся в {filename}")
+    log_info(f"Watching {len(pairs)} pairs, events to {filename}")
+    reporter = asyncio.create_task(report_watch(pairs, stream))
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        reporter.cancel()
+        stream.close()
+        print(f"Наблюдение остановлено: опросов {sum(p.polls for p in pairs)}, запросов {run_budget.requests}, "
+              f"изменений +{stream.added}/-{stream.removed}")
+        log_info(f"Watch stopped: +{stream.added}/-{stream.removed}")
 
 
 def select_regions():
@@ -585,8 +3027,13 @@ def select_regions():
             print()
 
     print("\n\nВведите номера через запятую, диапазон (1-10) или 'all' для всех:")
-    choice = input("> ").strip().lower()
+    return parse_regions(input("> "))
+
 
+def parse_regions(choice: str) -> List[str]:
+    """Регионы из строки: номера, диапазоны (1-10), названия через запятую или 'all'"""
+    cities = list(REGIONS.keys())
+    choice = choice.strip().lower()
     if choice == 'all':
         return cities
 
@@ -605,7 +3052,25 @@ def select_regions():
         elif part in REGIONS:
             selected.append(part)
 
-    return list(set(selected))
+    return list(dict.fromkeys(selected))
+
+
+def parse_shard(text: str) -> Tuple[int, int]:
+    """'i/N' -> (i, N), 0 <= i < N"""
+    try:
+        index, count = (int(v) for v in text.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"ожидается i/N, например 0/4: {text}")
+    if count < 1 or not 0 <= index < count:
+        raise argparse.ArgumentTypeError(f"нужно 0 <= i < N: {text}")
+    return index, count
+
+
+def shard_regions(regions: List[str], index: int, count: int) -> List[str]:
+    """Регионы шарда index из count: делятся по филиалам, регионы одного филиала - в одном шарде"""
+    branches = sorted({REGIONS[city] for city in regions}, key=int)
+    mine = set(branches[index::count])
+    return [city for city in regions if REGIONS[city] in mine]
 
 
 def load_proxies(filename: str, proxy_type: str) -> List[str]:
@@ -643,6 +3108,64 @@ def load_masks(filename: str) -> List[str]:
         return []
 
 
+def normalize_mask(mask: str) -> str:
+    return "".join(mask.split())
+
+
+class MaskPlan:
+    """План запросов по маскам.
+
+    Маска ищется как подстрока номера, поэтому результаты '7777' целиком входят
+    в результаты '777'. Запрашиваются только маски, не содержащие других масок
+    из списка (remote); остальные (derived) получаются локальной фильтрацией
+    номеров более широкой маски. Маски не из цифр всегда запрашиваются как есть.
+    """
+
+    def __init__(self, masks: List[str]):
+        self.source_count = len(masks)
+        self.masks = list(dict.fromkeys(m for m in (normalize_mask(m) for m in masks) if m))
+
+        digit_masks = [m for m in self.masks if m.isdigit()]
+        self.remote = [m for m in self.masks
+                       if not m.isdigit() or not any(p != m and p in m for p in digit_masks)]
+        remote_set = set(self.remote)
+        self.derived = {}  # маска -> самая длинная запрашиваемая маска, из которой она выводится
+        for mask in self.masks:
+            if mask not in remote_set:
+                self.derived[mask] = max((p for p in self.remote if p.isdigit() and p in mask), key=len)
+
+        # Для каждой запрашиваемой маски - выводимые из неё, от самых длинных
+        self.children = {}
+        for remote in self.remote:
+            children = sorted((d for d in self.derived if remote in d), key=len, reverse=True)
+            if children:
+                self.children[remote] = children
+        self.hits = {mask: 0 for mask in self.derived}  # Новых номеров по выводимым маскам (считает ResultWriter)
+
+    def refine(self, record: NumberRecord):
+        """Помечает запись самой длинной выводимой маской, которой соответствует номер"""
+        children = self.children.get(record.mask)
+        if not children:
+            return
+        number = record.number
+        for child in children:
+            if child in number:
+                record.mask_id = mask_ids.id(child)
+                return
+
+    def report(self, regions_count: int):
+        """Печатает план и сколько запросов он экономит"""
+        duplicates = self.source_count - len(self.masks)
+        saved = (duplicates + len(self.derived)) * regions_count
+        print(f"План масок: {self.source_count} в файле, {len(self.masks)} уникальных, "
+              f"запрашивается {len(self.remote)}, выводится локально {len(self.derived)}")
+        for mask, parent in self.derived.items():
+            print(f"  {mask} <- {parent}")
+        print(f"Экономия: не меньше {saved} запросов ({regions_count} регионов × "
+              f"{duplicates + len(self.derived)} масок, без учёта страниц)")
+        log_info(f"Mask plan: remote={self.remote}, derived={self.derived}, saved>={saved} requests")
+
+
 async def check_proxy(proxy: str, index: int) -> Tuple[str, bool]:
     """Проверяет работоспособность прокси на сайте мегафона"""
     # Определяем тип прокси
@@ -656,8 +3179,9 @@ async def check_proxy(proxy: str, index: int) -> Tuple[str, bool]:
     proxy_short = proxy.split('@')[-1] if '@' in proxy else proxy.replace('http://', '').replace('https://', '').replace('socks5://', '')
 
     try:
-        async with AsyncSession(impersonate="chrome120", proxy=proxy, timeout=20) as session:
-            response = await session.get("https://moscow.shop.megafon.ru", allow_redirects=True)
+        async with session_pool.session(proxy) as session:
+            response = await session.get(SHOP_URL.format(city="moscow"), allow_redirects=True)
+            session_pool.observe(response)
             if response.status_code == 200:
                 print(f"  [{index}] ✓ {ptype} {proxy_short}")
                 return proxy, True
@@ -688,17 +3212,493 @@ async def check_all_proxies(proxies: List[str], max_concurrent: int = 50) -> Lis
     return working
 
 
-async def main():
+def save_results(writer: ResultWriter):
+    """Финальное сохранение: txt-файл пересобирается отсортированным, пустой - удаляется"""
+    print("-" * 50)
+    print(f"Всего уникальных номеров: {len(all_numbers)}")
+    log_info(f"Total unique numbers: {len(all_numbers)}")
+
+    filename = writer.filename
+    if not writer.count:
+        os.remove(filename)
+        return
+
+    if writer.fmt == "txt":
+        tmp = f"{filename}.tmp"
+        opener = gzip.open if writer.compress else open
+        with opener(tmp, 'wt', encoding='utf-8') as f:
+            for num in all_numbers:  # NumberSet обходится по возрастанию
+                f.write(f"{num}\n")
+        os.replace(tmp, filename)
+
+    print(f"Сохранено в: {filename}")
+    log_info(f"Numbers saved to: {filename}")
+
+
+def iter_numbers(filename: str):
+    """Номера (int) из файла результата (txt или ndjson, можно .gz)"""
+    opener = gzip.open if filename.endswith(".gz") else open
+    try:
+        with opener(filename, 'rt', encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    if line.startswith("{"):
+                        yield int(json.loads(line)["number"])
+                    else:
+                        yield int(line)
+                except (ValueError, KeyError):
+                    continue  # Недописанная строка при падении
+    except (OSError, EOFError):
+        pass
+
+
+def repair_gzip(filename: str) -> Optional[int]:
+    """Чинит gzip-файл результата перед дописыванием (--resume).
+
+    После падения последний член gzip оборван, и всё, что дописано за ним,
+    gzip/zcat и iter_numbers уже не прочитают. Если файл битый, он
+    переписывается из прочитанных полных строк; возвращает их число,
+    None - файл целый (или его нет).
+    """
+    try:
+        with gzip.open(filename, 'rb') as f:
+            while f.read(1 << 20):
+                pass
+        return None
+    except FileNotFoundError:
+        return None
+    except (OSError, EOFError, zlib.error):
+        pass
+
+    tmp = f"{filename}.tmp"
+    kept = 0
+    with open(filename, 'rb') as src, gzip.open(tmp, 'wb') as out:
+        decoder = zlib.decompressobj(zlib.MAX_WBITS | 16)
+        pending = b""
+        chunk = src.read(1 << 20)
+        while chunk:
+            try:
+                pending += decoder.decompress(chunk)
+            except zlib.error:
+                break  # Дальше мусор - оставляем то, что уже разобрали
+            if decoder.eof and decoder.unused_data:
+                # Следующий член gzip (файл дописывался несколько раз)
+                chunk = decoder.unused_data
+                decoder = zlib.decompressobj(zlib.MAX_WBITS | 16)
+            else:
+                chunk = src.read(1 << 20)
+            end = pending.rfind(b"\n") + 1
+            if end:
+                out.write(pending[:end])
+                kept += pending.count(b"\n", 0, end)
+                pending = pending[end:]
+    os.replace(tmp, filename)
+    return kept
+
+
+class RegionQueue:
+    """Очередь регионов в SQLite для процессов --processes: каждый процесс забирает
+    следующий свободный регион, пока они не кончатся"""
+
+    def __init__(self, filename: str):
+        self.filename = filename
+        self.db = sqlite3.connect(filename, timeout=60, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS regions ("
+                        "city TEXT PRIMARY KEY, status TEXT NOT NULL DEFAULT 'pending', "
+                        "worker INTEGER, updated TEXT)")
+
+    @classmethod
+    def create(cls, filename: str, regions: List[str]) -> "RegionQueue":
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(filename + suffix):
+                os.remove(filename + suffix)
+        queue = cls(filename)
+        queue.db.executemany("INSERT INTO regions (city) VALUES (?)", [(city,) for city in regions])
+        return queue
+
+    def claim(self, worker: int) -> Optional[str]:
+        self.db.execute("BEGIN IMMEDIATE")
+        try:
+            row = self.db.execute("SELECT city FROM regions WHERE status = 'pending' ORDER BY rowid LIMIT 1").fetchone()
+            if row:
+                self.db.execute("UPDATE regions SET status = 'running', worker = ?, updated = ? WHERE city = ?",
+                                (worker, datetime.now().isoformat(timespec="seconds"), row[0]))
+            self.db.execute("COMMIT")
+        except BaseException:
+            self.db.execute("ROLLBACK")
+            raise
+        return row[0] if row else None
+
+    def done(self, city: str):
+        self.db.execute("UPDATE regions SET status = 'done', updated = ? WHERE city = ?",
+                        (datetime.now().isoformat(timespec="seconds"), city))
+
+    def unfinished(self) -> List[str]:
+        return [row[0] for row in self.db.execute("SELECT city FROM regions WHERE status != 'done' ORDER BY rowid")]
+
+    def close(self):
+        self.db.close()
+
+
+async def run_queue(queue: RegionQueue, worker: int, regions: List[str], region_proxy_map: dict,
+                    masks: List[str], writer: ResultWriter, all_proxies: List[str], max_regions: int,
+                    max_workers: int = MAX_WORKERS_TOTAL, verify_alias: bool = False):
+    """Как run_regions, но регионы (основные регионы филиалов) забираются из общей очереди процессов"""
+    global worker_slots
+    worker_slots = asyncio.Semaphore(max_workers)
+    plan_branches(regions, region_proxy_map)
+
+    # Первые регионы забираем сразу: классы их филиалов - параллельно, до старта воркеров.
+    # Классы регионов, забранных позже, получает fetch_branch (обычно уже из кэша на диске)
+    claimed = []
+    while len(claimed) < max_regions and not run_budget.exhausted():
+        city = queue.claim(worker)
+        if city is None:
+            break
+        claimed.append(city)
+    branch_classes = await prefetch_classes(claimed, region_proxy_map, all_proxies) if claimed else {}
+
+    async def claimer(city):
+        while city is not None:
+            log_info(f"Processing region: {city} (queue)")
+            try:
+                await fetch_branch(city, region_proxy_map, masks, writer, all_proxies=all_proxies,
+                                   number_classes=branch_classes.get(REGIONS[city]), verify=verify_alias)
+                if not run_budget.exhausted():  # Иначе регион мог остаться недообработанным
+                    queue.done(city)
+            except Exception as e:
+                print(f"[{city}] Ошибка региона: {e}")
+                log_error(f"[{city}] Region error: {e}")
+            city = None if run_budget.exhausted() else queue.claim(worker)
+
+    await asyncio.gather(*(claimer(city) for city in claimed))
+
+
+def part_filename(filename: str, index: int) -> str:
+    """numbers.txt.gz -> numbers.part1.txt.gz"""
+    base, gz = (filename[:-3], ".gz") if filename.endswith(".gz") else (filename, "")
+    stem, ext = os.path.splitext(base)
+    return f"{stem}.part{index}{ext}{gz}"
+
+
+def is_sorted(filename: str) -> bool:
+    """Номера файла идут по неубыванию (txt после save_results)"""
+    last = None
+    for number in iter_numbers(filename):
+        if last is not None and number < last:
+            return False
+        last = number
+    return True
+
+
+def merge_results(files: List[str], output: str) -> int:
+    """Потоковое слияние файлов результата без дублей; возвращает число номеров.
+
+    В txt отсортированные файлы (save_results) сливаются через heapq.merge;
+    неотсортированные (процесс упал до пересортировки, ndjson) собираются в
+    NumberSet, который обходится по возрастанию и сливается с остальными.
+    В ndjson записи дописываются по порядку с отсевом дублей в NumberSet,
+    строки txt становятся записями только с номером.
+    """
+    files = [f for f in files if os.path.exists(f)]
+    ndjson = output.removesuffix(".gz").endswith(".ndjson")
+    opener = gzip.open if output.endswith(".gz") else open
+    count = 0
+    tmp = f"{output}.tmp"
+    with opener(tmp, 'wt', encoding='utf-8') as out:
+        if ndjson:
+            seen = NumberSet()
+            for filename in files:
+                part_opener = gzip.open if filename.endswith(".gz") else open
+                with part_opener(filename, 'rt', encoding='utf-8') as f:
+                    for line in f:
+                        line = line.strip()
+                        try:
+                            if line.startswith("{"):
+                                number = int(json.loads(line)["number"])
+                            else:
+                                number = int(line)
+                                line = json.dumps({"number": line})
+                        except (ValueError, KeyError):
+                            continue
+                        if seen.add(number):
+                            out.write(line + "\n")
+                            count += 1
+        else:
+            streams = []
+            unsorted = NumberSet()
+            for filename in files:
+                if is_sorted(filename):
+                    streams.append(iter_numbers(filename))
+                else:
+                    log_info(f"Merge: {filename} is not sorted, collecting it in memory")
+                    unsorted.add_many(iter_numbers(filename))
+            if unsorted:
+                streams.append(iter(unsorted))
+            last = None
+            for number in heapq.merge(*streams):
+                if number != last:
+                    out.write(f"{number}\n")
+                    count += 1
+                    last = number
+    os.replace(tmp, output)
+    return count
+
+
+async def run_coordinator(args: argparse.Namespace, regions: List[str], masks: List[str], proxy_type: str,
+                          threads: int, parallel_regions: int, filename: str):
+    """Запускает args.processes процессов megafon.py, раздаёт регионы через очередь
+    в SQLite и сливает их файлы в filename"""
+    count = args.processes
+    queue_file = args.queue or QUEUE_FILE
+    # По одному региону на филиал, псевдонимы процессы знают из --regions; продуктивные - первыми
+    primaries = [cities[0] for cities in group_branches(regions).values()]
+    queue = RegionQueue.create(queue_file, yield_history.order_regions(primaries, masks))
+    print(f"\nКоординатор: {count} процессов, {len(regions)} регионов, очередь {queue_file}")
+    if args.db:
+        print("--db с --processes не поддерживается: история запусков не пишется")
+    log_info(f"Coordinator: {count} processes, {len(regions)} regions")
+
+    parts = []
+    children = []
+    for i in range(count):
+        part = part_filename(filename, i + 1)
+        parts.append(part)
+        child_args = [
+            sys.executable, os.path.abspath(__file__),
+            "--regions", ",".join(regions), "--queue", queue_file, "--shard", f"{i}/{count}",
+            "--proxy-type", proxy_type, "--threads", str(threads), "--parallel-regions", str(parallel_regions),
+            "--masks-file", args.masks_file, "--proxies-file", args.proxies_file, "--output", part,
+            "--checkpoint", part_filename(args.checkpoint, i + 1),
+            "--metrics-file", part_filename(args.metrics_file, i + 1) if args.metrics_file else "",
+            "--shop-url", args.shop_url, "--classes-url", args.classes_url, "--max-rate", str(args.max_rate),
+            "--log-level", args.log_level, "--log-sample", str(args.log_sample),
+        ]
+        if args.verify_alias:
+            child_args.append("--verify-alias")
+        if args.deadline:
+            child_args += ["--deadline", str(args.deadline)]
+        if args.max_requests:
+            # Бюджет запросов делится поровну между процессами
+            child_args += ["--max-requests", str(-(-args.max_requests // count))]
+        # Лимиты воркеров и запросов на хост - тоже, чтобы вместе процессы их не превышали
+        child_args += ["--max-workers", str(-(-MAX_WORKERS_TOTAL // count)),
+                       "--max-per-host", str(-(-MAX_PER_HOST // count))]
+        env = dict(os.environ, MEGAFON_LOG=part_filename(LOG_FILE, i + 1))
+        children.append(await asyncio.create_subprocess_exec(*child_args, env=env))
+
+    codes = await asyncio.gather(*(child.wait() for child in children))
+    unfinished = queue.unfinished()
+    queue.close()
+    if any(codes):
+        print(f"Процессы завершились с кодами: {codes}")
+        log_error(f"Child exit codes: {codes}")
+    if unfinished:
+        print(f"Не обработаны регионы: {', '.join(unfinished)}")
+        log_error(f"Unfinished regions: {unfinished}")
+
+    print("-" * 50)
+    total = merge_results(parts, filename)
+    for part in parts:
+        if os.path.exists(part):
+            os.remove(part)
+    print(f"Всего уникальных номеров: {total}")
+    print(f"Сохранено в: {filename}")
+    log_info(f"Merged {len(parts)} parts into {filename}: {total} numbers")
+
+
+def show_history(args: argparse.Namespace):
+    """--runs и --diff: история из SQLite-базы, без парсинга"""
+    if not args.db or not os.path.exists(args.db):
+        print("Укажите существующую базу: --db numbers.db")
+        return
+    store = ResultStore(args.db)
+    try:
+        if args.runs:
+            print(f"{'ID':>5}  {'начат':19}  {'закончен':19}  {'регионов':>8}  {'номеров':>9}  файл")
+            for run_id, started, finished, output, regions, numbers in store.runs():
+                print(f"{run_id:>5}  {started:19}  {finished or '-':19}  {regions:>8}  {numbers:>9}  {output or ''}")
+            return
+        try:
+            old_run, new_run = (store.resolve_run(run) for run in args.diff)
+        except ValueError as e:
+            print(f"Ошибка: {e}")
+            return
+        added = removed = 0
+        for sign, city, number in store.diff(old_run, new_run, args.region):
+            print(f"{sign}{number} {city}")
+            if sign == "+":
+                added += 1
+            else:
+                removed += 1
+        print(f"Запуск {old_run} -> {new_run}: +{added} -{removed}", file=sys.stderr)
+    finally:
+        store.db.close()
+
+
+def output_name(args: argparse.Namespace) -> str:
+    """Файл результата: --output или numbers_ДАТА_ВРЕМЯ с расширением по OUTPUT_FORMAT"""
+    if args.output:
+        return args.output
+    extension = "ndjson" if OUTPUT_FORMAT == "ndjson" else "txt"
+    filename = f"numbers_{datetime.now().strftime('%Y%m%d_%H%M%S')}.{extension}"
+    return filename + ".gz" if OUTPUT_GZIP else filename
+
+
+def parse_args(argv: List[str] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Megafon Number Parser")
+    parser.add_argument("--resume", action="store_true",
+                        help="продолжить прерванный запуск по журналу checkpoint")
+    parser.add_argument("--checkpoint", default=CHECKPOINT_FILE,
+                        help=f"файл журнала выполненных юнитов (по умолчанию {CHECKPOINT_FILE})")
+    parser.add_argument("--shop-url", default=SHOP_URL,
+                        help="шаблон адреса магазина региона, например http://127.0.0.1:8080/{city}")
+    parser.add_argument("--classes-url", default=CLASSES_URL,
+                        help="шаблон адреса API классов с {branch_id}")
+    parser.add_argument("--regions", help="регионы без вопроса: 'all', номера, диапазоны или названия через запятую")
+    parser.add_argument("--proxy-type", choices=["http", "socks5", "none"], help="тип прокси без вопроса")
+    parser.add_argument("--threads", type=int, help="воркеров на регион без вопроса")
+    parser.add_argument("--parallel-regions", type=int, help="регионов одновременно без вопроса")
+    parser.add_argument("--masks-file", default="mask.txt", help="файл масок (по умолчанию mask.txt)")
+    parser.add_argument("--proxies-file", default="proxies.txt", help="файл прокси (по умолчанию proxies.txt)")
+    parser.add_argument("--output", help="файл результата (по умолчанию numbers_ДАТА_ВРЕМЯ.txt)")
+    parser.add_argument("--shard", type=parse_shard, metavar="i/N",
+                        help="обработать только шард i из N (регионы делятся по филиалам, прокси - поровну)")
+    parser.add_argument("--processes", type=int, default=1,
+                        help="запустить столько процессов с общей очередью регионов и слить результат")
+    parser.add_argument("--queue", help=f"SQLite-очередь регионов для --processes (по умолчанию {QUEUE_FILE})")
+    parser.add_argument("--merge", nargs="+", metavar="FILE",
+                        help="слить файлы результата (например шардов с разных машин) в --output и выйти")
+    parser.add_argument("--verify-alias", action="store_true",
+                        help="сверить первую страницу у регионов с общим филиалом и обойти отдельно отличающиеся")
+    parser.add_argument("--watch", action="store_true",
+                        help="наблюдать непрерывно: опрашивать пары (филиал, маска) в своём темпе "
+                             "и писать только появившиеся и пропавшие номера")
+    parser.add_argument("--watch-min", type=float, default=WATCH_INTERVAL_MIN,
+                        help=f"минимальный интервал опроса пары, секунд (по умолчанию {WATCH_INTERVAL_MIN:g})")
+    parser.add_argument("--watch-max", type=float, default=WATCH_INTERVAL_MAX,
+                        help=f"максимальный интервал опроса пары, секунд (по умолчанию {WATCH_INTERVAL_MAX:g})")
+    parser.add_argument("--deadline", type=float, metavar="MIN",
+                        help="остановиться через столько минут; продуктивные пары идут первыми, остальное - --resume")
+    parser.add_argument("--max-requests", type=int, metavar="N",
+                        help="остановиться после стольких запросов (бюджет запуска)")
+    parser.add_argument("--max-workers", type=int, default=MAX_WORKERS_TOTAL,
+                        help=f"воркеров одновременно на все регионы (по умолчанию {MAX_WORKERS_TOTAL})")
+    parser.add_argument("--max-per-host", type=int, default=MAX_PER_HOST,
+                        help=f"одновременных запросов на один хост (по умолчанию {MAX_PER_HOST})")
+    parser.add_argument("--max-rate", type=float, default=RATE_MAX,
+                        help=f"потолок запросов в секунду на хост/филиал (по умолчанию {RATE_MAX:g})")
+    parser.add_argument("--db", default=RESULTS_DB,
+                        help="SQLite-база с историей запусков (номер, регион, филиал, маска, класс, когда виден)")
+    parser.add_argument("--diff", nargs=2, metavar=("OLD", "NEW"),
+                        help="вывести номера, появившиеся (+) и пропавшие (-) между запусками "
+                             "(ID, last или prev) и выйти; нужен --db")
+    parser.add_argument("--region", help="для --diff: только этот регион")
+    parser.add_argument("--runs", action="store_true", help="показать запуски из --db и выйти")
+    parser.add_argument("--metrics-file", default=METRICS_FILE,
+                        help=f"JSON-снимок метрик (по умолчанию {METRICS_FILE}), пустая строка - отключить")
+    parser.add_argument("--metrics-interval", type=float, default=METRICS_INTERVAL,
+                        help="как часто обновлять снимок метрик, секунд")
+    parser.add_argument("--metrics-port", type=int,
+                        help="порт локального HTTP /metrics в формате Prometheus")
+    parser.add_argument("--profile", nargs="?", const=PROFILE_FILE, metavar="FILE",
+                        help=f"профилировать запуск и записать отчёт (по умолчанию {PROFILE_FILE})")
+    parser.add_argument("--record", metavar="FILE",
+                        help="записать все запросы и полные ответы в архив фикстур (например run.replay.gz)")
+    parser.add_argument("--replay", metavar="FILE",
+                        help="отвечать на запросы из архива --record, без сети")
+    parser.add_argument("--replay-scale", type=float, default=REPLAY_SCALE,
+                        help="множитель записанного времени ответа при --replay (0 - без задержек)")
+    parser.add_argument("--log-level", default=logging.getLevelName(LOG_LEVEL),
+                        choices=["DEBUG", "INFO", "WARNING", "ERROR"],
+                        help="уровень лога (на INFO запросы и ответы не пишутся)")
+    parser.add_argument("--log-sample", type=float, default=LOG_BODY_SAMPLE,
+                        help="доля запросов с заголовками и телами в логе, 0..1")
+    args = parser.parse_args(argv)
+    # Процесс координатора: регионы берёт из очереди, а не делит по --shard
+    args.queue_worker = bool(args.queue and args.shard and args.processes == 1)
+    return args
+
+
+async def main(args: argparse.Namespace = None):
+    global LOG_BODY_SAMPLE, SHOP_URL, CLASSES_URL, RATE_MAX, AsyncSession, recorder, replay
+    global WATCH_INTERVAL_MIN, WATCH_INTERVAL_MAX, MAX_WORKERS_TOTAL, MAX_PER_HOST
+    if args is None:
+        args = parse_args()
+    SHOP_URL, CLASSES_URL = args.shop_url, args.classes_url
+    RATE_MAX = args.max_rate
+    MAX_WORKERS_TOTAL, MAX_PER_HOST = max(1, args.max_workers), max(1, args.max_per_host)
+    WATCH_INTERVAL_MIN, WATCH_INTERVAL_MAX = args.watch_min, args.watch_max
+    logger.setLevel(args.log_level)
+    LOG_BODY_SAMPLE = args.log_sample
+
+    if args.diff or args.runs:
+        show_history(args)
+        return
+    if args.processes > 1 and args.resume:
+        print("--resume с --processes не поддерживается")
+        return
+    if args.merge:
+        output = args.output or f"numbers_{datetime.now().strftime('%Y%m%d_%H%M%S')}.txt"
+        print(f"Всего уникальных номеров: {merge_results(args.merge, output)}")
+        print(f"Сохранено в: {output}")
+        return
+
+    if args.record and args.replay:
+        print("--record и --replay вместе не используются")
+        return
+    if args.processes > 1 and (args.record or args.replay):
+        print("--record и --replay с --processes не поддерживаются")
+        return
+    if args.watch and (args.processes > 1 or args.resume):
+        print("--watch с --processes и --resume не поддерживается")
+        return
+    if args.replay:
+        # Адреса - из архива, чтобы ключи запросов совпали с записанными
+        replay = Replay(args.replay, args.replay_scale)
+        SHOP_URL, CLASSES_URL = replay.shop_url, replay.classes_url
+        AsyncSession = ReplaySession
+        print(f"Воспроизведение: {args.replay} (время ответа x{args.replay_scale:g})")
+    elif args.record:
+        recorder = Recorder(args.record)
+        AsyncSession = RecordingSession
+        print(f"Запись обменов: {args.record}")
+
+    rotate_log()
+    profiler = None
+    if args.profile:
+        profiler = Profiler()
+        profiler.start()
+    try:
+        await run_parser(args)
+    finally:
+        await session_pool.close()
+        if profiler:
+            profiler.stop()
+            profiler.report(args.profile)
+        if recorder:
+            recorder.close()
+        if replay:
+            replay.report()
+
+
+async def run_parser(args: argparse.Namespace):
+    """Основной сценарий: меню (или флаги), запуск регионов, сохранение"""
+    global run_budget
     print(f"\n=== Megafon Parser ===")
     print(f"Лог файл: {LOG_FILE}")
     log_info("=" * 50)
     log_info("Megafon Parser started")
 
     # Загружаем маски (обязательно)
-    masks = load_masks("mask.txt")
+    masks = load_masks(args.masks_file)
     if not masks:
-        print("Ошибка: файл mask.txt не найден или пуст!")
-        print("Создайте файл mask.txt с масками (по одной на строку):")
+        print(f"Ошибка: файл {args.masks_file} не найден или пуст!")
+        print(f"Создайте файл {args.masks_file} с масками (по одной на строку):")
         print("  6666")
         print("  4444")
         print("  7777")
@@ -708,56 +3708,99 @@ async def main():
     print(f"Маски: {', '.join(masks)}")
     log_info(f"Masks loaded: {masks}")
 
-    regions = select_regions()
+    # Продолжение прерванного запуска: регионы и файл результата - из журнала
+    checkpoint = None
+    if args.resume:
+        checkpoint = Checkpoint.load(args.checkpoint)
+        if checkpoint is None:
+            print(f"Журнал {args.checkpoint} не найден - нечего продолжать")
+            return
+        regions = [city for city in checkpoint.header.get("regions", []) if city in REGIONS]
+        print(f"Продолжение запуска от {checkpoint.header.get('started')}: "
+              f"выполнено юнитов: {len(checkpoint.completed)}")
+        log_info(f"Resuming {args.checkpoint}: {len(checkpoint.completed)} units done")
+    elif args.regions:
+        regions = parse_regions(args.regions)
+    else:
+        regions = select_regions()
+    if args.shard and not args.queue_worker:
+        regions = shard_regions(regions, *args.shard)
+        print(f"Шард {args.shard[0]}/{args.shard[1]}: {len(regions)} регионов")
     if not regions:
         print("Регионы не выбраны")
         return
 
     print(f"\nВыбрано регионов: {len(regions)}")
 
+    # Дубли и маски, которые выводятся из более широких, не запрашиваем
+    plan = MaskPlan(masks)
+    plan.report(len(regions))
+    masks = plan.remote
+
     # Прокси - тип
-    print("\nТип прокси в файле proxies.txt:")
-    print("  1. HTTP (ip:port или user:pass@ip:port)")
-    print("  2. SOCKS5 (ip:port или user:pass@ip:port)")
-    print("  3. Без прокси")
-    proxy_type_choice = input("> ").strip()
+    proxy_type_choice = {"http": "1", "socks5": "2", "none": "3"}.get(args.proxy_type)
+    if proxy_type_choice is None:
+        print(f"\nТип прокси в файле {args.proxies_file}:")
+        print("  1. HTTP (ip:port или user:pass@ip:port)")
+        print("  2. SOCKS5 (ip:port или user:pass@ip:port)")
+        print("  3. Без прокси")
+        proxy_type_choice = input("> ").strip()
 
     proxies = []
     proxy_type = 'http'
 
     if proxy_type_choice == "1":
         proxy_type = 'http'
-        proxies = load_proxies("proxies.txt", proxy_type)
+        proxies = load_proxies(args.proxies_file, proxy_type)
         if proxies:
             print(f"Загружено {len(proxies)} HTTP прокси")
         else:
-            print("Файл proxies.txt не найден или пуст")
+            print(f"Файл {args.proxies_file} не найден или пуст")
             return
     elif proxy_type_choice == "2":
         proxy_type = 'socks5'
-        proxies = load_proxies("proxies.txt", proxy_type)
+        proxies = load_proxies(args.proxies_file, proxy_type)
         if proxies:
             print(f"Загружено {len(proxies)} SOCKS5 прокси")
         else:
-            print("Файл proxies.txt не найден или пуст")
+            print(f"Файл {args.proxies_file} не найден или пуст")
             return
     elif proxy_type_choice == "3":
+        proxy_type = 'none'
         proxies = [None]
         print("Работа без прокси")
     else:
         print("Неверный выбор")
         return
 
+    if args.shard and proxies[0] is not None:
+        # У каждого шарда свои прокси
+        proxies = proxies[args.shard[0]::args.shard[1]]
+        if not proxies:
+            print("Для этого шарда не хватило прокси")
+            return
+        print(f"Прокси шарда: {len(proxies)}")
+
     # Количество потоков на регион
     if proxies[0] is not None:
-        print(f"\nКоличество потоков на регион (доступно прокси: {len(proxies)}):")
-        try:
-            threads_per_region = int(input("> ").strip())
-            if threads_per_region < 1:
+        if args.threads:
+            threads_per_region = max(1, args.threads)
+        else:
+            print(f"\nКоличество потоков на регион (доступно прокси: {len(proxies)}):")
+            try:
+                threads_per_region = int(input("> ").strip())
+                if threads_per_region < 1:
+                    threads_per_region = 1
+            except ValueError:
                 threads_per_region = 1
-        except ValueError:
-            threads_per_region = 1
-            print("Используется 1 поток")
+                print("Используется 1 поток")
+
+        if args.processes > 1:
+            # Прокси проверяют сами процессы, каждый свою часть
+            parallel_regions = args.parallel_regions or max(1, len(proxies) // args.processes // threads_per_region)
+            await run_coordinator(args, regions, masks, proxy_type, threads_per_region, parallel_regions,
+                                  output_name(args))
+            return
 
         total_threads_needed = threads_per_region * len(regions)
         print(f"\nВсего нужно потоков: {threads_per_region} × {len(regions)} регионов = {total_threads_needed}")
@@ -768,7 +3811,9 @@ async def main():
             print("Нет рабочих прокси!")
             return
 
-        if len(proxies) < total_threads_needed:
+        if len(proxies) < total_threads_needed and args.threads:
+            print(f"\nРабочих прокси ({len(proxies)}) меньше чем нужно ({total_threads_needed}) - прокси будут переиспользоваться")
+        elif len(proxies) < total_threads_needed:
             print(f"\n⚠ Внимание: рабочих прокси ({len(proxies)}) меньше чем нужно ({total_threads_needed})")
             print("Варианты:")
             print(f"  1. Продолжить с {len(proxies)} потоками (прокси будут переиспользоваться)")
@@ -786,11 +3831,36 @@ async def main():
             # choice == "1" - продолжаем как есть
     else:
         threads_per_region = 1
+        if args.processes > 1:
+            parallel_regions = args.parallel_regions or 1
+            await run_coordinator(args, regions, masks, proxy_type, threads_per_region, parallel_regions,
+                                  output_name(args))
+            return
+
+    # Сколько регионов обрабатывать одновременно
+    # По умолчанию - столько, чтобы задействовать все рабочие прокси
+    if proxies[0] is not None:
+        default_parallel = max(1, len(proxies) // threads_per_region)
+    else:
+        default_parallel = 1
+    if args.parallel_regions:
+        parallel_regions = max(1, args.parallel_regions)
+    else:
+        print(f"\nРегионов одновременно (Enter = {default_parallel}):")
+        try:
+            parallel_regions = int(input("> ").strip() or default_parallel)
+            if parallel_regions < 1:
+                parallel_regions = 1
+        except ValueError:
+            parallel_regions = default_parallel
+    parallel_regions = min(parallel_regions, len(regions))
 
     print(f"\nСтарт: {len(regions)} регионов × {threads_per_region} потоков = {len(regions) * threads_per_region} всего")
     print(f"Рабочих прокси: {len(proxies) if proxies[0] else 0}")
     print("-" * 50)
+    print(f"Регионов одновременно: {parallel_regions}, воркеров максимум: {MAX_WORKERS_TOTAL}, запросов на хост: {MAX_PER_HOST}")
     log_info(f"Starting: {len(regions)} regions, {threads_per_region} threads/region, {len(masks)} masks")
+    log_info(f"Scheduler: {parallel_regions} regions in parallel, {MAX_WORKERS_TOTAL} workers max, {MAX_PER_HOST} per host")
     log_info(f"Regions: {regions}")
     log_info(f"Working proxies: {len(proxies) if proxies[0] else 0}")
 
@@ -820,22 +3890,101 @@ async def main():
         print()
         log_info(f"Proxy distribution: {len(regions)} regions × {threads_per_region} proxies each")
 
-    for city in regions:
-        log_info(f"Processing region: {city}")
-        await fetch_region(city, region_proxy_map[city], masks, all_proxies=proxies)
-
-    # Сохранение
-    print("-" * 50)
-    print(f"Всего уникальных номеров: {len(all_numbers)}")
-    log_info(f"Total unique numbers: {len(all_numbers)}")
+    if args.watch:
+        filename = args.output or f"watch_{datetime.now().strftime('%Y%m%d_%H%M%S')}.ndjson"
+        run_budget = RunBudget(args.deadline * 60 if args.deadline else None, args.max_requests)
+        metrics_task = None
+        if args.metrics_file:
+            metrics_task = asyncio.create_task(metrics.run_snapshots(args.metrics_file, args.metrics_interval))
+        try:
+            await run_watch(regions, region_proxy_map, masks, filename, proxies, max_polls=parallel_regions,
+                            max_workers=MAX_WORKERS_TOTAL, mask_plan=plan)
+        finally:
+            if metrics_task:
+                metrics_task.cancel()
+                metrics.save(args.metrics_file)
+            session_pool.report()
+        return
 
-    if all_numbers:
-        filename = f"numbers_{datetime.now().strftime('%Y%m%d_%H%M%S')}.txt"
-        with open(filename, 'w') as f:
-            for num in sorted(all_numbers):
-                f.write(f"{num}\n")
-        print(f"Сохранено в: {filename}")
-        log_info(f"Numbers saved to: {filename}")
+    # Номера пишутся в файл сразу по мере нахождения
+    store = ResultStore(args.db) if args.db else None
+    if checkpoint:
+        # Дописываем в тот же файл; уже найденные номера - для отсева дублей
+        filename = checkpoint.header["output"]
+        compress = filename.endswith(".gz")
+        fmt = "ndjson" if filename.removesuffix(".gz").endswith(".ndjson") else "txt"
+        if compress:
+            kept = repair_gzip(filename)
+            if kept is not None:
+                print(f"{filename}: оборванный хвост gzip отрезан, сохранено строк: {kept}")
+                log_info(f"Repaired truncated gzip {filename}: {kept} lines kept")
+        all_numbers.add_many(iter_numbers(filename))
+        print(f"Уже найдено номеров: {len(all_numbers)}")
+        if store:
+            try:
+                store.resume_run(checkpoint.header["run_id"])
+            except (KeyError, ValueError):
+                store.start_run(filename, regions)  # Прерванный запуск шёл без этой базы
+    else:
+        filename = output_name(args)
+        compress = filename.endswith(".gz")
+        fmt = "ndjson" if filename.removesuffix(".gz").endswith(".ndjson") else "txt"
+        header = {
+            "started": datetime.now().isoformat(timespec="seconds"),
+            "output": filename,
+            "regions": regions,
+        }
+        if store:
+            header["run_id"] = store.start_run(filename, regions)
+        checkpoint = Checkpoint.start(args.checkpoint, header)
+    if store:
+        print(f"История запусков: {args.db} (запуск {store.run_id})")
+    writer = ResultWriter(filename, fmt, compress, checkpoint=checkpoint, mask_plan=plan, store=store)
+    writer.count = len(all_numbers)
+    writer.start()
+    metrics.writer = writer
+
+    metrics_tasks = []
+    if args.metrics_file:
+        metrics_tasks.append(asyncio.create_task(metrics.run_snapshots(args.metrics_file, args.metrics_interval)))
+        print(f"Метрики: {args.metrics_file} (каждые {args.metrics_interval:g} с)")
+    metrics_server = None
+    if args.metrics_port:
+        metrics_server = await metrics.serve(args.metrics_port)
+        print(f"Метрики Prometheus: http://127.0.0.1:{args.metrics_port}/metrics")
+    print(f"Результаты пишутся в: {filename}")
+    log_info(f"Streaming results to: {filename}")
+
+    run_budget = RunBudget(args.deadline * 60 if args.deadline else None, args.max_requests)
+    try:
+        if args.queue_worker:
+            queue = RegionQueue(args.queue)
+            try:
+                await run_queue(queue, args.shard[0] + 1, regions, region_proxy_map, masks, writer, proxies,
+                                max_regions=parallel_regions, max_workers=MAX_WORKERS_TOTAL,
+                                verify_alias=args.verify_alias)
+            finally:
+                queue.close()
+        else:
+            await run_regions(regions, region_proxy_map, masks, writer, proxies, max_regions=parallel_regions,
+                              max_workers=MAX_WORKERS_TOTAL, verify_alias=args.verify_alias)
+    finally:
+        await writer.close()
+        save_results(writer)
+        session_pool.report()
+        yield_history.save()
+        for task in metrics_tasks:
+            task.cancel()
+        if metrics_server:
+            metrics_server.close()
+        if args.metrics_file:
+            metrics.save(args.metrics_file)
+
+    if plan.hits:
+        print("Номера выводимых масок: " + ", ".join(f"{m}: {n}" for m, n in plan.hits.items()))
+    if run_budget.exhausted():
+        print(f"Бюджет запуска исчерпан ({run_budget.reason()}), остальное: python megafon.py --resume")
+        log_info(f"Run budget exhausted: {run_budget.reason()}")
 
     log_info("Megafon Parser finished")
     log_info("=" * 50)
@@ -0,0 +1,288 @@
+"""Локальная замена магазина Megafon для тестов производительности.
+
+Эмулирует эндпоинты, которые использует megafon.py: главную страницу региона,
+fullnumber, RSC lnumber, /api/msisdn/msisdn (offset/limit/mask/classIds) и API
+классов. Задержки, доля ошибок 404/5xx и объём номеров настраиваются. С --churn
+часть пар (филиал, маска) каждые --churn-period секунд меняет долю номеров -
+для проверки megafon.py --watch.
+
+    python mock_server.py --port 8080 --latency 50 --error-5xx 0.01
+    python megafon.py --shop-url "http://127.0.0.1:8080/{city}" \\
+        --classes-url "http://127.0.0.1:8080/catalog/v1/showcases/1/branches/{branch_id}/numbers/classes"
+"""
+import argparse
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional
+
+CLASSES_PATH = re.compile(r"^/catalog/v1/showcases/1/branches/(\d+)/numbers/classes$")
+
+
+class MockConfig:
+    """Настройки поведения сервера"""
+
+    def __init__(self, latency_ms: float = 20, jitter_ms: float = 10, error_404: float = 0.0,
+                 error_5xx: float = 0.0, lnumber_404: float = 0.0, numbers_per_mask: int = 500,
+                 classes: int = 6, max_limit: int = 100, vip_classes: int = 1, seed: int = 1,
+                 churn: float = 0.0, churn_period: float = 60.0, churn_pairs: float = 0.5):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_404 = error_404  # Доля 404 на msisdn API
+        self.error_5xx = error_5xx  # Доля 5xx на msisdn API и API классов
+        self.lnumber_404 = lnumber_404  # Доля 404 на RSC lnumber
+        self.numbers_per_mask = numbers_per_mask  # Номеров на (филиал, маска), делятся между классами
+        self.classes = classes
+        self.max_limit = max_limit  # Сервер урезает страницу до этого размера
+        self.vip_classes = vip_classes  # Сколько последних классов отдаются в секции vip
+        self.seed = seed
+        self.churn = churn  # Доля номеров пары, заменяемая каждый период
+        self.churn_period = churn_period  # Секунд
+        self.churn_pairs = churn_pairs  # Доля пар (филиал, маска), которые меняются
+
+
+class MockStats:
+    """Счётчики запросов по эндпоинтам (потокобезопасно)"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests: Dict[str, int] = {}
+        self.statuses: Dict[int, int] = {}
+        self.latencies: Dict[str, List[float]] = {}
+
+    def add(self, endpoint: str, status: int, seconds: float):
+        with self.lock:
+            self.requests[endpoint] = self.requests.get(endpoint, 0) + 1
+            self.statuses[status] = self.statuses.get(status, 0) + 1
+            self.latencies.setdefault(endpoint, []).append(seconds)
+
+    def reset(self):
+        with self.lock:
+            self.requests.clear()
+            self.statuses.clear()
+            self.latencies.clear()
+
+    @property
+    def total(self) -> int:
+        with self.lock:
+            return sum(self.requests.values())
+
+
+class Inventory:
+    """Детерминированный набор номеров для (филиал, маска), разбитый на классы"""
+
+    def __init__(self, config: MockConfig):
+        self.config = config
+        self.cache: Dict[tuple, Dict[int, List[int]]] = {}
+        self.lock = threading.Lock()
+
+    def get(self, branch_id: str, mask: str) -> Dict[int, List[int]]:
+        epoch = int(time.time() // self.config.churn_period) if self.config.churn else 0
+        key = (branch_id, mask, epoch)
+        with self.lock:
+            if key not in self.cache:
+                if self.config.churn:
+                    # Прошлые периоды больше не нужны
+                    for old in [k for k in self.cache if k[2] != epoch]:
+                        del self.cache[old]
+                self.cache[key] = self.generate(branch_id, mask, epoch)
+            return self.cache[key]
+
+    def generate(self, branch_id: str, mask: str, epoch: int = 0) -> Dict[int, List[int]]:
+        digest = hashlib.sha256(f"{self.config.seed}|{branch_id}|{mask}".encode()).digest()
+        rng = random.Random(digest)
+        digits = "".join(ch for ch in mask if ch.isdigit())[:7] or "0"
+
+        def make_number(rng: random.Random) -> int:
+            tail = "".join(rng.choice("0123456789") for _ in range(7 - len(digits)))
+            pos = rng.randint(0, len(tail))
+            return int(f"79{rng.randint(0, 99):02d}" + tail[:pos] + digits + tail[pos:])
+
+        numbers = set()
+        while len(numbers) < self.config.numbers_per_mask:
+            numbers.add(make_number(rng))
+        if self.config.churn and digest[0] < 256 * self.config.churn_pairs:
+            # Изменчивая пара: в каждом периоде своя доля номеров заменена новыми
+            churn_rng = random.Random(f"{digest.hex()}|{epoch}")
+            for number in churn_rng.sample(sorted(numbers), int(len(numbers) * self.config.churn)):
+                numbers.discard(number)
+                numbers.add(make_number(churn_rng))
+        numbers = sorted(numbers)
+        # Классы неравные: первый самый большой, как на живом сайте
+        weights = [2 ** (self.config.classes - i) for i in range(self.config.classes)]
+        classes: Dict[int, List[int]] = {i + 1: [] for i in range(self.config.classes)}
+        for number in numbers:
+            class_id = rng.choices(range(1, self.config.classes + 1), weights)[0]
+            classes[class_id].append(number)
+        return classes
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server: "MockServer"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.handle_request("GET")
+
+    def do_POST(self):
+        self.handle_request("POST")
+
+    def handle_request(self, method: str):
+        started = time.perf_counter()
+        config = self.server.config
+        url = urllib.parse.urlsplit(self.path)
+        query = dict(urllib.parse.parse_qsl(url.query))
+        length = int(self.headers.get("Content-Length") or 0)
+        if length:
+            self.rfile.read(length)
+
+        if config.latency_ms or config.jitter_ms:
+            time.sleep(max(0.0, random.gauss(config.latency_ms, config.jitter_ms)) / 1000)
+
+        endpoint, status, body, content_type = self.route(method, url.path, query)
+        payload = body.encode() if isinstance(body, str) else body
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(payload)))
+        if endpoint in ("home", "fullnumber"):
+            self.send_header("Set-Cookie", f"mock_session={random.getrandbits(32):x}; Path=/")
+        self.end_headers()
+        self.wfile.write(payload)
+        self.server.stats.add(endpoint, status, time.perf_counter() - started)
+
+    def route(self, method: str, path: str, query: dict) -> tuple:
+        config = self.server.config
+        match = CLASSES_PATH.match(path)
+        if match:
+            if random.random() < config.error_5xx:
+                return "classes", 503, "", "text/plain"
+            classes = [{"id": i + 1, "name": f"class{i + 1}"} for i in range(config.classes)]
+            return "classes", 200, json.dumps({"payload": {"numberClasses": classes}}), "application/json"
+
+        parts = path.strip("/").split("/", 1)
+        rest = "/" + parts[1] if len(parts) > 1 else "/"
+        if rest == "/":
+            return "home", 200, "<html><body>mock home</body></html>", "text/html"
+        if rest == "/connect/chnumber/fullnumber":
+            return "fullnumber", 200, "<html><body>mock fullnumber</body></html>", "text/html"
+        if rest == "/connect/chnumber/lnumber":
+            if random.random() < config.lnumber_404:
+                return "lnumber", 404, "not found", "text/plain"
+            return "lnumber", 200, "0:[\"$\",\"div\",null,{}]\n", "text/x-component"
+        if rest == "/api/msisdn/msisdn" and method == "POST":
+            return self.msisdn(query)
+        return "other", 404, "not found", "text/plain"
+
+    def msisdn(self, query: dict) -> tuple:
+        config = self.server.config
+        roll = random.random()
+        if roll < config.error_5xx:
+            return "msisdn", 502, "", "text/plain"
+        if roll < config.error_5xx + config.error_404:
+            return "msisdn", 404, "", "text/plain"
+
+        branch_id = self.headers.get("X-Branch-Id", "0")
+        classes = self.server.inventory.get(branch_id, query.get("mask", ""))
+        offset = int(query.get("offset", 0))
+        limit = min(int(query.get("limit", 44)), config.max_limit)
+        class_ids = {int(c) for c in query["classIds"].split(",")} if "classIds" in query else None
+
+        result = {"regular": {"numbers": []}, "vip": {"numbers": []}}
+        for class_id, numbers in classes.items():
+            if class_ids is not None and class_id not in class_ids:
+                continue
+            phones = numbers[offset:offset + limit]
+            if not phones:
+                continue
+            section = "vip" if class_id > config.classes - config.vip_classes else "regular"
+            result[section]["numbers"].append({"classType": class_id, "phones": phones})
+        return "msisdn", 200, json.dumps(result), "application/json"
+
+
+class MockServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, port: int = 0, config: Optional[MockConfig] = None):
+        super().__init__(("127.0.0.1", port), MockHandler)
+        self.config = config or MockConfig()
+        self.stats = MockStats()
+        self.inventory = Inventory(self.config)
+        self.thread = None
+
+    @property
+    def base(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    @property
+    def shop_url(self) -> str:
+        return self.base + "/{city}"
+
+    @property
+    def classes_url(self) -> str:
+        return self.base + "/catalog/v1/showcases/1/branches/{branch_id}/numbers/classes"
+
+    def start(self) -> "MockServer":
+        """Запускает сервер в фоновом потоке"""
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def add_config_args(parser: argparse.ArgumentParser):
+    defaults = MockConfig()
+    parser.add_argument("--latency", type=float, default=defaults.latency_ms, help="средняя задержка, мс")
+    parser.add_argument("--jitter", type=float, default=defaults.jitter_ms, help="разброс задержки, мс")
+    parser.add_argument("--error-404", type=float, default=defaults.error_404, help="доля 404 на msisdn API")
+    parser.add_argument("--error-5xx", type=float, default=defaults.error_5xx, help="доля 5xx")
+    parser.add_argument("--lnumber-404", type=float, default=defaults.lnumber_404, help="доля 404 на lnumber")
+    parser.add_argument("--numbers", type=int, default=defaults.numbers_per_mask, help="номеров на (филиал, маска)")
+    parser.add_argument("--classes", type=int, default=defaults.classes, help="классов номеров")
+    parser.add_argument("--max-limit", type=int, default=defaults.max_limit, help="максимальный размер страницы")
+    parser.add_argument("--seed", type=int, default=defaults.seed)
+    parser.add_argument("--churn", type=float, default=defaults.churn,
+                        help="доля номеров изменчивой пары, заменяемая каждый период")
+    parser.add_argument("--churn-period", type=float, default=defaults.churn_period, help="период замены, секунд")
+    parser.add_argument("--churn-pairs", type=float, default=defaults.churn_pairs,
+                        help="доля пар (филиал, маска), которые меняются")
+
+
+def config_from_args(args: argparse.Namespace) -> MockConfig:
+    return MockConfig(latency_ms=args.latency, jitter_ms=args.jitter, error_404=args.error_404,
+                      error_5xx=args.error_5xx, lnumber_404=args.lnumber_404, numbers_per_mask=args.numbers,
+                      classes=args.classes, max_limit=args.max_limit, seed=args.seed, churn=args.churn,
+                      churn_period=args.churn_period, churn_pairs=args.churn_pairs)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Mock-сервер магазина Megafon")
+    parser.add_argument("--port", type=int, default=8080)
+    add_config_args(parser)
+    args = parser.parse_args()
+
+    server = MockServer(args.port, config_from_args(args))
+    print(f"Mock-сервер: {server.base}")
+    print(f"  --shop-url \"{server.shop_url}\"")
+    print(f"  --classes-url \"{server.classes_url}\"")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(f"Запросов: {server.stats.requests}, статусы: {server.stats.statuses}")
+
+
+if __name__ == "__main__":
+    main()
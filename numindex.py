@@ -0,0 +1,430 @@
+"""Индекс цифровых шаблонов по архиву найденных номеров.
+
+Номера из файлов результата megafon.py (txt/ndjson, можно .gz) или из SQLite-базы
+(--db) складываются в папку индекса сегментами. Сегмент - массивы NumPy, которые
+открываются через memmap:
+
+    numbers.npy       int64, отсортированные номера       -> префиксы
+    regions.npy       uint16, код региона строки
+    rev.npy/rev_rows  перевёрнутые номера и их строки      -> суффиксы
+    gram_offsets/gram_rows  4-граммы цифр -> строки (CSR)  -> подстроки
+
+Новые запуски добавляются новым сегментом, уже добавленные файлы пропускаются;
+мелкие сегменты сливаются в один при накоплении (или по команде compact).
+
+    python numindex.py add numbers_20240101_120000.ndjson
+    python numindex.py add --db numbers.db
+    python numindex.py query "*0000" --region spb --region moscow
+    python numindex.py query "*1212*" --count
+    python numindex.py query "7999???00??"
+"""
+import argparse
+import gzip
+import json
+import os
+import re
+import shutil
+import sqlite3
+import sys
+import time
+from typing import Iterator, List, Tuple
+
+import numpy as np
+
+INDEX_DIR = "numindex"
+DIGITS = 11  # 7XXXXXXXXXX
+GRAM = 4  # Длина n-граммы для подстрок
+MAX_SEGMENTS = 8  # Сегментов до автоматического слияния
+CHUNK = 1_000_000  # Строк в пачке при построении
+
+
+def read_file(filename: str, region: str = "") -> Iterator[Tuple[int, str]]:
+    """(номер, регион) из файла результата; у txt регион берётся из аргумента"""
+    opener = gzip.open if filename.endswith(".gz") else open
+    with opener(filename, 'rt', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                if line.startswith("{"):
+                    entry = json.loads(line)
+                    yield int(entry["number"]), entry.get("region") or region
+                else:
+                    yield int(line), region
+            except (ValueError, KeyError):
+                continue  # Недописанная строка при падении
+
+
+def read_db(filename: str) -> Iterator[Tuple[int, str]]:
+    """(номер, регион) из SQLite-базы megafon.py --db"""
+    db = sqlite3.connect(filename)
+    try:
+        cursor = db.execute("SELECT number, region FROM numbers")
+        while True:
+            rows = cursor.fetchmany(CHUNK)
+            if not rows:
+                break
+            yield from rows
+    finally:
+        db.close()
+
+
+def digit_matrix(numbers: np.ndarray) -> np.ndarray:
+    """Матрица цифр (N, 11) uint8, старшая цифра слева"""
+    digits = np.empty((len(numbers), DIGITS), dtype=np.uint8)
+    rest = numbers.copy()
+    for col in range(DIGITS - 1, -1, -1):
+        rest, digit = np.divmod(rest, 10)
+        digits[:, col] = digit
+    return digits
+
+
+def reverse_numbers(numbers: np.ndarray) -> np.ndarray:
+    """Номер с цифрами задом наперёд (11 знаков): суффикс становится префиксом"""
+    digits = digit_matrix(numbers)
+    reversed_ = np.zeros(len(numbers), dtype=np.int64)
+    for col in range(DIGITS - 1, -1, -1):
+        reversed_ = reversed_ * 10 + digits[:, col]
+    return reversed_
+
+
+def digit_range(prefix: str) -> Tuple[int, int]:
+    """Полуинтервал 11-значных чисел, начинающихся с prefix"""
+    scale = 10 ** (DIGITS - len(prefix))
+    return int(prefix) * scale, (int(prefix) + 1) * scale
+
+
+class Segment:
+    """Один сегмент индекса (массивы открыты через memmap)"""
+
+    FILES = ("numbers", "regions", "rev", "rev_rows", "gram_offsets", "gram_rows")
+
+    def __init__(self, path: str):
+        self.path = path
+        for name in self.FILES:
+            setattr(self, name, np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r"))
+
+    def __len__(self):
+        return len(self.numbers)
+
+    @staticmethod
+    def build(path: str, numbers: np.ndarray, regions: np.ndarray):
+        """Пишет сегмент из уникальных пар (номер, код региона)"""
+        order = np.lexsort((regions, numbers))
+        numbers, regions = numbers[order], regions[order]
+        keep = np.ones(len(numbers), dtype=bool)
+        keep[1:] = (numbers[1:] != numbers[:-1]) | (regions[1:] != regions[:-1])
+        numbers, regions = numbers[keep], regions[keep]
+
+        rev = reverse_numbers(numbers)
+        rev_rows = np.argsort(rev, kind="stable").astype(np.int32)
+
+        # Постинги 4-грамм: по каждой позиции, без повторов строки внутри граммы
+        counts = np.zeros(10 ** GRAM, dtype=np.int64)
+        keys = []
+        for start in range(0, len(numbers), CHUNK):
+            d = digit_matrix(numbers[start:start + CHUNK]).astype(np.int32)
+            grams = np.zeros((len(d), DIGITS - GRAM + 1), dtype=np.int32)
+            for pos in range(DIGITS - GRAM + 1):
+                for k in range(GRAM):
+                    grams[:, pos] = grams[:, pos] * 10 + d[:, pos + k]
+            rows = np.arange(start, start + len(d), dtype=np.int64)[:, None]
+            key = np.sort((grams.astype(np.int64) << 32 | rows).ravel(), kind="stable")
+            key = key[np.r_[True, key[1:] != key[:-1]]]
+            counts += np.bincount((key >> 32).astype(np.int64), minlength=10 ** GRAM)
+            keys.append(key)
+        key = np.sort(np.concatenate(keys), kind="stable") if keys else np.zeros(0, dtype=np.int64)
+        gram_rows = (key & 0xFFFFFFFF).astype(np.int32)
+        gram_offsets = np.zeros(10 ** GRAM + 1, dtype=np.int64)
+        np.cumsum(counts, out=gram_offsets[1:])
+
+        tmp = path + ".tmp"
+        shutil.rmtree(tmp, ignore_errors=True)
+        os.makedirs(tmp)
+        arrays = {"numbers": numbers, "regions": regions, "rev": rev[rev_rows], "rev_rows": rev_rows,
+                  "gram_offsets": gram_offsets, "gram_rows": gram_rows}
+        for name, array in arrays.items():
+            np.save(os.path.join(tmp, f"{name}.npy"), array)
+        os.replace(tmp, path)
+
+    def prefix_rows(self, prefix: str) -> np.ndarray:
+        low, high = digit_range(prefix)
+        return np.arange(*np.searchsorted(self.numbers, [low, high]))
+
+    def suffix_rows(self, suffix: str) -> np.ndarray:
+        low, high = digit_range(suffix[::-1])
+        start, stop = np.searchsorted(self.rev, [low, high])
+        return np.sort(self.rev_rows[start:stop])
+
+    def count_prefix(self, prefix: str) -> int:
+        start, stop = np.searchsorted(self.numbers, digit_range(prefix))
+        return int(stop - start)
+
+    def count_suffix(self, suffix: str) -> int:
+        start, stop = np.searchsorted(self.rev, digit_range(suffix[::-1]))
+        return int(stop - start)
+
+    def gram_rows_of(self, gram: str) -> np.ndarray:
+        g = int(gram)
+        return self.gram_rows[self.gram_offsets[g]:self.gram_offsets[g + 1]]
+
+    def substring_rows(self, literal: str) -> np.ndarray:
+        """Кандидаты (надмножество) для подстроки длиной от GRAM: пересечение постингов её грамм"""
+        grams = sorted({literal[i:i + GRAM] for i in range(len(literal) - GRAM + 1)},
+                       key=lambda g: len(self.gram_rows_of(g)))
+        rows = np.asarray(self.gram_rows_of(grams[0]))
+        for gram in grams[1:]:
+            if not len(rows):
+                break
+            rows = np.intersect1d(rows, self.gram_rows_of(gram), assume_unique=True)
+        return rows
+
+
+class Pattern:
+    """Шаблон: цифры, ? (любая цифра) и * (любое число цифр).
+
+    Без * шаблон сравнивается со всеми 11 цифрами: "7999???00??".
+    "7999*" - префикс, "*0000" - суффикс, "*1212*" - подстрока.
+    """
+
+    def __init__(self, text: str):
+        text = text.strip().upper().replace("X", "?").replace("+", "")
+        if not text or not re.fullmatch(r"[0-9?*]+", text):
+            raise ValueError(f"неверный шаблон: {text!r} (допустимы цифры, ? и *)")
+        if "*" not in text and len(text) != DIGITS:
+            raise ValueError(f"шаблон без * должен быть из {DIGITS} знаков: {text!r}")
+        if len(text.replace("*", "")) > DIGITS:
+            raise ValueError(f"в шаблоне больше {DIGITS} цифр: {text!r}")
+        self.text = text
+        self.parts = text.split("*")
+        self.prefix = re.match(r"[0-9]*", text).group()
+        self.suffix = re.search(r"[0-9]*$", text).group()
+        self.literals = [part for part in re.split(r"[?*]+", text) if len(part) >= GRAM]
+        # Точный ответ без проверки: "7999*", "*0000", "*1212*"
+        self.exact_prefix = text == self.prefix + "*"
+        self.exact_suffix = text == "*" + self.suffix
+        self.positional = "*" not in text
+
+    def verify(self, numbers: np.ndarray) -> np.ndarray:
+        """Маска строк, подходящих под шаблон (векторно по матрице цифр)"""
+        ok = np.ones(len(numbers), dtype=bool)
+        for start in range(0, len(numbers), CHUNK):
+            ok[start:start + CHUNK] = self.match(digit_matrix(np.asarray(numbers[start:start + CHUNK])))
+        return ok
+
+    @staticmethod
+    def part_at(d: np.ndarray, part: str, pos: int) -> np.ndarray:
+        ok = np.ones(len(d), dtype=bool)
+        for k, ch in enumerate(part):
+            if ch != "?":
+                ok &= d[:, pos + k] == int(ch)
+        return ok
+
+    def match(self, d: np.ndarray) -> np.ndarray:
+        """Части между * ищутся жадно слева направо, первая и последняя привязаны к краям"""
+        first, last, middle = self.parts[0], self.parts[-1], self.parts[1:-1]
+        if self.positional:
+            return self.part_at(d, first, 0)
+        ok = self.part_at(d, first, 0) & self.part_at(d, last, DIGITS - len(last))
+        cursor = np.full(len(d), len(first))
+        end = DIGITS - len(last)
+        for part in middle:
+            if not part:
+                continue
+            found = np.zeros(len(d), dtype=bool)
+            for pos in range(len(first), end - len(part) + 1):
+                hit = ~found & (cursor <= pos) & self.part_at(d, part, pos)
+                cursor[hit] = pos + len(part)
+                found |= hit
+            ok &= found
+        return ok
+
+
+class NumberIndex:
+    """Папка индекса: manifest.json + сегменты seg_NNNN"""
+
+    def __init__(self, path: str = INDEX_DIR):
+        self.path = path
+        self.manifest_file = os.path.join(path, "manifest.json")
+        try:
+            with open(self.manifest_file, 'r', encoding='utf-8') as f:
+                self.manifest = json.load(f)
+        except (OSError, ValueError):
+            self.manifest = {"segments": [], "regions": [""], "sources": {}, "next_segment": 0}
+        self.segments = [Segment(os.path.join(path, name)) for name in self.manifest["segments"]]
+
+    def save_manifest(self):
+        os.makedirs(self.path, exist_ok=True)
+        tmp = self.manifest_file + ".tmp"
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(self.manifest, f, ensure_ascii=False, indent=1)
+        os.replace(tmp, self.manifest_file)
+
+    def region_code(self, region: str) -> int:
+        regions = self.manifest["regions"]
+        if region not in regions:
+            regions.append(region)
+        return regions.index(region)
+
+    @staticmethod
+    def source_key(filename: str) -> str:
+        stat = os.stat(filename)
+        return f"{stat.st_size}:{int(stat.st_mtime)}"
+
+    def add(self, pairs: Iterator[Tuple[int, str]], source: str = None, key: str = None) -> int:
+        """Добавляет пары (номер, регион) новым сегментом; возвращает число строк"""
+        numbers, regions = [], []
+        codes = {}
+        for number, region in pairs:
+            code = codes.get(region)
+            if code is None:
+                code = codes[region] = self.region_code(region)
+            numbers.append(number)
+            regions.append(code)
+        if not numbers:
+            return 0
+        name = f"seg_{self.manifest['next_segment']:04d}"
+        self.manifest["next_segment"] += 1
+        os.makedirs(self.path, exist_ok=True)
+        Segment.build(os.path.join(self.path, name), np.array(numbers, dtype=np.int64),
+                      np.array(regions, dtype=np.uint16))
+        self.manifest["segments"].append(name)
+        if source:
+            self.manifest["sources"][source] = key
+        self.save_manifest()
+        self.segments.append(Segment(os.path.join(self.path, name)))
+        return len(self.segments[-1])
+
+    def compact(self):
+        """Сливает все сегменты в один (дубли пар номер+регион убираются)"""
+        if len(self.segments) < 2:
+            return
+        numbers = np.concatenate([np.asarray(s.numbers) for s in self.segments])
+        regions = np.concatenate([np.asarray(s.regions) for s in self.segments])
+        old = self.manifest["segments"]
+        name = f"seg_{self.manifest['next_segment']:04d}"
+        self.manifest["next_segment"] += 1
+        Segment.build(os.path.join(self.path, name), numbers, regions)
+        self.manifest["segments"] = [name]
+        self.save_manifest()
+        self.segments = [Segment(os.path.join(self.path, name))]
+        for old_name in old:
+            shutil.rmtree(os.path.join(self.path, old_name), ignore_errors=True)
+
+    def candidates(self, segment: Segment, pattern: Pattern) -> Tuple[np.ndarray, bool]:
+        """Строки-кандидаты сегмента по самому узкому доступу и нужна ли проверка"""
+        options = []
+        if pattern.prefix:
+            options.append((segment.count_prefix(pattern.prefix), "prefix"))
+        if pattern.suffix and pattern.suffix != pattern.text:
+            options.append((segment.count_suffix(pattern.suffix), "suffix"))
+        for literal in pattern.literals:
+            if literal not in (pattern.prefix, pattern.suffix):
+                options.append((min(len(segment.gram_rows_of(literal[i:i + GRAM]))
+                                    for i in range(len(literal) - GRAM + 1)), literal))
+        if not options:
+            return np.arange(len(segment)), True
+        _, best = min(options, key=lambda o: o[0])
+        if best == "prefix":
+            return segment.prefix_rows(pattern.prefix), not pattern.exact_prefix
+        if best == "suffix":
+            return segment.suffix_rows(pattern.suffix), not pattern.exact_suffix
+        return segment.substring_rows(best), True
+
+    def query(self, pattern: Pattern, regions: List[str] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """(номера, регионы) под шаблон, отсортированные, без дублей между сегментами"""
+        codes = None
+        if regions:
+            known = self.manifest["regions"]
+            codes = np.array([known.index(r) for r in regions if r in known], dtype=np.uint16)
+        found_numbers, found_regions = [], []
+        for segment in self.segments:
+            rows, check = self.candidates(segment, pattern)
+            if codes is not None:
+                rows = rows[np.isin(segment.regions[rows], codes)]
+            numbers = segment.numbers[rows]
+            if check:
+                ok = pattern.verify(numbers)
+                rows, numbers = rows[ok], numbers[ok]
+            found_numbers.append(np.asarray(numbers))
+            found_regions.append(np.asarray(segment.regions[rows]))
+        if not found_numbers:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.uint16)
+        numbers, regions_ = np.concatenate(found_numbers), np.concatenate(found_regions)
+        if len(self.segments) > 1:
+            pairs = np.unique(np.stack([numbers, regions_.astype(np.int64)], axis=1), axis=0)
+            numbers, regions_ = pairs[:, 0], pairs[:, 1].astype(np.uint16)
+        return numbers, regions_
+
+
+def main(argv: List[str] = None):
+    parser = argparse.ArgumentParser(description="Индекс цифровых шаблонов по найденным номерам")
+    parser.add_argument("--index", default=INDEX_DIR, help=f"папка индекса (по умолчанию {INDEX_DIR})")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    add = commands.add_parser("add", help="добавить файлы результата или базу новым сегментом")
+    add.add_argument("files", nargs="*", help="файлы результата megafon.py (txt/ndjson, можно .gz)")
+    add.add_argument("--db", help="SQLite-база megafon.py --db (добавляется целиком)")
+    add.add_argument("--region", default="", help="регион для txt-файлов (в них региона нет)")
+    add.add_argument("--force", action="store_true", help="добавить даже уже проиндексированные файлы")
+
+    query = commands.add_parser("query", help="найти номера по шаблону")
+    query.add_argument("pattern", help="цифры, ? - любая цифра, * - любое число цифр: *0000, 7999*, *1212*")
+    query.add_argument("--region", action="append", default=[], help="только этот регион (можно несколько)")
+    query.add_argument("--count", action="store_true", help="только количество")
+    query.add_argument("--limit", type=int, default=0, help="сколько номеров вывести (0 - все)")
+
+    commands.add_parser("compact", help="слить сегменты в один")
+    commands.add_parser("info", help="сегменты и регионы индекса")
+    args = parser.parse_args(argv)
+
+    index = NumberIndex(args.index)
+
+    if args.command == "add":
+        sources = [(f, lambda f=f: read_file(f, args.region)) for f in args.files]
+        if args.db:
+            sources.append((args.db, lambda: read_db(args.db)))
+        if not sources:
+            parser.error("укажите файлы или --db")
+        for filename, reader in sources:
+            key = NumberIndex.source_key(filename)
+            source = os.path.abspath(filename)
+            if not args.force and index.manifest["sources"].get(source) == key:
+                print(f"{filename}: уже в индексе", file=sys.stderr)
+                continue
+            started = time.perf_counter()
+            rows = index.add(reader(), source, key)
+            print(f"{filename}: {rows} строк за {time.perf_counter() - started:.1f} с", file=sys.stderr)
+        if len(index.segments) > MAX_SEGMENTS:
+            index.compact()
+            print(f"Сегменты слиты: {len(index.segments[0])} строк", file=sys.stderr)
+
+    elif args.command == "compact":
+        index.compact()
+        print(f"Сегментов: {len(index.segments)}, строк: {sum(len(s) for s in index.segments)}", file=sys.stderr)
+
+    elif args.command == "info":
+        for segment in index.segments:
+            print(f"{os.path.basename(segment.path)}: {len(segment)} строк")
+        print(f"Регионы: {', '.join(r or '-' for r in index.manifest['regions'])}")
+        print(f"Источников: {len(index.manifest['sources'])}")
+
+    elif args.command == "query":
+        try:
+            pattern = Pattern(args.pattern)
+        except ValueError as e:
+            parser.error(str(e))
+        started = time.perf_counter()
+        numbers, regions = index.query(pattern, args.region)
+        elapsed = (time.perf_counter() - started) * 1000
+        if not args.count:
+            names = index.manifest["regions"]
+            shown = numbers if not args.limit else numbers[:args.limit]
+            for number, region in zip(shown, regions):
+                print(f"{number} {names[region]}".rstrip())
+        print(f"Найдено: {len(numbers)} за {elapsed:.1f} мс", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
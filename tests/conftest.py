@@ -0,0 +1,30 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+# Лог тестов - во временный файл, а не в megafon.log рабочей папки
+os.environ.setdefault("MEGAFON_LOG", os.path.join(tempfile.gettempdir(), "megafon-tests.log"))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import megafon  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def fresh_state(tmp_path, monkeypatch):
+    """Чистые глобальные структуры и файлы кэша во временной папке на каждый тест"""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(megafon, "all_numbers", megafon.NumberSet())
+    monkeypatch.setattr(megafon, "yield_history", megafon.YieldHistory(str(tmp_path / "yield_history.json")))
+    monkeypatch.setattr(megafon, "run_budget", megafon.RunBudget())
+    monkeypatch.setattr(megafon, "branch_aliases", {})
+    monkeypatch.setattr(megafon, "page_limit_cache", None)
+    monkeypatch.setattr(megafon, "page_probes", set())
+    monkeypatch.setattr(megafon, "worker_slots", None)
+
+
+def make_record(number: str, mask: str, city: str = "moscow", class_type=1, section: str = "") -> "megafon.NumberRecord":
+    return megafon.NumberRecord(int(number), megafon.region_ids.id(city), megafon.branch_ids.id(megafon.REGIONS[city]),
+                                megafon.mask_ids.id(mask), megafon.class_ids.id(class_type),
+                                megafon.section_ids.id(section))
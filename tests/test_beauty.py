@@ -0,0 +1,77 @@
+import numpy as np
+import pytest
+
+import beauty
+
+# Ручная проверка: хвосты по одному правилу и обычный номер без совпадений
+KNOWN = {
+    79164827153: [],
+    79161234567: ["ladder"],
+    79169876540: ["ladder"],
+    79165555555: ["run", "end", "mirror4", "mirror6", "mirror7", "few"],
+    79164821212: ["abab"],
+    79163121212: ["abab", "ababab", "few"],
+    79164123123: ["abcabc"],
+    79161234321: ["ladder", "mirror7"],
+    79164112233: ["pairs"],
+    79164830000: ["run", "end", "mirror4", "round"],
+}
+
+
+def longest(flags) -> int:
+    best = current = 0
+    for flag in flags:
+        current = current + 1 if flag else 0
+        best = max(best, current)
+    return best
+
+
+def scalar_rules(number: int) -> dict:
+    """Те же правила по одному номеру обычным Python - эталон для векторного score"""
+    s = str(number)
+    t = [int(c) for c in s[-beauty.TAIL:]]
+    run = longest(a == b for a, b in zip(t, t[1:])) + 1
+    end = len(t) - len("".join(map(str, t)).rstrip(str(t[-1])))
+    ladder = max(longest(b - a == 1 for a, b in zip(t, t[1:])), longest(a - b == 1 for a, b in zip(t, t[1:]))) + 1
+    t6 = s[-6:]
+    pairs = [t6[0] == t6[1], t6[2] == t6[3], t6[4] == t6[5]]
+    distinct = [t6[2] != t6[0], t6[4] != t6[2]]
+    zeros = len(s) - len(s.rstrip("0"))
+
+    def repeat(block, times):
+        tail = s[-block * times:]
+        return int(tail == tail[:block] * times and len(set(tail[:block])) > 1)
+
+    return {
+        "run": run - 2 if run >= 3 else 0,
+        "end": end - 2 if end >= 3 else 0,
+        "ladder": ladder - 3 if ladder >= 4 else 0,
+        "mirror4": int(s[-4:] == s[-4:][::-1]),
+        "mirror6": int(s[-6:] == s[-6:][::-1]),
+        "mirror7": int(s[-7:] == s[-7:][::-1]),
+        "abab": repeat(2, 2),
+        "ababab": repeat(2, 3),
+        "abcabc": repeat(3, 2),
+        "pairs": int(pairs[1] and pairs[2] and distinct[1]) + int(all(pairs) and all(distinct)),
+        "few": max(0, 4 - len(set(t))),
+        "round": zeros - 1 if zeros >= 2 else 0,
+    }
+
+
+def test_score_and_tags_match_scalar_rules():
+    numbers = np.array(list(KNOWN), dtype=np.int64)
+    scores, tags = beauty.score(numbers)
+    weights = {rule.name: rule.weight for rule in beauty.RULES}
+    for number, value, bits in zip(KNOWN, scores, tags):
+        strengths = scalar_rules(number)
+        assert beauty.tag_names(int(bits)) == KNOWN[number], number
+        assert beauty.tag_names(int(bits)) == [name for name, s in strengths.items() if s], number
+        assert value == pytest.approx(sum(weights[name] * s for name, s in strengths.items())), number
+
+
+def test_chunks_give_the_same_result(monkeypatch):
+    numbers = np.array(list(KNOWN), dtype=np.int64)
+    expected = beauty.score(numbers)
+    monkeypatch.setattr(beauty, "CHUNK", 2)
+    for got, want in zip(beauty.score(numbers), expected):
+        assert np.array_equal(got, want)
@@ -0,0 +1,56 @@
+import megafon
+
+HEADER = {"regions": ["moscow"], "output": "out.txt", "started": "2026-01-01T00:00:00"}
+
+
+def test_journal_replay(tmp_path):
+    path = str(tmp_path / "checkpoint.jsonl")
+    checkpoint = megafon.Checkpoint.start(path, HEADER)
+    # Первый запрос маски 777 породил дозагрузки двух классов, одна из них уже сделана
+    checkpoint.add("1", ("777", None, 0), [("777", 3, 44), ("777", 5, 44)])
+    checkpoint.add("1", ("777", 3, 44), [("777", 3, 144)])
+    checkpoint.add("1", ("1234", None, 0), [])
+    checkpoint.sync()
+    checkpoint.add("1", ("777", 5, 44), [])  # Не дошло до fsync номеров - в журнале его нет
+    checkpoint.file.close()
+
+    loaded = megafon.Checkpoint.load(path)
+    assert loaded.header == HEADER
+    assert loaded.pending_units("1", ["777", "1234", "0000"]) == [
+        ("0000", None, 0), ("777", 3, 144), ("777", 5, 44)]
+    assert loaded.pending_units("2", ["777"]) == [("777", None, 0)]
+    loaded.close()
+
+
+def test_split_alias_has_its_own_key(tmp_path):
+    path = str(tmp_path / "checkpoint.jsonl")
+    checkpoint = megafon.Checkpoint.start(path, HEADER)
+    checkpoint.add("1", ("777", None, 0), [])
+    checkpoint.close()
+    loaded = megafon.Checkpoint.load(path)
+    assert loaded.pending_units("1", ["777"]) == []
+    assert loaded.pending_units("1:spb", ["777"]) == [("777", None, 0)]
+    loaded.close()
+
+
+def test_torn_last_line_and_append(tmp_path):
+    path = str(tmp_path / "checkpoint.jsonl")
+    checkpoint = megafon.Checkpoint.start(path, HEADER)
+    checkpoint.add("1", ("777", None, 0), [("777", 3, 44)])
+    checkpoint.close()
+    with open(path, 'a', encoding='utf-8') as f:
+        f.write('{"b": "1", "m": "777", "c": 3, "o"')  # Падение посреди записи
+
+    loaded = megafon.Checkpoint.load(path)
+    assert loaded.pending_units("1", ["777"]) == [("777", 3, 44)]
+    # Продолжение дописывает журнал, и следующий --resume видит оба запуска
+    loaded.add("1", ("777", 3, 44), [])
+    loaded.close()
+    assert megafon.Checkpoint.load(path).pending_units("1", ["777"]) == []
+
+
+def test_missing_or_headerless_journal(tmp_path):
+    assert megafon.Checkpoint.load(str(tmp_path / "missing.jsonl")) is None
+    path = tmp_path / "checkpoint.jsonl"
+    path.write_text('{"b": "1", "m": "777", "c": null, "o": 0, "next": []}\n', encoding='utf-8')
+    assert megafon.Checkpoint.load(str(path)) is None
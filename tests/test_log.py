@@ -0,0 +1,15 @@
+import logging
+
+import megafon
+
+
+def test_request_and_response_bodies_are_sampled_together(monkeypatch, caplog):
+    monkeypatch.setattr(megafon, "LOG_BODY_SAMPLE", 0.5)
+    draws = iter([0.9, 0.1])  # Первый запрос - мимо выборки, второй - в неё
+    monkeypatch.setattr(megafon.random, "random", lambda: next(draws))
+    with caplog.at_level(logging.DEBUG, logger=megafon.logger.name):
+        for i in range(2):
+            sampled = megafon.log_request("POST", f"http://shop/{i}", {"h": i}, {"b": i})
+            megafon.log_response(200, f"answer {i}", sampled)
+    bodies = [r.getMessage() for r in caplog.records if "Body" in r.getMessage() or "Response" in r.getMessage()]
+    assert bodies == ['    Body: {"b": 1}', "    Response: answer 1"]
@@ -0,0 +1,30 @@
+import megafon
+from conftest import make_record
+
+
+def test_duplicates_and_containment():
+    plan = megafon.MaskPlan(["777", " 7777", "777", "12 34", "1234", "77771", "*00*", "", "0"])
+    assert plan.source_count == 9
+    assert plan.masks == ["777", "7777", "1234", "77771", "*00*", "0"]
+    # Маски не из цифр запрашиваются как есть, даже если содержат другую маску
+    assert plan.remote == ["777", "1234", "*00*", "0"]
+    assert plan.derived == {"7777": "777", "77771": "777"}
+    assert plan.children == {"777": ["77771", "7777"]}
+
+
+def test_derived_mask_takes_longest_remote_parent():
+    plan = megafon.MaskPlan(["12", "123", "1234", "12345"])
+    assert plan.remote == ["12"]
+    assert plan.derived == {"123": "12", "1234": "12", "12345": "12"}
+    plan = megafon.MaskPlan(["99", "5", "5995"])
+    assert plan.remote == ["99", "5"]
+    assert plan.derived == {"5995": "99"}
+
+
+def test_refine_picks_longest_matching_child():
+    plan = megafon.MaskPlan(["777", "7777", "77771"])
+    records = [make_record("79157777100", "777"), make_record("79157777200", "777"),
+               make_record("79157770000", "777"), make_record("79157777100", "1234")]
+    for record in records:
+        plan.refine(record)
+    assert [record.mask for record in records] == ["77771", "7777", "777", "1234"]
@@ -0,0 +1,52 @@
+import gzip
+import json
+
+import megafon
+
+
+def write_lines(path, lines):
+    opener = gzip.open if str(path).endswith(".gz") else open
+    with opener(path, 'wt', encoding='utf-8') as f:
+        f.writelines(f"{line}\n" for line in lines)
+    return str(path)
+
+
+def read_lines(path):
+    opener = gzip.open if str(path).endswith(".gz") else open
+    with opener(path, 'rt', encoding='utf-8') as f:
+        return f.read().splitlines()
+
+
+def test_sorted_parts(tmp_path):
+    a = write_lines(tmp_path / "a.txt", [79150000001, 79150000003, 79150000005])
+    b = write_lines(tmp_path / "b.txt.gz", [79150000002, 79150000003, 79150000006])
+    out = tmp_path / "out.txt"
+    assert megafon.merge_results([a, b, str(tmp_path / "missing.txt")], str(out)) == 5
+    assert read_lines(out) == ["79150000001", "79150000002", "79150000003", "79150000005", "79150000006"]
+
+
+def test_unsorted_part_is_sorted_and_deduplicated(tmp_path):
+    """Часть процесса, упавшего до пересортировки, идёт в порядке дописывания"""
+    a = write_lines(tmp_path / "a.txt", [79150000001, 79150000004])
+    b = write_lines(tmp_path / "b.txt", [79150000009, 79150000004, 79150000002, 79150000009])
+    out = tmp_path / "out.txt"
+    assert megafon.merge_results([a, b], str(out)) == 4
+    assert read_lines(out) == ["79150000001", "79150000002", "79150000004", "79150000009"]
+
+
+def test_ndjson_parts_into_txt(tmp_path):
+    a = write_lines(tmp_path / "a.ndjson", [json.dumps({"number": "79150000007"}),
+                                            json.dumps({"number": "79150000001"})])
+    b = write_lines(tmp_path / "b.txt", [79150000001, 79150000003])
+    out = tmp_path / "out.txt"
+    assert megafon.merge_results([a, b], str(out)) == 3
+    assert read_lines(out) == ["79150000001", "79150000003", "79150000007"]
+
+
+def test_txt_parts_into_ndjson(tmp_path):
+    a = write_lines(tmp_path / "a.ndjson", [json.dumps({"number": "79150000007", "region": "moscow"})])
+    b = write_lines(tmp_path / "b.txt", [79150000001, 79150000007])
+    out = tmp_path / "out.ndjson"
+    assert megafon.merge_results([a, b], str(out)) == 2
+    assert [json.loads(line) for line in read_lines(out)] == [
+        {"number": "79150000007", "region": "moscow"}, {"number": "79150000001"}]
@@ -0,0 +1,43 @@
+import random
+
+import megafon
+
+
+def test_add_contains_and_order():
+    numbers = megafon.NumberSet()
+    assert not numbers
+    assert numbers.add(79161234567)
+    assert not numbers.add(79161234567)
+    assert numbers.add(79031234567)
+    assert numbers.add(123)  # Вне диапазона 7XXXXXXXXXX
+    assert numbers.add(89161234567)
+    assert 79161234567 in numbers and 123 in numbers
+    assert 79161234568 not in numbers and 124 not in numbers
+    assert len(numbers) == 4
+    assert list(numbers) == [123, 79031234567, 79161234567, 89161234567]
+
+
+def test_sparse_prefix_becomes_bitmap(monkeypatch):
+    monkeypatch.setattr(megafon.NumberSet, "SPARSE_LIMIT", 50)
+    numbers = megafon.NumberSet()
+    dense = random.Random(1).sample(range(79160000000, 79170000000), 60)
+    for i, number in enumerate(dense):
+        assert numbers.add(number)
+        assert (916 in numbers.bitmaps) == (i + 1 >= 50)
+    assert 916 not in numbers.sparse
+    numbers.add(79031234567)
+    assert 903 in numbers.sparse  # Другой префикс остаётся set
+
+    # После перевода дубли и поиск работают так же
+    assert not numbers.add(dense[0])
+    assert all(number in numbers for number in dense)
+    assert next(n for n in range(79160000000, 79170000000) if n not in dense) not in numbers
+    assert len(numbers) == 61
+    assert list(numbers) == sorted(dense + [79031234567])
+
+
+def test_add_many_and_count_new():
+    numbers = megafon.NumberSet()
+    assert numbers.add_many([79150000001, 79150000002, 79150000001]) == 2
+    assert numbers.count_new([79150000002, 79150000003, 79150000003]) == 1
+    assert len(numbers) == 2
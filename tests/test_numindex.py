@@ -0,0 +1,75 @@
+import random
+import re
+
+import numpy as np
+import pytest
+
+import numindex
+
+
+def oracle(pattern: str):
+    """Шаблон как регулярное выражение - для сверки"""
+    return re.compile(pattern.replace("?", "[0-9]").replace("*", "[0-9]*") + "$")
+
+
+def test_pattern_plan():
+    pattern = numindex.Pattern("7999*")
+    assert (pattern.prefix, pattern.exact_prefix, pattern.exact_suffix, pattern.positional) == ("7999", True, False, False)
+    pattern = numindex.Pattern("*0000")
+    assert (pattern.suffix, pattern.exact_suffix) == ("0000", True)
+    pattern = numindex.Pattern("*1212*")
+    assert (pattern.prefix, pattern.suffix, pattern.literals) == ("", "", ["1212"])
+    pattern = numindex.Pattern("7999xxx00XX")
+    assert (pattern.text, pattern.positional, pattern.prefix, pattern.suffix) == ("7999???00??", True, "7999", "")
+    assert numindex.Pattern("+7916*").prefix == "7916"
+
+
+@pytest.mark.parametrize("text", ["", "79a*", "7999", "*123456789012*"])
+def test_pattern_rejects(text):
+    with pytest.raises(ValueError):
+        numindex.Pattern(text)
+
+
+@pytest.fixture(scope="module")
+def numbers():
+    rng = random.Random(7)
+    picked = {rng.randrange(79000000000, 80000000000) for _ in range(3000)}
+    # Гарантированные попадания для каждого шаблона
+    picked |= {79991230000, 79161212000, 79991110011, 79001212121, 79160000000}
+    return sorted(picked)
+
+
+@pytest.fixture(scope="module")
+def index(tmp_path_factory, numbers):
+    index = numindex.NumberIndex(str(tmp_path_factory.mktemp("index")))
+    half = len(numbers) // 2
+    index.add((n, "spb" if n % 2 else "moscow") for n in numbers[:half])
+    # Второй сегмент пересекается с первым - дубли пар не должны попасть в ответ
+    index.add((n, "spb" if n % 2 else "moscow") for n in numbers[half - 100:])
+    return index
+
+
+@pytest.mark.parametrize("text", ["7999*", "*0000", "*1212*", "7999???00??", "*12*00*", "79??*", "*",
+                                  "7916*0000", "*1?1?1"])
+def test_query_matches_oracle(index, numbers, text):
+    regex = oracle(text)
+    expected = [n for n in numbers if regex.match(str(n))]
+    found, _ = index.query(numindex.Pattern(text))
+    assert found.tolist() == expected
+
+
+def test_query_region_filter(index, numbers):
+    found, regions = index.query(numindex.Pattern("*1*"), regions=["spb"])
+    assert found.tolist() == [n for n in numbers if n % 2 and "1" in str(n)]
+    assert set(regions.tolist()) == {index.manifest["regions"].index("spb")}
+
+
+def test_compact_keeps_answers(tmp_path, numbers):
+    index = numindex.NumberIndex(str(tmp_path / "index"))
+    index.add((n, "spb") for n in numbers[:1000])
+    index.add((n, "spb") for n in numbers[500:])
+    before, _ = index.query(numindex.Pattern("*12*"))
+    index.compact()
+    assert len(index.segments) == 1 and len(index.segments[0]) == len(numbers)
+    after, _ = index.query(numindex.Pattern("*12*"))
+    assert np.array_equal(before, after)
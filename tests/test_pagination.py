@@ -0,0 +1,104 @@
+import asyncio
+from urllib.parse import parse_qs, urlsplit
+
+import pytest
+
+import megafon
+
+CITY = "moscow"
+BRANCH = megafon.REGIONS[CITY]
+
+
+def fake_server(monkeypatch, class_size: int, max_limit: int):
+    """Подменяет запрос API: класс 1 из class_size номеров, страница урезается до max_limit"""
+    phones = [str(79150000000 + i) for i in range(class_size)]
+    requests = []
+
+    async def request(session, url, headers, body, cookies, city, worker_id, mask):
+        query = {k: v[0] for k, v in parse_qs(urlsplit(url).query).items()}
+        offset, limit = int(query["offset"]), int(query["limit"])
+        requests.append((offset, limit))
+        page = phones[offset:offset + min(limit, max_limit)]
+        return {"payload": {"msisdns": [{"msisdn": p, "classType": 1} for p in page]}}, cookies
+
+    monkeypatch.setattr(megafon, "self_request_with_captcha", request)
+    return phones, requests
+
+
+def fetch_class(pagination: dict = None) -> list:
+    """Дозагрузка класса 1 по очереди юнитов, как это делают воркеры; номера по порядку"""
+    pagination = {} if pagination is None else pagination
+    units = [("777", 1, megafon.LIMIT)]
+    found = []
+    while units:
+        unit = units.pop(0)
+        (records, next_units), _ = asyncio.run(megafon.fetch_unit(
+            None, unit, "http://shop", {}, {}, {}, {}, CITY, 0, "", pagination))
+        found += [record.number for record in records]
+        units += next_units
+    return found
+
+
+@pytest.mark.parametrize("class_size, max_limit", [(500, 100), (500, 30), (104, 1000), (300, 1000)])
+def test_class_fetched_completely(monkeypatch, class_size, max_limit):
+    phones, _ = fake_server(monkeypatch, class_size, max_limit)
+    found = fetch_class()
+    assert found == phones[megafon.LIMIT:]
+
+
+def test_server_cap_is_cached_after_confirmation(monkeypatch):
+    _, requests = fake_server(monkeypatch, 500, 100)
+    fetch_class()
+    assert megafon.get_page_limit(BRANCH) == (100, True)
+    # Следующий класс сразу идёт страницами по 100
+    requests.clear()
+    fetch_class()
+    assert {limit for _, limit in requests} == {100}
+
+
+def test_short_class_does_not_cache_its_size(monkeypatch):
+    """Класс короче пробной страницы - не повод считать его длину пределом сервера"""
+    _, requests = fake_server(monkeypatch, 104, 1000)
+    fetch_class()
+    assert megafon.get_page_limit(BRANCH) is None
+    assert requests == [(megafon.LIMIT, megafon.PAGE_LIMIT_PROBE), (104, 60)]
+
+
+def failing_probe(monkeypatch, failure):
+    """Первый запрос (проба) - failure: исключение бросается, None - временная ошибка"""
+    _, requests = fake_server(monkeypatch, 300, 1000)
+    serve = megafon.self_request_with_captcha
+
+    async def request(session, url, headers, body, cookies, city, worker_id, mask):
+        if not requests:
+            requests.append(None)
+            if failure is None:
+                return None, cookies
+            raise failure
+        return await serve(session, url, headers, body, cookies, city, worker_id, mask)
+
+    monkeypatch.setattr(megafon, "self_request_with_captcha", request)
+    (records, _), _ = asyncio.run(megafon.fetch_unit(None, ("777", 1, megafon.LIMIT), "http://shop", {}, {}, {}, {},
+                                                     CITY, 0, "", {}))
+    assert len(records) == megafon.LIMIT + 1  # Страница всё равно получена, со стандартным limit
+    return requests
+
+
+def test_rejected_probe_falls_back_unconfirmed(monkeypatch):
+    requests = failing_probe(monkeypatch, megafon.RequestRejected(400))
+    assert requests == [None, (megafon.LIMIT, megafon.LIMIT + 1)]
+    assert megafon.get_page_limit(BRANCH) == (megafon.LIMIT + 1, True)  # Полная страница подтвердила стандартный
+
+
+def test_transient_probe_failure_leaves_cache_alone(monkeypatch):
+    requests = failing_probe(monkeypatch, None)
+    assert requests == [None, (megafon.LIMIT, megafon.LIMIT + 1)]
+    assert megafon.get_page_limit(BRANCH) is None
+    assert not megafon.page_probes
+
+
+def test_rejected_cookies_during_probe_are_not_cached(monkeypatch):
+    with pytest.raises(megafon.RequestRejected):
+        failing_probe(monkeypatch, megafon.RequestRejected(403))
+    assert megafon.get_page_limit(BRANCH) is None
+    assert not megafon.page_probes
@@ -0,0 +1,36 @@
+import gzip
+import os
+
+import megafon
+
+
+def test_truncated_gzip_is_repaired_before_append(tmp_path):
+    """Хвост, оборванный падением, отрезается, и дописанное после --resume читается"""
+    path = str(tmp_path / "out.txt.gz")
+    with gzip.open(path, 'at', encoding='utf-8') as f:
+        f.write("".join(f"{79150000000 + i}\n" for i in range(1000)))
+    with gzip.open(path, 'at', encoding='utf-8') as f:
+        f.write("".join(f"{79160000000 + i}\n" for i in range(1000)))
+    os.truncate(path, os.path.getsize(path) - 20)  # Второй член оборван
+
+    kept = megafon.repair_gzip(path)
+    assert 1000 <= kept < 2000
+    with gzip.open(path, 'at', encoding='utf-8') as f:
+        f.write("79170000000\n")
+
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        lines = f.read().splitlines()
+    assert len(lines) == kept + 1
+    assert lines[-1] == "79170000000"
+    assert all(len(line) == 11 for line in lines)
+    assert megafon.repair_gzip(path) is None
+
+
+def test_intact_gzip_is_left_alone(tmp_path):
+    path = str(tmp_path / "out.txt.gz")
+    with gzip.open(path, 'wt', encoding='utf-8') as f:
+        f.write("79150000001\n")
+    before = os.path.getmtime(path), os.path.getsize(path)
+    assert megafon.repair_gzip(path) is None
+    assert megafon.repair_gzip(str(tmp_path / "missing.gz")) is None
+    assert (os.path.getmtime(path), os.path.getsize(path)) == before
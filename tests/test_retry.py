@@ -0,0 +1,99 @@
+import asyncio
+
+import pytest
+
+import megafon
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Подменённые часы time.monotonic, которые двигает тест"""
+    now = [1000.0]
+    monkeypatch.setattr(megafon.time, "monotonic", lambda: now[0])
+    return now
+
+
+def trip(breaker: megafon.CircuitBreaker) -> list:
+    return [breaker.failure() for _ in range(megafon.BREAKER_FAILURES)]
+
+
+def test_breaker_opens_after_failures_in_a_row(clock):
+    breaker = megafon.CircuitBreaker()
+    for _ in range(megafon.BREAKER_FAILURES - 1):
+        assert not breaker.failure()
+    breaker.success()  # Успех сбрасывает счёт
+    assert trip(breaker)[-1] is True
+    assert breaker.is_open and not breaker.allow()
+    assert breaker.open_until == 1000.0 + megafon.BREAKER_COOLDOWN
+
+
+def test_breaker_half_open_probe(clock):
+    breaker = megafon.CircuitBreaker()
+    trip(breaker)
+    clock[0] += megafon.BREAKER_COOLDOWN
+    assert not breaker.is_open
+    assert breaker.allow()  # Один пробный запрос
+    assert breaker.is_open and not breaker.allow()  # Остальные ждут его исхода
+
+    # Проба не прошла - пауза вдвое дольше
+    assert breaker.failure()
+    assert breaker.cooldown == megafon.BREAKER_COOLDOWN * 2
+    assert breaker.open_until == clock[0] + megafon.BREAKER_COOLDOWN * 2
+
+    # Проба прошла - автомат замкнут, пауза снова базовая
+    clock[0] = breaker.open_until
+    assert breaker.allow()
+    breaker.success()
+    assert not breaker.is_open and breaker.allow()
+    assert (breaker.failures, breaker.opens, breaker.cooldown) == (0, 0, megafon.BREAKER_COOLDOWN)
+
+
+def test_breaker_gives_up_after_max_opens(clock):
+    breaker = megafon.CircuitBreaker()
+    trip(breaker)
+    for _ in range(megafon.BREAKER_MAX_OPENS):
+        assert not breaker.given_up
+        clock[0] = breaker.open_until
+        assert breaker.allow()
+        breaker.failure()
+    assert breaker.given_up
+    assert not breaker.allow() and not breaker.is_open
+    assert breaker.cooldown <= megafon.BREAKER_COOLDOWN_MAX
+
+
+def test_retry_budget(monkeypatch):
+    monkeypatch.setattr(megafon.random, "uniform", lambda a, b: 0)
+    policy = megafon.RetryPolicy("moscow")
+
+    async def scenario():
+        retries = 0
+        while await policy.before("msisdn", retry=1):
+            retries += 1
+        assert retries == megafon.RETRY_BUDGET_MIN
+        # Первые запросы пополняют бюджет долями RETRY_BUDGET_RATIO
+        for _ in range(round(1 / megafon.RETRY_BUDGET_RATIO)):
+            assert await policy.before("msisdn", retry=0)
+        assert await policy.before("msisdn", retry=1)
+        assert not await policy.before("msisdn", retry=1)
+
+    asyncio.run(scenario())
+
+
+def test_retry_budget_is_capped():
+    policy = megafon.RetryPolicy("moscow")
+
+    async def scenario():
+        for _ in range(1000):
+            await policy.before("msisdn", retry=0)
+
+    asyncio.run(scenario())
+    assert policy.budget == megafon.RETRY_BUDGET_MIN * 10
+
+
+def test_open_breaker_blocks_only_its_endpoint(clock):
+    policy = megafon.RetryPolicy("moscow")
+    for _ in range(megafon.BREAKER_FAILURES):
+        policy.failure("msisdn")
+    assert policy.is_open("msisdn") and not policy.is_open("classes")
+    assert not asyncio.run(policy.before("msisdn", retry=0))
+    assert asyncio.run(policy.before("classes", retry=0))
@@ -0,0 +1,46 @@
+import asyncio
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import megafon
+
+
+class CookieHandler(BaseHTTPRequestHandler):
+    """/set ставит куку, любой адрес возвращает заголовок Cookie запроса"""
+
+    def do_GET(self):
+        body = (self.headers.get("Cookie") or "").encode()
+        self.send_response(200)
+        if self.path == "/set":
+            self.send_header("Set-Cookie", "leak=1; Path=/")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), CookieHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_port}"
+    server.shutdown()
+
+
+def test_pooled_session_sends_only_explicit_cookies(server):
+    pool = megafon.SessionPool()
+
+    async def scenario():
+        async with pool.session(None) as session:
+            response = await session.get(f"{server}/set", cookies={"branchId": "1"})
+            assert response.cookies.get("leak") == "1"  # Ответ куки видит
+        async with pool.session(None) as session:
+            response = await session.get(f"{server}/echo", cookies={"branchId": "2"})
+        await pool.close()
+        return response.text
+
+    assert asyncio.run(scenario()) == "branchId=2"
@@ -0,0 +1,46 @@
+import asyncio
+import contextlib
+
+import megafon
+from conftest import make_record
+
+
+class FakePool:
+    @contextlib.asynccontextmanager
+    async def session(self, proxy):
+        yield None
+
+
+def test_workers_survive_polls_and_records_are_refined(monkeypatch):
+    warmups = []
+    polls = [["79157777100", "79157770000"], ["79157777100", "79157771234"]]
+
+    async def cookies(session, city, branch_id, base_url, proxy, tag, **kwargs):
+        warmups.append(proxy)
+        return {}, None
+
+    async def fetch_unit(session, unit, *args):
+        mask, class_type, offset = unit
+        return ([make_record(number, mask) for number in polls[0]], []), {}
+
+    monkeypatch.setattr(megafon, "session_pool", FakePool())
+    monkeypatch.setattr(megafon, "get_bootstrap_cookies", cookies)
+    monkeypatch.setattr(megafon, "fetch_unit", fetch_unit)
+
+    async def scenario():
+        megafon.worker_slots = asyncio.Semaphore(2)
+        pair = megafon.WatchPair("moscow", "777", 60, megafon.MaskPlan(["777", "7777"]))
+        first = await megafon.poll_pair(pair, ["p1", "p2"], [])
+        # Между опросами воркеры живы, но слоты отданы другим парам
+        await asyncio.sleep(0)
+        assert megafon.worker_slots._value == 2
+        polls.pop(0)
+        second = await megafon.poll_pair(pair, ["p1", "p2"], [])
+        assert not any(worker.done() for worker in pair.workers)
+        await megafon.stop_pair(pair)
+        return first, second
+
+    first, second = asyncio.run(scenario())
+    assert sorted(warmups) == ["p1", "p2"]  # Прогрев - один раз на воркера, а не на опрос
+    assert {r.number: r.mask for r in first.values()} == {"79157777100": "7777", "79157770000": "777"}
+    assert {r.number: r.mask for r in second.values()} == {"79157777100": "7777", "79157771234": "777"}
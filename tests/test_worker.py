@@ -0,0 +1,146 @@
+import asyncio
+import contextlib
+
+import megafon
+
+
+class FakePool:
+    @contextlib.asynccontextmanager
+    async def session(self, proxy):
+        yield None
+
+
+class PausedPolicy:
+    """API региона на паузе, пока не выставлено ready"""
+
+    def __init__(self):
+        self.ready = asyncio.Event()
+        self.waiting = asyncio.Event()
+
+    def is_open(self, endpoint):
+        return not self.ready.is_set()
+
+    async def wait_ready(self, endpoint):
+        self.waiting.set()
+        await self.ready.wait()
+
+
+def start_worker(monkeypatch, policy):
+    async def cookies(*args, **kwargs):
+        return {}, None
+
+    monkeypatch.setattr(megafon, "session_pool", FakePool())
+    monkeypatch.setattr(megafon, "get_bootstrap_cookies", cookies)
+    monkeypatch.setattr(megafon, "retry_policy", lambda city: policy)
+    queue = megafon.WorkQueue()
+    return asyncio.create_task(megafon.worker_fetch(1, None, "moscow", megafon.REGIONS["moscow"], "http://shop",
+                                                    [], queue, None, {}))
+
+
+def test_paused_worker_gives_slot_back(monkeypatch):
+    async def scenario():
+        megafon.worker_slots = asyncio.Semaphore(1)
+        policy = PausedPolicy()
+        task = start_worker(monkeypatch, policy)
+        await policy.waiting.wait()
+        # Пока регион на паузе, слот свободен для других
+        assert not megafon.worker_slots.locked()
+        async with megafon.worker_slots:
+            policy.ready.set()
+            await asyncio.sleep(0)
+            assert not task.done()  # Воркер ждёт слот обратно
+        assert await task == 0  # Очередь пуста - воркер завершился
+        assert megafon.worker_slots._value == 1
+
+    asyncio.run(scenario())
+
+
+def test_cancel_during_pause_does_not_leak_or_over_release(monkeypatch):
+    async def scenario():
+        megafon.worker_slots = asyncio.Semaphore(1)
+        policy = PausedPolicy()
+        task = start_worker(monkeypatch, policy)
+        await policy.waiting.wait()
+        await megafon.worker_slots.acquire()  # Слот забрал другой регион
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        assert task.cancelled()
+        megafon.worker_slots.release()
+        assert megafon.worker_slots._value == 1
+
+    asyncio.run(scenario())
+
+
+class PausingPolicy:
+    """Пауза региона выставляется снаружи и снимается при ожидании"""
+
+    def __init__(self):
+        self.paused = False
+
+    def is_open(self, endpoint):
+        return self.paused
+
+    async def wait_ready(self, endpoint):
+        self.paused = False
+
+
+def run_cached_worker(monkeypatch, outcomes, policy=None):
+    """Воркер на куках из кэша: outcomes - ответы fetch_unit по порядку
+    (исключение или его класс - бросается). Возвращает аргументы stale_since прогревов."""
+    warmups = []
+    policy = policy or PausingPolicy()
+
+    async def cookies(*args, stale_since=None, **kwargs):
+        if stale_since is not None:
+            warmups.append(stale_since)
+            return {}, None
+        return {}, 100.0
+
+    async def fetch_unit(*args):
+        outcome = outcomes.pop(0)
+        if isinstance(outcome, type):
+            outcome = outcome()
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome, {}
+
+    class Writer:
+        async def put(self, records, done=None):
+            pass
+
+    monkeypatch.setattr(megafon, "session_pool", FakePool())
+    monkeypatch.setattr(megafon, "get_bootstrap_cookies", cookies)
+    monkeypatch.setattr(megafon, "fetch_unit", fetch_unit)
+    monkeypatch.setattr(megafon, "retry_policy", lambda city: policy)
+    megafon.worker_slots = asyncio.Semaphore(1)
+    queue = megafon.WorkQueue()
+    queue.put(("777", None, 0))
+    asyncio.run(megafon.worker_fetch(1, None, "moscow", megafon.REGIONS["moscow"], "http://shop",
+                                     [], queue, Writer(), {}, verbose=False))
+    return warmups
+
+
+def test_rejected_cached_cookies_warm_up_once(monkeypatch):
+    outcomes = [megafon.RequestRejected(403), ([], [])]
+    assert run_cached_worker(monkeypatch, outcomes) == [100.0]
+    assert outcomes == []
+
+
+def test_server_error_does_not_warm_up(monkeypatch):
+    # 5xx и исчерпанный бюджет - fetch_unit вернул None, куки тут ни при чём
+    outcomes = [None, ([], [])]
+    assert run_cached_worker(monkeypatch, outcomes) == []
+    assert outcomes == []
+
+
+def test_paused_region_does_not_warm_up(monkeypatch):
+    policy = PausingPolicy()
+
+    class PausingRejection(megafon.RequestRejected):
+        def __init__(self):
+            super().__init__(401)
+            policy.paused = True  # Пока шёл запрос, регион встал на паузу
+
+    outcomes = [PausingRejection, ([], [])]
+    assert run_cached_worker(monkeypatch, outcomes, policy) == []
+    assert outcomes == []
@@ -0,0 +1,44 @@
+import megafon
+from conftest import make_record
+
+
+def test_yield_credited_to_queried_mask(tmp_path):
+    """Номера выводимой маски засчитываются в отдачу запрошенной, из которой она выведена"""
+    plan = megafon.MaskPlan(["777", "7777", "1234"])
+    writer = megafon.ResultWriter(str(tmp_path / "out.txt"), mask_plan=plan)
+    writer.write([make_record("79157777001", "777"), make_record("79157770002", "777"),
+                  make_record("79151234003", "1234")])
+    writer.write([make_record("79157777001", "777")])  # Дубль не засчитывается
+    writer.file.close()
+
+    branch = megafon.REGIONS["moscow"]
+    history = megafon.yield_history
+    assert history.new == {(branch, "777"): 2, (branch, "1234"): 1}
+    assert plan.hits == {"7777": 1}
+
+    for mask in ("777", "1234"):
+        history.request(branch, mask)
+    history.save()
+    saved = megafon.load_json_cache(history.filename)
+    assert saved[f"{branch}|777"]["rate"] == 2.0
+    assert saved[f"{branch}|1234"]["rate"] == 1.0
+    assert f"{branch}|7777" not in saved
+
+
+def test_store_and_file_agree_on_derived_mask(tmp_path):
+    """В базу попадает та же уточнённая маска, что и в файл, в том числе для дублей"""
+    store = megafon.ResultStore(str(tmp_path / "numbers.db"))
+    store.start_run("out.ndjson", ["moscow"])
+    plan = megafon.MaskPlan(["777", "7777"])
+    writer = megafon.ResultWriter(str(tmp_path / "out.ndjson"), fmt="ndjson", mask_plan=plan, store=store)
+    writer.write([make_record("79157777001", "777"), make_record("79157770002", "777")])
+    writer.write([make_record("79157777001", "777")])
+    writer.sync()
+    writer.file.close()
+
+    with open(tmp_path / "out.ndjson", encoding="utf-8") as f:
+        in_file = {int(entry["number"]): entry["mask"] for entry in map(megafon.json.loads, f)}
+    in_db = dict(store.db.execute("SELECT number, mask FROM numbers"))
+    store.db.close()
+    assert in_file == in_db == {79157777001: "7777", 79157770002: "777"}
+    assert plan.hits == {"7777": 1}